@@ -0,0 +1,323 @@
+"""
+Нагрузочный прогон полного расклада против фейкового Bot API.
+
+    python benchmark.py --users 200
+    python benchmark.py --users 200 --out bench_results/run.json --compare bench_results/prev.json
+
+Поднимает роутер из create_router() и локальный aiohttp-сервер вместо api.telegram.org,
+картинки не качаются (заглушка), паузы сценариев идут по сжатым часам.
+N пользователей параллельно проходят /start → ready_yes → запрос → draw_cards →
+show_resource → resource_understood; следующий шаг пользователь делает, только когда
+доиграл сценарий предыдущего. В отчёте: p50/p95/p99 обработки апдейтов,
+апдейты в секунду, рост RSS и число сессий, транзакции SQLite на апдейт.
+Если число вызовов Bot API не совпало с ожидаемым (расклад прошёл не целиком),
+прогон завершается с ошибкой и результаты не сохраняются.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+os.environ.setdefault("BOT_TOKEN", "123456:benchmark")
+
+from aiogram import Bot
+from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.enums import ParseMode
+from aiohttp import web
+
+import database
+import main
+from card_media import CardMediaCache
+from draws import DrawEngine, make_rng
+from scripts import ScriptEngine
+
+FAKE_IMAGE = b"\x89PNG\r\n\x1a\n" + b"\x00" * 2048
+
+# Паузы пользователя между шагами (секунды «реального» времени до сжатия)
+FLOW = (
+    ('start', 8),
+    ('ready_yes', 2),
+    ('request', 2),
+    ('draw_cards', 38),
+    ('show_resource', 36),
+    ('resource_understood', 0),
+)
+
+# Вызовы Bot API за один полный расклад пользователя
+EXPECTED_CALLS_PER_USER = {
+    'answerCallbackQuery': 4,  # ready_yes, draw_cards, show_resource, resource_understood
+    'deleteMessage': 2,        # «Вытягиваем карту...» перед каждой картой
+    'sendMessage': 16,
+    'sendPhoto': 2,
+}
+
+
+class CompressedClock:
+    def __init__(self, scale: float):
+        self.scale = scale
+
+    async def sleep(self, delay: float) -> None:
+        await asyncio.sleep(delay / self.scale)
+
+
+class FakeTelegramAPI:
+    """Минимальный Bot API: отвечает правдоподобными объектами и считает вызовы."""
+
+    def __init__(self):
+        self.calls = {}
+        self._message_id = 0
+
+    def _message(self, chat_id, **extra) -> dict:
+        self._message_id += 1
+        return dict({
+            'message_id': self._message_id,
+            'date': int(time.time()),
+            'chat': {'id': int(chat_id), 'type': 'private'},
+        }, **extra)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        self.calls[method] = self.calls.get(method, 0) + 1
+        data = await request.post()
+        chat_id = data.get('chat_id', 0)
+
+        if method == 'sendPhoto':
+            result = self._message(chat_id, photo=[{
+                'file_id': f"photo-{self._message_id}", 'file_unique_id': f"u{self._message_id}",
+                'width': 1280, 'height': 1280,
+            }])
+        elif method == 'sendMediaGroup':
+            media = json.loads(data.get('media', '[]'))
+            result = [self._message(chat_id, photo=[{
+                'file_id': f"photo-{self._message_id}-{i}", 'file_unique_id': f"u{self._message_id}-{i}",
+                'width': 1280, 'height': 1280,
+            }]) for i in range(len(media))]
+        elif method.startswith('send'):
+            result = self._message(chat_id, text=data.get('text', ''))
+        else:
+            result = True
+        return web.json_response({'ok': True, 'result': result})
+
+
+def percentile(values, q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(q / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize(values) -> dict:
+    return {
+        'count': len(values),
+        'p50_ms': round(percentile(values, 50) * 1000, 3),
+        'p95_ms': round(percentile(values, 95) * 1000, 3),
+        'p99_ms': round(percentile(values, 99) * 1000, 3),
+        'max_ms': round(max(values) * 1000, 3) if values else 0.0,
+    }
+
+
+def rss_bytes() -> int:
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Benchmark:
+    def __init__(self, bot: Bot, dp, clock: CompressedClock):
+        self.bot = bot
+        self.dp = dp
+        self.clock = clock
+        self.latencies = {name: [] for name, _ in FLOW}
+        self._update_id = 0
+
+    def _next_update_id(self) -> int:
+        self._update_id += 1
+        return self._update_id
+
+    def _user(self, user_id: int) -> dict:
+        return {'id': user_id, 'is_bot': False, 'first_name': f"User{user_id}"}
+
+    def _message(self, user_id: int, text: str) -> dict:
+        return {
+            'update_id': self._next_update_id(),
+            'message': {
+                'message_id': self._update_id, 'date': int(time.time()), 'text': text,
+                'chat': {'id': user_id, 'type': 'private'}, 'from': self._user(user_id),
+                **({'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(text)}]}
+                   if text.startswith('/') else {}),
+            },
+        }
+
+    def _callback(self, user_id: int, data: str) -> dict:
+        return {
+            'update_id': self._next_update_id(),
+            'callback_query': {
+                'id': str(self._update_id), 'chat_instance': str(user_id), 'data': data,
+                'from': self._user(user_id),
+                'message': {
+                    'message_id': self._update_id, 'date': int(time.time()),
+                    'chat': {'id': user_id, 'type': 'private'}, 'text': '...',
+                },
+            },
+        }
+
+    def _update_for(self, step: str, user_id: int) -> dict:
+        if step == 'start':
+            return self._message(user_id, '/start')
+        if step == 'request':
+            return self._message(user_id, 'Как мне найти внутренний покой?')
+        return self._callback(user_id, step)
+
+    async def run_user(self, user_id: int) -> None:
+        for step, pause in FLOW:
+            update = self._update_for(step, user_id)
+            started = time.perf_counter()
+            await self.dp.feed_raw_update(self.bot, update)
+            self.latencies[step].append(time.perf_counter() - started)
+            # Пользователь отвечает на последнее сообщение сценария: иначе следующий шаг
+            # отменит недоигранный сценарий и прогон окажется короче настоящего расклада
+            await main.scripts.wait(user_id)
+            if pause:
+                await self.clock.sleep(pause)
+
+
+async def run(args) -> dict:
+    workdir = tempfile.mkdtemp(prefix="elina-bench-")
+    database.DB_PATH = os.path.join(workdir, "bench.db")
+    database.init_db()
+
+    commits = 0
+
+    def trace(statement: str) -> None:
+        nonlocal commits
+        if statement.lstrip().upper().startswith('COMMIT'):
+            commits += 1
+
+    await database._run(lambda conn: conn.set_trace_callback(trace))
+
+    api = FakeTelegramAPI()
+    app = web.Application()
+    app.router.add_post('/bot{token}/{method}', api.handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', args.port)
+    await site.start()
+
+    clock = CompressedClock(args.time_scale)
+    main.scripts = ScriptEngine(sleep=clock.sleep)
+    # Одинаковые карты от прогона к прогону — результаты сравнимы
+    main.draws = DrawEngine(make_rng(args.seed))
+
+    fetches = 0
+
+    async def stub_loader(card):
+        nonlocal fetches
+        fetches += 1
+        return FAKE_IMAGE
+
+    bot = Bot(
+        token=os.environ["BOT_TOKEN"],
+        session=AiohttpSession(api=TelegramAPIServer.from_base(f"http://127.0.0.1:{args.port}")),
+        default=DefaultBotProperties(parse_mode=ParseMode.HTML),
+    )
+    if args.rate_limit:
+        bot.session.middleware(main.outbound)
+
+    catalog = main.load_catalog()
+    media = CardMediaCache(stub_loader)
+    await media.load(catalog)
+    dp = main.create_dispatcher(catalog, media)
+
+    bench = Benchmark(bot, dp, clock)
+    rss_before = rss_bytes()
+    started = time.perf_counter()
+    await asyncio.gather(*(bench.run_user(100000 + i) for i in range(args.users)))
+    elapsed = time.perf_counter() - started
+    await database.write_queue.flush()
+    rss_after = rss_bytes()
+
+    all_latencies = [value for values in bench.latencies.values() for value in values]
+    updates = len(all_latencies)
+    result = {
+        'revision': git_revision(),
+        'timestamp': int(time.time()),
+        'params': {'users': args.users, 'time_scale': args.time_scale, 'rate_limit': args.rate_limit,
+                   'seed': args.seed},
+        'updates': updates,
+        'wall_seconds': round(elapsed, 3),
+        'updates_per_second': round(updates / elapsed, 1) if elapsed else 0.0,
+        'latency': summarize(all_latencies),
+        'latency_by_step': {step: summarize(values) for step, values in bench.latencies.items()},
+        'rss_growth_bytes': rss_after - rss_before,
+        'sessions_in_memory': len(main.sessions),
+        'db_commits': commits,
+        'db_commits_per_update': round(commits / updates, 3) if updates else 0.0,
+        'image_loads': fetches,
+        'api_calls': dict(sorted(api.calls.items())),
+        'api_calls_expected': {method: count * args.users for method, count in EXPECTED_CALLS_PER_USER.items()},
+    }
+
+    await main.scripts.stop()
+    await bot.session.close()
+    await runner.cleanup()
+    await database.close_db()
+    return result
+
+
+def compare(current: dict, previous: dict) -> None:
+    print(f"\nСравнение с {previous.get('revision')}:")
+    for key in ('updates_per_second', 'db_commits_per_update', 'rss_growth_bytes'):
+        print(f"  {key}: {previous.get(key)} → {current.get(key)}")
+    for key in ('p50_ms', 'p95_ms', 'p99_ms'):
+        print(f"  latency.{key}: {previous['latency'].get(key)} → {current['latency'].get(key)}")
+
+
+def cli():
+    logging.basicConfig(level=logging.WARNING)
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон расклада")
+    parser.add_argument("--users", type=int, default=100, help="число параллельных пользователей")
+    parser.add_argument("--time-scale", type=float, default=1000, help="во сколько раз сжимать паузы")
+    parser.add_argument("--rate-limit", action="store_true", help="включить лимиты исходящих сообщений")
+    parser.add_argument("--port", type=int, default=8099, help="порт фейкового Bot API")
+    parser.add_argument("--seed", type=int, default=42, help="зерно вытягивания карт")
+    parser.add_argument("--out", help="куда сохранить результаты (JSON)")
+    parser.add_argument("--compare", help="JSON предыдущего прогона для сравнения")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    if result['api_calls'] != result['api_calls_expected']:
+        logging.error(f"💥 Расклад прошёл не целиком: вызовы Bot API {result['api_calls']}, "
+                      f"ожидалось {result['api_calls_expected']}")
+        return 1
+
+    if args.out:
+        os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+        with open(args.out, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            compare(result, json.load(f))
+
+
+if __name__ == "__main__":
+    sys.exit(cli())
@@ -0,0 +1,158 @@
+"""
+Сборка оптимизированных вариантов картинок карт и чтение их манифеста.
+
+    python card_assets.py            # собрать assets/ из cards.json и cards/
+    python card_assets.py --force    # пересобрать всё
+
+Для сборки нужен Pillow; боту он не нужен — бот только читает manifest.json.
+"""
+import argparse
+import hashlib
+import io
+import json
+import logging
+import os
+import sys
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+CARDS_JSON = os.path.join(BASE_DIR, "cards.json")
+SOURCE_DIR = os.path.join(BASE_DIR, "cards")
+ASSETS_DIR = os.path.join(BASE_DIR, "assets")
+MANIFEST_FILE = "manifest.json"
+MANIFEST_VERSION = 1
+
+# Telegram всё равно ужимает фото до 1280 px по большей стороне
+VARIANTS = {
+    'photo': {'max_side': 1280, 'quality': 85},
+    'thumb': {'max_side': 320, 'quality': 75},
+}
+
+
+def _sha256(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def _source_path(image_url: str) -> str:
+    return os.path.join(SOURCE_DIR, os.path.basename(image_url))
+
+
+def _render(image, max_side: int, quality: int) -> tuple:
+    variant = image.copy()
+    variant.thumbnail((max_side, max_side))
+    buffer = io.BytesIO()
+    variant.save(buffer, format='JPEG', quality=quality, optimize=True, progressive=True)
+    return buffer.getvalue(), variant.size
+
+
+def _write(path: str, data: bytes) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def load_manifest(assets_dir: str = ASSETS_DIR) -> dict:
+    try:
+        with open(os.path.join(assets_dir, MANIFEST_FILE), 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {'version': MANIFEST_VERSION, 'variants': VARIANTS, 'cards': {}}
+    if manifest.get('version') != MANIFEST_VERSION or manifest.get('variants') != VARIANTS:
+        # Другие параметры сборки — старые варианты не подходят
+        manifest['cards'] = {}
+    return manifest
+
+
+def _is_fresh(entry: dict | None, source_hash: str, assets_dir: str) -> bool:
+    if not entry or entry.get('source_sha256') != source_hash:
+        return False
+    return all(os.path.exists(os.path.join(assets_dir, entry[name]['path'])) for name in VARIANTS)
+
+
+def build(cards_json: str = CARDS_JSON, assets_dir: str = ASSETS_DIR, force: bool = False) -> dict:
+    try:
+        from PIL import Image
+    except ImportError:
+        sys.exit("❌ Для сборки картинок нужен Pillow: pip install Pillow")
+
+    with open(cards_json, 'r', encoding='utf-8') as f:
+        cards = json.load(f)
+
+    manifest = load_manifest(assets_dir)
+    old_entries = {} if force else manifest['cards']
+    entries = {}
+    built = skipped = missing = 0
+
+    for card in cards:
+        source = _source_path(card['image_url'])
+        try:
+            with open(source, 'rb') as f:
+                source_bytes = f.read()
+        except OSError:
+            logging.warning(f"⚠️ Нет исходника для карты {card['id']}: {source}")
+            missing += 1
+            continue
+
+        key = str(card['id'])
+        source_hash = _sha256(source_bytes)
+        if _is_fresh(old_entries.get(key), source_hash, assets_dir):
+            entries[key] = old_entries[key]
+            skipped += 1
+            continue
+
+        image = Image.open(io.BytesIO(source_bytes)).convert('RGB')
+        entry = {
+            'source': os.path.relpath(source, BASE_DIR),
+            'source_sha256': source_hash,
+            'source_bytes': len(source_bytes),
+            'width': image.width,
+            'height': image.height,
+        }
+        for name, params in VARIANTS.items():
+            data, (width, height) = _render(image, params['max_side'], params['quality'])
+            path = os.path.join(name, f"{card['id']}.jpg")
+            _write(os.path.join(assets_dir, path), data)
+            entry[name] = {'path': path, 'sha256': _sha256(data), 'bytes': len(data),
+                           'width': width, 'height': height}
+        entries[key] = entry
+        built += 1
+
+    manifest = {'version': MANIFEST_VERSION, 'variants': VARIANTS, 'cards': entries}
+    os.makedirs(assets_dir, exist_ok=True)
+    _write(os.path.join(assets_dir, MANIFEST_FILE), json.dumps(manifest, ensure_ascii=False, indent=2).encode('utf-8'))
+    logging.info(f"✅ Картинки: собрано {built}, без изменений {skipped}, нет исходника {missing}")
+    return manifest
+
+
+class CardAssets:
+    """Оптимизированные варианты картинок карт по манифесту из assets/."""
+
+    def __init__(self, assets_dir: str = ASSETS_DIR):
+        self.assets_dir = assets_dir
+        self._cards = load_manifest(assets_dir)['cards']
+
+    def __len__(self):
+        return len(self._cards)
+
+    def variant(self, card_id: int, name: str = 'photo') -> dict | None:
+        entry = self._cards.get(str(card_id))
+        return entry.get(name) if entry else None
+
+    def read(self, card_id: int, name: str = 'photo') -> bytes | None:
+        variant = self.variant(card_id, name)
+        if not variant:
+            return None
+        try:
+            with open(os.path.join(self.assets_dir, variant['path']), 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Сборка оптимизированных картинок карт")
+    parser.add_argument("--force", action="store_true", help="пересобрать все варианты")
+    args = parser.parse_args()
+    build(force=args.force)
@@ -0,0 +1,156 @@
+import asyncio
+import logging
+import os
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import BufferedInputFile, InputFile, InputMediaPhoto, Message
+
+from database import get_card_media, save_card_file_id, delete_card_file_id
+
+# Признаки того, что Telegram отверг именно file_id (а не чат, подпись или клавиатуру)
+FILE_ID_ERRORS = ('wrong file identifier', 'wrong remote file id', 'file_reference_', 'wrong file_id')
+
+
+def is_file_id_error(error: TelegramBadRequest) -> bool:
+    message = str(error.message).lower()
+    return any(marker in message for marker in FILE_ID_ERRORS)
+
+
+class MemoryInputFile(InputFile):
+    """Загрузка из memoryview (например, из mmap колоды) без копирования в bytes."""
+
+    def __init__(self, data: memoryview, filename: str):
+        super().__init__(filename=filename)
+        self.data = data
+
+    async def read(self, bot: Bot):
+        for start in range(0, len(self.data), self.chunk_size):
+            yield self.data[start:start + self.chunk_size]
+
+
+class CardMediaCache:
+    """
+    Кэш Telegram file_id для фото карт.
+
+    После первой отправки карты Telegram возвращает file_id — дальше карта
+    отправляется по нему, без скачивания и повторной загрузки картинки.
+    Записи хранятся в таблице card_media и переживают перезапуск бота.
+
+    file_id привязан к image_url и хэшу содержимого картинки (image_hash):
+    новая колода с другими картинками под теми же URL грузится заново.
+    """
+
+    def __init__(self, image_loader, image_hash=None, image_filename=None):
+        # image_loader: async (card) -> bytes | memoryview | None
+        # image_hash: (card) -> str | None — хэш того, что отдаст image_loader (None — не известен)
+        # image_filename: (card) -> str — имя файла с расширением формата того, что отдаст image_loader
+        self._image_loader = image_loader
+        self._image_hash = image_hash or (lambda card: None)
+        self._image_filename = image_filename or (
+            lambda card: f"{card.id}{os.path.splitext(card.image_url)[1] or '.png'}"
+        )
+        self._file_ids = {}  # card_id -> ((image_url, image_hash), file_id)
+
+    def _key(self, card) -> tuple:
+        return card.image_url, self._image_hash(card)
+
+    async def load(self, cards) -> None:
+        """Загружает кэш из базы, отбрасывая записи карт, у которых сменились image_url или картинка."""
+        current = {c.id: self._key(c) for c in cards}
+        file_ids = {}
+        for card_id, (image_url, image_hash, file_id) in (await get_card_media()).items():
+            if current.get(card_id) == (image_url, image_hash):
+                file_ids[card_id] = ((image_url, image_hash), file_id)
+            else:
+                await delete_card_file_id(card_id)
+                logging.info(f"🗑 file_id карты {card_id} устарел (изменилась картинка)")
+        self._file_ids = file_ids
+        logging.info(f"✅ Загружено {len(self._file_ids)} file_id карт из кэша")
+
+    def get(self, card) -> str | None:
+        cached = self._file_ids.get(card.id)
+        if cached and cached[0] == self._key(card):
+            return cached[1]
+        return None
+
+    async def remember(self, card, file_id: str) -> None:
+        key = self._key(card)
+        self._file_ids[card.id] = (key, file_id)
+        await save_card_file_id(card.id, key[0], key[1], file_id)
+
+    async def invalidate(self, card_id: int) -> None:
+        self._file_ids.pop(card_id, None)
+        await delete_card_file_id(card_id)
+
+    async def send_photo(self, bot: Bot, chat_id: int, card, **kwargs) -> Message | None:
+        """
+        Отправляет фото карты: по закэшированному file_id, а если его нет
+        или Telegram его отверг — свежей загрузкой картинки.
+        Возвращает None, если изображение загрузить не удалось.
+        """
+        file_id = self.get(card)
+        if file_id:
+            try:
+                return await bot.send_photo(chat_id=chat_id, photo=file_id, **kwargs)
+            except TelegramBadRequest as e:
+                # Остальные 400 (чат не найден, кривая подпись) к кэшу отношения не имеют
+                if not is_file_id_error(e):
+                    raise
+                logging.warning(f"⚠️ Telegram отклонил file_id карты {card.id}: {e}")
+                await self.invalidate(card.id)
+
+        photo = await self._upload(card)
+        if photo is None:
+            return None
+        message = await bot.send_photo(chat_id=chat_id, photo=photo, **kwargs)
+        if message.photo:
+            await self.remember(card, message.photo[-1].file_id)
+        return message
+
+    async def _upload(self, card) -> InputFile | None:
+        img = await self._image_loader(card)
+        if not img:
+            return None
+        filename = self._image_filename(card)
+        if isinstance(img, memoryview):
+            return MemoryInputFile(img, filename=filename)
+        return BufferedInputFile(img, filename=filename)
+
+    async def send_media_group(self, bot: Bot, chat_id: int, cards, captions=None) -> list | None:
+        """
+        Отправляет несколько карт одним альбомом (sendMediaGroup, 2–10 фото).
+        Карты с file_id идут по нему, остальные картинки грузятся параллельно.
+        Если Telegram отверг какой-то file_id — кэш этих карт сбрасывается
+        и альбом уходит заново со свежей загрузкой.
+        Возвращает сообщения альбома или None, если какую-то картинку загрузить не удалось.
+        """
+        cards = list(cards)
+        captions = list(captions) if captions is not None else [None] * len(cards)
+
+        for attempt in range(2):
+            photos = [self.get(card) for card in cards]
+            missing = [i for i, photo in enumerate(photos) if photo is None]
+            uploads = await asyncio.gather(*(self._upload(cards[i]) for i in missing))
+            for i, upload in zip(missing, uploads):
+                if upload is None:
+                    logging.error(f"❌ Нет картинки для карты {cards[i].id}, альбом не отправлен")
+                    return None
+                photos[i] = upload
+
+            media = [InputMediaPhoto(media=photo, caption=caption) for photo, caption in zip(photos, captions)]
+            try:
+                messages = await bot.send_media_group(chat_id=chat_id, media=media)
+            except TelegramBadRequest as e:
+                cached = [card for i, card in enumerate(cards) if i not in missing]
+                if attempt or not cached or not is_file_id_error(e):
+                    raise
+                logging.warning(f"⚠️ Telegram отклонил альбом с file_id: {e}")
+                for card in cached:
+                    await self.invalidate(card.id)
+                continue
+
+            for card, message in zip(cards, messages):
+                if message.photo and self.get(card) is None:
+                    await self.remember(card, message.photo[-1].file_id)
+            return messages
@@ -0,0 +1,101 @@
+import logging
+import os
+import re
+import sqlite3
+from collections import OrderedDict
+
+from catalog import CardCatalog
+
+# Сколько разных запросов помнить (набор в inline-режиме повторяет префиксы)
+SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", 512))
+MAX_RESULTS = 50  # больше Telegram в ответе на inline-запрос не принимает
+
+_WORD = re.compile(r"\w+", re.UNICODE)
+
+
+def normalize(text: str) -> str:
+    # unicode61 снимает диакритику только с латиницы, поэтому ё → е делаем сами
+    return text.lower().replace('ё', 'е')
+
+
+class CardSearch:
+    """
+    Полнотекстовый поиск карт по названию и описанию.
+
+    Индекс — FTS5 в SQLite в памяти, строится из колоды при первом запросе
+    и перестраивается после горячей замены колоды (catalog.revision).
+    Каждое слово запроса ищется по префиксу ("благод" найдёт "благодарность"),
+    совпадения в названии весят больше, чем в описании.
+    Результаты кэшируются по нормализованной строке запроса (LRU).
+    """
+
+    def __init__(self, catalog: CardCatalog, cache_size: int = SEARCH_CACHE_SIZE):
+        self.catalog = catalog
+        self.cache_size = cache_size
+        self._cache = OrderedDict()  # (запрос, limit) -> tuple(card_id)
+        self._conn = None
+        self._revision = None
+        self.hits = 0
+        self.misses = 0
+
+    def _build(self) -> None:
+        conn = sqlite3.connect(":memory:")
+        conn.execute('''
+            CREATE VIRTUAL TABLE cards USING fts5(
+                name, description, card_id UNINDEXED,
+                tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3 4'
+            )
+        ''')
+        conn.executemany(
+            'INSERT INTO cards (name, description, card_id) VALUES (?, ?, ?)',
+            [(normalize(card.name), normalize(card.description), card.id) for card in self.catalog]
+        )
+        conn.commit()
+        if self._conn is not None:
+            self._conn.close()
+        self._conn = conn
+        self._revision = self.catalog.revision
+        self._cache.clear()
+        logging.info(f"🔎 Индекс поиска: {len(self.catalog)} карт")
+
+    @staticmethod
+    def _match_expression(query: str) -> str | None:
+        words = _WORD.findall(normalize(query))
+        if not words:
+            return None
+        # Каждое слово в кавычках (без операторов FTS5) и по префиксу; все слова обязательны
+        return ' '.join(f'"{word}"*' for word in words)
+
+    def search(self, query: str, limit: int = 10) -> list:
+        """Карты, подходящие под запрос, от лучших к худшим."""
+        if self._conn is None or self._revision != self.catalog.revision:
+            self._build()
+
+        key = (' '.join(normalize(query).split()), limit)
+        card_ids = self._cache.get(key)
+        if card_ids is not None:
+            self.hits += 1
+            self._cache.move_to_end(key)
+        else:
+            self.misses += 1
+            card_ids = self._lookup(key[0], limit)
+            self._cache[key] = card_ids
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+        return [card for card in map(self.catalog.get, card_ids) if card is not None]
+
+    def _lookup(self, query: str, limit: int) -> tuple:
+        if query.isdigit():
+            card = self.catalog.get(int(query))
+            if card is not None:
+                return (card.id,)
+
+        expression = self._match_expression(query)
+        if expression is None:
+            return ()
+        rows = self._conn.execute(
+            'SELECT card_id FROM cards WHERE cards MATCH ? ORDER BY bm25(cards, 10.0, 1.0) LIMIT ?',
+            (expression, min(limit, MAX_RESULTS))
+        ).fetchall()
+        return tuple(row[0] for row in rows)
@@ -0,0 +1,69 @@
+import json
+import random
+
+
+class Card:
+    __slots__ = ('id', 'name', 'description', 'type', 'image_url')
+
+    def __init__(self, id: int, name: str, description: str, type: str, image_url: str):
+        self.id = id
+        self.name = name
+        self.description = description
+        self.type = type
+        self.image_url = image_url
+
+    def __repr__(self):
+        return f"Card(id={self.id}, type={self.type!r}, name={self.name!r})"
+
+
+class CardCatalog:
+    """
+    Колода карт, проиндексированная один раз при загрузке:
+    id → карта и готовые кортежи карт по типам для случайного выбора за O(1).
+    """
+
+    def __init__(self, cards):
+        self._cards = tuple(cards)
+        self._by_id = {card.id: card for card in self._cards}
+
+        by_type = {}
+        for card in self._cards:
+            by_type.setdefault(card.type, []).append(card)
+        self._by_type = {card_type: tuple(items) for card_type, items in by_type.items()}
+
+        self.types = tuple(self._by_type)
+        self.min_id = min(self._by_id) if self._by_id else 0
+        self.max_id = max(self._by_id) if self._by_id else 0
+        # Растёт при каждой горячей замене — по нему производные индексы понимают, что устарели
+        self.revision = 0
+
+    @classmethod
+    def from_json(cls, path: str) -> 'CardCatalog':
+        with open(path, 'r', encoding='utf-8') as f:
+            raw_cards = json.load(f)
+        return cls(
+            Card(c['id'], c['name'], c['description'], c['type'], c['image_url'])
+            for c in raw_cards
+        )
+
+    def swap(self, other: 'CardCatalog') -> None:
+        """Подменяет содержимое колоды на месте — горячая замена без перезапуска."""
+        self._cards, self._by_id, self._by_type = other._cards, other._by_id, other._by_type
+        self.types, self.min_id, self.max_id = other.types, other.min_id, other.max_id
+        self.revision += 1
+
+    def __len__(self):
+        return len(self._cards)
+
+    def __iter__(self):
+        return iter(self._cards)
+
+    def get(self, card_id: int) -> Card | None:
+        return self._by_id.get(card_id)
+
+    def of_type(self, card_type: str) -> tuple:
+        return self._by_type.get(card_type, ())
+
+    def random(self, card_type: str, rng=random) -> Card | None:
+        cards = self._by_type.get(card_type)
+        return rng.choice(cards) if cards else None
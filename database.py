@@ -1,96 +1,942 @@
+import asyncio
+import fcntl
+import json
+import logging
 import sqlite3
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import db_call_seconds
 
 # ✅ Универсальный путь: работает и на Render, и в Docker
 # База создаётся в той же папке, где лежит скрипт (рядом с main.py)
-DB_PATH = os.path.join(os.path.dirname(__file__), "bot_database.db")
+# DB_PATH переопределяет путь; база вместе с -wal и -shm должна лежать в одном каталоге
+# (в Docker — смонтированном целиком, см. docker-compose.yml)
+DB_PATH = os.getenv("DB_PATH") or os.path.join(os.path.dirname(__file__), "bot_database.db")
+
+# Одно долгоживущее соединение и один поток: SQLite всё равно пишет по одному,
+# а event loop больше не блокируется на fsync
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+_conn = None
+
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",   # в WAL-режиме безопасно и без fsync на каждый коммит
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA cache_size=-8000",     # ~8 МБ страничного кэша
+    "PRAGMA temp_store=MEMORY",
+)
+
+def _connect():
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+def _get_conn():
+    global _conn
+    if _conn is None:
+        _conn = _connect()
+    return _conn
+
+async def _run(fn, *args):
+    """Выполняет fn(conn, *args) в потоке базы данных."""
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    try:
+        return await loop.run_in_executor(_executor, lambda: fn(_get_conn(), *args))
+    finally:
+        db_call_seconds.observe(time.perf_counter() - started, call=fn.__name__.lstrip('_'))
+
+def _close():
+    global _conn
+    if _conn is not None:
+        # Переносим WAL в основной файл: новый процесс стартует без долгого восстановления
+        try:
+            _conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        except sqlite3.Error as e:
+            logging.warning(f"⚠️ Не удалось сделать checkpoint WAL: {e}")
+        _conn.close()
+        _conn = None
+
+def _prewarm(conn):
+    # Открывает соединение и читает горячие индексы в страничный кэш
+    conn.execute("SELECT COUNT(*) FROM users").fetchone()
+    conn.execute("SELECT COUNT(*) FROM sessions").fetchone()
+    conn.execute("SELECT COUNT(*) FROM draw_state").fetchone()
+
+async def prewarm_db():
+    await _run(_prewarm)
+
+async def close_db():
+    # Сначала гарантированно сбрасываем отложенные записи
+    lost = await write_queue.stop()
+    if lost:
+        logging.error(f"💥 При остановке не записано в базу {lost} операций, они сохранены в {failed_writes_path()}")
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(_executor, _close)
+
+# ========================
+# 🔹 СХЕМА И МИГРАЦИИ
+# ========================
+
+# Версия схемы хранится в PRAGMA user_version; миграции идут строго по порядку
+MIGRATION_BATCH_SIZE = int(os.getenv("DB_MIGRATION_BATCH", 1000))
+
+class _transaction:
+    """BEGIN IMMEDIATE … COMMIT: берёт блокировку записи сразу, а не на первом UPDATE."""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.conn.commit()
+        else:
+            self.conn.rollback()
+
+def _user_version(conn) -> int:
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def _columns(conn, table: str) -> set:
+    return {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+
+def _migrate_1_base(conn):
+    """Исходная схема (база до версионирования тоже приводится к ней)."""
+    with _transaction(conn):
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS users (
+                user_id INTEGER PRIMARY KEY,
+                first_name TEXT NOT NULL,
+                created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+                current_request TEXT
+            )
+        ''')
+        # Совсем старые базы: users без current_request
+        if 'current_request' not in _columns(conn, 'users'):
+            conn.execute("ALTER TABLE users ADD COLUMN current_request TEXT")
+
+        # История раскладов (описания карт здесь — до миграции 2)
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS requests (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                request_text TEXT,
+                block_card_id INTEGER,
+                resource_card_id INTEGER,
+                block_card_description TEXT,
+                resource_card_description TEXT,
+                requested_at TEXT DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES users (user_id)
+            )
+        ''')
+
+        # Кэш Telegram file_id для фото карт (чтобы не загружать картинку при каждом показе)
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS card_media (
+                card_id INTEGER PRIMARY KEY,
+                image_url TEXT NOT NULL,
+                file_id TEXT NOT NULL,
+                updated_at TEXT DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
+        # Сессии диалога (состояние расклада), чтобы они переживали перезапуск
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS sessions (
+                user_id INTEGER PRIMARY KEY,
+                step TEXT,
+                request_text TEXT,
+                block_card_id INTEGER,
+                resource_card_id INTEGER,
+                last_interaction REAL,
+                updated_at REAL NOT NULL
+            )
+        ''')
+
+        # Отложенные задачи (follow-up сообщения), переживающие перезапуск
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS scheduled_jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                kind TEXT NOT NULL,
+                run_at REAL NOT NULL,
+                payload TEXT,
+                UNIQUE (user_id, kind)
+            )
+        ''')
+
+        # Состояния aiogram FSM, общие для всех процессов бота
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS fsm_states (
+                key TEXT PRIMARY KEY,
+                state TEXT,
+                data TEXT,
+                updated_at REAL NOT NULL
+            )
+        ''')
+
+def _migrate_2_normalize_requests(conn):
+    """
+    requests хранит только id карт: описания берутся из колоды.
+    Строки переносятся в новую таблицу пачками, каждая пачка — своя короткая
+    транзакция, так что бот продолжает писать в базу во время миграции.
+    Прерванная миграция продолжается с последней перенесённой строки.
+    """
+    with _transaction(conn):
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS requests_v2 (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                request_text TEXT,
+                block_card_id INTEGER,
+                resource_card_id INTEGER,
+                requested_at TEXT DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES users (user_id)
+            )
+        ''')
+
+    copy_sql = '''
+        INSERT OR IGNORE INTO requests_v2 (id, user_id, request_text, block_card_id, resource_card_id, requested_at)
+        SELECT id, user_id, request_text, block_card_id, resource_card_id, requested_at
+        FROM requests WHERE id > ? ORDER BY id LIMIT ?
+    '''
+    copied = 0
+    while True:
+        with _transaction(conn):
+            last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM requests_v2").fetchone()[0]
+            batch = conn.execute(copy_sql, (last_id, MIGRATION_BATCH_SIZE)).rowcount
+        copied += batch
+        if batch < MIGRATION_BATCH_SIZE:
+            break
+
+    # Хвост (строки, записанные во время переноса) и подмена таблиц — в одной транзакции
+    with _transaction(conn):
+        last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM requests_v2").fetchone()[0]
+        copied += conn.execute(copy_sql, (last_id, -1)).rowcount
+        conn.execute("DROP TABLE requests")
+        conn.execute("ALTER TABLE requests_v2 RENAME TO requests")
+        # История пользователя и выборки по времени читаются из индексов, без обращения к таблице
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS idx_requests_user_time
+            ON requests (user_id, requested_at, block_card_id, resource_card_id)
+        ''')
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS idx_requests_time
+            ON requests (requested_at, block_card_id, resource_card_id)
+        ''')
+    if copied:
+        logging.info(f"📦 Перенесено раскладов без описаний: {copied}")
+
+def _migrate_3_aggregates(conn):
+    """
+    Агрегаты для отчётов: выпадения карт по дням, активность по дням, расклады по пользователям.
+    Обновляются триггерами в той же транзакции, что и вставка в requests,
+    поэтому отчёты читают готовые суммы, а не сканируют историю.
+    """
+    with _transaction(conn):
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS card_draws_daily (
+                day TEXT NOT NULL,
+                card_id INTEGER NOT NULL,
+                role TEXT NOT NULL,
+                draws INTEGER NOT NULL,
+                PRIMARY KEY (day, card_id, role)
+            ) WITHOUT ROWID
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS daily_stats (
+                day TEXT PRIMARY KEY,
+                readings INTEGER NOT NULL DEFAULT 0,
+                active_users INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS daily_users (
+                day TEXT NOT NULL,
+                user_id INTEGER NOT NULL,
+                PRIMARY KEY (day, user_id)
+            ) WITHOUT ROWID
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS user_readings (
+                user_id INTEGER PRIMARY KEY,
+                readings INTEGER NOT NULL,
+                first_at TEXT NOT NULL,
+                last_at TEXT NOT NULL
+            )
+        ''')
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_user_readings_count ON user_readings (readings)")
+
+        # Заполняем агрегаты по уже накопленной истории (до создания триггеров — без двойного счёта)
+        conn.execute('''
+            INSERT OR REPLACE INTO card_draws_daily (day, card_id, role, draws)
+            SELECT date(requested_at), block_card_id, 'block', COUNT(*) FROM requests
+            WHERE block_card_id IS NOT NULL GROUP BY 1, 2
+            UNION ALL
+            SELECT date(requested_at), resource_card_id, 'resource', COUNT(*) FROM requests
+            WHERE resource_card_id IS NOT NULL GROUP BY 1, 2
+        ''')
+        conn.execute('''
+            INSERT OR REPLACE INTO daily_users (day, user_id)
+            SELECT DISTINCT date(requested_at), user_id FROM requests
+        ''')
+        conn.execute('''
+            INSERT OR REPLACE INTO daily_stats (day, readings, active_users)
+            SELECT date(requested_at), COUNT(*), COUNT(DISTINCT user_id) FROM requests GROUP BY 1
+        ''')
+        conn.execute('''
+            INSERT OR REPLACE INTO user_readings (user_id, readings, first_at, last_at)
+            SELECT user_id, COUNT(*), MIN(requested_at), MAX(requested_at) FROM requests GROUP BY user_id
+        ''')
+
+        conn.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_requests_aggregates AFTER INSERT ON requests
+            BEGIN
+                INSERT INTO card_draws_daily (day, card_id, role, draws)
+                SELECT date(NEW.requested_at), NEW.block_card_id, 'block', 1 WHERE NEW.block_card_id IS NOT NULL
+                ON CONFLICT (day, card_id, role) DO UPDATE SET draws = draws + 1;
+                INSERT INTO card_draws_daily (day, card_id, role, draws)
+                SELECT date(NEW.requested_at), NEW.resource_card_id, 'resource', 1 WHERE NEW.resource_card_id IS NOT NULL
+                ON CONFLICT (day, card_id, role) DO UPDATE SET draws = draws + 1;
+                INSERT INTO daily_stats (day, readings) VALUES (date(NEW.requested_at), 1)
+                ON CONFLICT (day) DO UPDATE SET readings = readings + 1;
+                INSERT OR IGNORE INTO daily_users (day, user_id) VALUES (date(NEW.requested_at), NEW.user_id);
+                INSERT INTO user_readings (user_id, readings, first_at, last_at)
+                VALUES (NEW.user_id, 1, NEW.requested_at, NEW.requested_at)
+                ON CONFLICT (user_id) DO UPDATE SET readings = readings + 1, last_at = NEW.requested_at;
+            END
+        ''')
+        # Новый пользователь за день — срабатывает только на реально вставленную строку
+        conn.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_daily_users_count AFTER INSERT ON daily_users
+            BEGIN
+                INSERT INTO daily_stats (day, active_users) VALUES (NEW.day, 1)
+                ON CONFLICT (day) DO UPDATE SET active_users = active_users + 1;
+            END
+        ''')
+
+def _migrate_4_request_cards(conn):
+    """
+    Расклады любого размера: карты расклада — строки request_cards с позицией.
+    Колонки block_card_id/resource_card_id в requests остаются для пары «блок + ресурс»,
+    а выпадения карт для отчётов теперь считаются по request_cards.
+    """
+    with _transaction(conn):
+        if 'spread' not in _columns(conn, 'requests'):
+            conn.execute("ALTER TABLE requests ADD COLUMN spread TEXT NOT NULL DEFAULT 'pair'")
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS request_cards (
+                request_id INTEGER NOT NULL,
+                position INTEGER NOT NULL,
+                card_id INTEGER NOT NULL,
+                role TEXT NOT NULL,
+                PRIMARY KEY (request_id, position),
+                FOREIGN KEY (request_id) REFERENCES requests (id)
+            ) WITHOUT ROWID
+        ''')
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_request_cards_card ON request_cards (card_id)")
+        conn.execute('''
+            INSERT OR IGNORE INTO request_cards (request_id, position, card_id, role)
+            SELECT id, 0, block_card_id, 'block' FROM requests WHERE block_card_id IS NOT NULL
+            UNION ALL
+            SELECT id, 1, resource_card_id, 'resource' FROM requests WHERE resource_card_id IS NOT NULL
+        ''')
+
+        conn.execute("DROP TRIGGER IF EXISTS trg_requests_aggregates")
+        conn.execute('''
+            CREATE TRIGGER trg_requests_aggregates AFTER INSERT ON requests
+            BEGIN
+                INSERT INTO daily_stats (day, readings) VALUES (date(NEW.requested_at), 1)
+                ON CONFLICT (day) DO UPDATE SET readings = readings + 1;
+                INSERT OR IGNORE INTO daily_users (day, user_id) VALUES (date(NEW.requested_at), NEW.user_id);
+                INSERT INTO user_readings (user_id, readings, first_at, last_at)
+                VALUES (NEW.user_id, 1, NEW.requested_at, NEW.requested_at)
+                ON CONFLICT (user_id) DO UPDATE SET readings = readings + 1, last_at = NEW.requested_at;
+            END
+        ''')
+        conn.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_request_cards_draws AFTER INSERT ON request_cards
+            BEGIN
+                INSERT INTO card_draws_daily (day, card_id, role, draws)
+                SELECT date(requested_at), NEW.card_id, NEW.role, 1 FROM requests WHERE id = NEW.request_id
+                ON CONFLICT (day, card_id, role) DO UPDATE SET draws = draws + 1;
+            END
+        ''')
+
+def _migrate_5_draw_state(conn):
+    """Уже вытянутые карты по пользователю и типу — битсет id карт (мешок без повторов)."""
+    with _transaction(conn):
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS draw_state (
+                user_id INTEGER NOT NULL,
+                card_type TEXT NOT NULL,
+                drawn BLOB NOT NULL,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (user_id, card_type)
+            ) WITHOUT ROWID
+        ''')
+
+def _migrate_6_idempotency(conn):
+    """Ключ идемпотентности расклада: повторная доставка того же нажатия не создаёт вторую запись."""
+    with _transaction(conn):
+        if 'idempotency_key' not in _columns(conn, 'requests'):
+            conn.execute("ALTER TABLE requests ADD COLUMN idempotency_key TEXT")
+        conn.execute('''
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_requests_idempotency
+            ON requests (idempotency_key) WHERE idempotency_key IS NOT NULL
+        ''')
+
+def _migrate_7_card_media_hash(conn):
+    """Хэш содержимого картинки в card_media: file_id сбрасывается, если картинка сменилась под тем же URL."""
+    with _transaction(conn):
+        if 'image_hash' not in _columns(conn, 'card_media'):
+            conn.execute("ALTER TABLE card_media ADD COLUMN image_hash TEXT")
+
+MIGRATIONS = (
+    (1, _migrate_1_base),
+    (2, _migrate_2_normalize_requests),
+    (3, _migrate_3_aggregates),
+    (4, _migrate_4_request_cards),
+    (5, _migrate_5_draw_state),
+    (6, _migrate_6_idempotency),
+    (7, _migrate_7_card_media_hash),
+)
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+class _migration_lock:
+    """
+    Файловая блокировка на всё время миграций. Блокировку записи SQLite на это
+    время держать нельзя (миграция 2 идёт короткими транзакциями, чтобы бот
+    продолжал писать), поэтому второй процесс с init_db() ждёт здесь.
+    """
+
+    def __init__(self, db_path: str):
+        self.path = db_path + ".migrate.lock"
+        self._file = None
+
+    def __enter__(self):
+        self._file = open(self.path, 'a')
+        fcntl.flock(self._file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        fcntl.flock(self._file, fcntl.LOCK_UN)
+        self._file.close()
+        self._file = None
+
+def migrate(conn) -> int:
+    """Применяет недостающие миграции; возвращает итоговую версию схемы. Вызывать под _migration_lock."""
+    for version, migration in MIGRATIONS:
+        if _user_version(conn) >= version:
+            continue
+        logging.info(f"🔧 Миграция схемы до версии {version}: {migration.__doc__.strip().splitlines()[0]}")
+        migration(conn)
+        with _transaction(conn):
+            conn.execute(f"PRAGMA user_version = {version}")
+    return _user_version(conn)
 
 def init_db():
-    """Инициализация базы данных: создаёт таблицы, если их нет."""
+    """Инициализация базы данных: создаёт таблицы и применяет миграции схемы."""
     # Убедимся, что директория существует (актуально для некоторых систем)
     os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
-    
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-
-    # Таблица пользователей
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            user_id INTEGER PRIMARY KEY,
-            first_name TEXT NOT NULL,
-            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
-            current_request TEXT
-        )
-    ''')
 
-    # Попытка добавить колонку current_request (если база старая)
+    conn = _connect()
     try:
-        cursor.execute("ALTER TABLE users ADD COLUMN current_request TEXT;")
-    except sqlite3.OperationalError:
-        pass  # Колонка уже существует
-
-    # Таблица запросов
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS requests (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            request_text TEXT,
-            block_card_id INTEGER,
-            resource_card_id INTEGER,
-            block_card_description TEXT,
-            resource_card_description TEXT,
-            requested_at TEXT DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (user_id)
-        )
-    ''')
+        # Другой процесс (db-init, соседний воркер) мог начать миграцию — ждём его целиком
+        with _migration_lock(DB_PATH):
+            version = _user_version(conn)
+            if version > SCHEMA_VERSION:
+                raise RuntimeError(f"База новее кода: схема {version}, поддерживается до {SCHEMA_VERSION}")
+            migrate(conn)
+    finally:
+        conn.close()
 
-    conn.commit()
-    conn.close()
+# ========================
+# 🔹 ПОЛЬЗОВАТЕЛИ И ЗАПРОСЫ
+# ========================
 
-def add_or_update_user(user_id, first_name):
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('''
+def _add_or_update_user(conn, user_id, first_name):
+    conn.execute('''
         INSERT OR REPLACE INTO users (user_id, first_name)
         VALUES (?, ?)
     ''', (user_id, first_name))
     conn.commit()
-    conn.close()
-
-def get_user(user_id):
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('SELECT first_name FROM users WHERE user_id = ?', (user_id,))
-    user = cursor.fetchone()
-    conn.close()
+
+async def add_or_update_user(user_id, first_name):
+    await _run(_add_or_update_user, user_id, first_name)
+
+def _get_user(conn, user_id):
+    user = conn.execute('SELECT first_name FROM users WHERE user_id = ?', (user_id,)).fetchone()
     return user[0] if user else None
 
-def update_current_request(user_id, request_text):
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('''
-        UPDATE users SET current_request = ? WHERE user_id = ?
-    ''', (request_text, user_id))
-    conn.commit()
-    conn.close()
-
-def clear_current_request(user_id):
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('''
-        UPDATE users SET current_request = NULL WHERE user_id = ?
-    ''', (user_id,))
+async def get_user(user_id):
+    return await _run(_get_user, user_id)
+
+# Запись current_request и истории раскладов идёт через write-behind очередь:
+# функции возвращаются сразу, а в базу всё уходит пачкой в одной транзакции
+
+async def update_current_request(user_id, request_text):
+    write_queue.set_current_request(user_id, request_text)
+
+async def clear_current_request(user_id):
+    write_queue.set_current_request(user_id, None)
+
+async def save_request(user_id, request_text, cards, spread='pair', idempotency_key=None):
+    """
+    cards — карты расклада по порядку позиций: [(card_id, role), ...], role — 'block' или 'resource'.
+    Описания карт не дублируются в истории — они есть в колоде.
+    idempotency_key (например, id callback-запроса): запись с уже сохранённым ключом игнорируется.
+    """
+    cards = tuple(cards)
+    block_card_id = next((card_id for card_id, role in cards if role == 'block'), None)
+    resource_card_id = next((card_id for card_id, role in cards if role == 'resource'), None)
+    write_queue.add_request((user_id, request_text, block_card_id, resource_card_id, spread, cards, idempotency_key))
+
+# ========================
+# 🔹 КЭШ FILE_ID КАРТ
+# ========================
+
+def _get_card_media(conn):
+    rows = conn.execute('SELECT card_id, image_url, image_hash, file_id FROM card_media').fetchall()
+    return {card_id: (image_url, image_hash, file_id) for card_id, image_url, image_hash, file_id in rows}
+
+async def get_card_media():
+    """Возвращает {card_id: (image_url, image_hash, file_id)} для всех закэшированных карт."""
+    return await _run(_get_card_media)
+
+def _save_card_file_id(conn, card_id, image_url, image_hash, file_id):
+    conn.execute('''
+        INSERT OR REPLACE INTO card_media (card_id, image_url, image_hash, file_id, updated_at)
+        VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+    ''', (card_id, image_url, image_hash, file_id))
     conn.commit()
-    conn.close()
-
-def save_request(user_id, request_text, block_card_id, resource_card_id, block_desc, resource_desc):
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT INTO requests (
-            user_id, request_text, block_card_id, resource_card_id,
-            block_card_description, resource_card_description
-        ) VALUES (?, ?, ?, ?, ?, ?)
-    ''', (user_id, request_text, block_card_id, resource_card_id, block_desc, resource_desc))
+
+async def save_card_file_id(card_id, image_url, image_hash, file_id):
+    await _run(_save_card_file_id, card_id, image_url, image_hash, file_id)
+
+def _delete_card_file_id(conn, card_id):
+    conn.execute('DELETE FROM card_media WHERE card_id = ?', (card_id,))
     conn.commit()
-    conn.close()
+
+async def delete_card_file_id(card_id):
+    await _run(_delete_card_file_id, card_id)
+
+# ========================
+# 🔹 СЕССИИ
+# ========================
+
+SESSION_COLUMNS = ('user_id', 'step', 'request_text', 'block_card_id', 'resource_card_id', 'last_interaction', 'updated_at')
+
+def _get_session(conn, user_id, min_updated_at):
+    return conn.execute(
+        f'SELECT {", ".join(SESSION_COLUMNS)} FROM sessions WHERE user_id = ? AND updated_at >= ?',
+        (user_id, min_updated_at)
+    ).fetchone()
+
+async def get_session(user_id, min_updated_at):
+    """Строка сессии (в порядке SESSION_COLUMNS) или None, если её нет или она устарела."""
+    pending = write_queue.pending_session(user_id)
+    if pending is not write_queue.NOT_PENDING:
+        return pending
+    return await _run(_get_session, user_id, min_updated_at)
+
+async def save_session(row):
+    write_queue.set_session(row[0], row)
+
+async def delete_session(user_id):
+    write_queue.set_session(user_id, None)
+
+def _write_session(conn, row):
+    with conn:
+        conn.execute(
+            f'INSERT OR REPLACE INTO sessions ({", ".join(SESSION_COLUMNS)}) VALUES ({", ".join("?" * len(SESSION_COLUMNS))})',
+            row
+        )
+
+def _remove_session(conn, user_id):
+    with conn:
+        conn.execute('DELETE FROM sessions WHERE user_id = ?', (user_id,))
+
+async def save_session_now(row):
+    """Запись сессии сразу, мимо write-behind очереди (общий режим для нескольких процессов)."""
+    await _run(_write_session, row)
+
+async def delete_session_now(user_id):
+    await _run(_remove_session, user_id)
+
+def _purge_sessions(conn, min_updated_at):
+    with conn:
+        return conn.execute('DELETE FROM sessions WHERE updated_at < ?', (min_updated_at,)).rowcount
+
+async def purge_sessions(min_updated_at):
+    return await _run(_purge_sessions, min_updated_at)
+
+# ========================
+# 🔹 ОТЛОЖЕННЫЕ ЗАДАЧИ
+# ========================
+
+def _add_job(conn, user_id, kind, run_at, payload):
+    with conn:
+        # UNIQUE (user_id, kind): новая задача заменяет старую того же вида
+        cursor = conn.execute(
+            'INSERT OR REPLACE INTO scheduled_jobs (user_id, kind, run_at, payload) VALUES (?, ?, ?, ?)',
+            (user_id, kind, run_at, payload)
+        )
+        return cursor.lastrowid
+
+async def add_job(user_id, kind, run_at, payload=None):
+    return await _run(_add_job, user_id, kind, run_at, payload)
+
+def _delete_jobs(conn, user_id, kinds):
+    with conn:
+        conn.executemany('DELETE FROM scheduled_jobs WHERE user_id = ? AND kind = ?',
+                         [(user_id, kind) for kind in kinds])
+
+async def delete_jobs(user_id, kinds):
+    """Удаляет задачи пользователя нескольких видов одной транзакцией."""
+    await _run(_delete_jobs, user_id, tuple(kinds))
+
+def _claim_job(conn, job_id):
+    with conn:
+        return conn.execute('DELETE FROM scheduled_jobs WHERE id = ?', (job_id,)).rowcount == 1
+
+async def claim_job(job_id):
+    """Забирает задачу на выполнение; False — её уже отменили или забрал другой процесс."""
+    return await _run(_claim_job, job_id)
+
+def _get_jobs(conn):
+    return conn.execute('SELECT id, user_id, kind, run_at, payload FROM scheduled_jobs').fetchall()
+
+async def get_jobs():
+    return await _run(_get_jobs)
+
+# ========================
+# 🔹 FSM
+# ========================
+
+def _get_fsm(conn, key, column, min_updated_at):
+    row = conn.execute(
+        f'SELECT {column} FROM fsm_states WHERE key = ? AND updated_at >= ?', (key, min_updated_at)
+    ).fetchone()
+    return row[0] if row else None
+
+async def get_fsm_state(key, min_updated_at):
+    return await _run(_get_fsm, key, 'state', min_updated_at)
+
+async def get_fsm_data(key, min_updated_at):
+    return await _run(_get_fsm, key, 'data', min_updated_at)
+
+def _set_fsm(conn, key, column, value, now):
+    with conn:
+        conn.execute(f'''
+            INSERT INTO fsm_states (key, {column}, updated_at) VALUES (?, ?, ?)
+            ON CONFLICT (key) DO UPDATE SET {column} = excluded.{column}, updated_at = excluded.updated_at
+        ''', (key, value, now))
+        # Пустая запись не нужна
+        conn.execute('DELETE FROM fsm_states WHERE key = ? AND state IS NULL AND data IS NULL', (key,))
+
+async def set_fsm_state(key, state, now):
+    await _run(_set_fsm, key, 'state', state, now)
+
+async def set_fsm_data(key, data, now):
+    await _run(_set_fsm, key, 'data', data, now)
+
+def _purge_fsm(conn, min_updated_at):
+    with conn:
+        return conn.execute('DELETE FROM fsm_states WHERE updated_at < ?', (min_updated_at,)).rowcount
+
+async def purge_fsm(min_updated_at):
+    return await _run(_purge_fsm, min_updated_at)
+
+# ========================
+# 🔹 СОСТОЯНИЕ ВЫТЯГИВАНИЯ КАРТ
+# ========================
+
+def _get_draw_state(conn, user_id, card_type):
+    row = conn.execute(
+        'SELECT drawn FROM draw_state WHERE user_id = ? AND card_type = ?', (user_id, card_type)
+    ).fetchone()
+    return row[0] if row else None
+
+async def get_draw_state(user_id, card_type) -> bytes | None:
+    pending = write_queue.pending_draw_state(user_id, card_type)
+    if pending is not write_queue.NOT_PENDING:
+        return pending[0]
+    return await _run(_get_draw_state, user_id, card_type)
+
+async def save_draw_state(user_id, card_type, drawn: bytes):
+    write_queue.set_draw_state(user_id, card_type, (drawn, time.time()))
+
+# ========================
+# 🔹 WRITE-BEHIND ОЧЕРЕДЬ
+# ========================
+
+# Сброс очереди: по количеству накопленных операций или по времени (секунды)
+FLUSH_MAX_OPS = int(os.getenv("DB_FLUSH_MAX_OPS", 100))
+FLUSH_INTERVAL = float(os.getenv("DB_FLUSH_INTERVAL", 0.5))
+# Сколько раз подряд повторять упавшую пачку, прежде чем писать её операции по одной
+FLUSH_MAX_RETRIES = int(os.getenv("DB_FLUSH_RETRIES", 3))
+
+def _apply_batch(conn, current_requests, requests, sessions, draw_states):
+    with conn:
+        conn.executemany(
+            f'INSERT OR REPLACE INTO sessions ({", ".join(SESSION_COLUMNS)}) VALUES ({", ".join("?" * len(SESSION_COLUMNS))})',
+            [row for row in sessions.values() if row is not None]
+        )
+        conn.executemany(
+            'DELETE FROM sessions WHERE user_id = ?',
+            [(user_id,) for user_id, row in sessions.items() if row is None]
+        )
+        conn.executemany(
+            'UPDATE users SET current_request = ? WHERE user_id = ?',
+            [(request_text, user_id) for user_id, request_text in current_requests.items()]
+        )
+        for user_id, request_text, block_card_id, resource_card_id, spread, cards, idempotency_key in requests:
+            cursor = conn.execute('''
+                INSERT OR IGNORE INTO requests (
+                    user_id, request_text, block_card_id, resource_card_id, spread, idempotency_key
+                ) VALUES (?, ?, ?, ?, ?, ?)
+            ''', (user_id, request_text, block_card_id, resource_card_id, spread, idempotency_key))
+            if not cursor.rowcount:
+                continue  # дубль по ключу идемпотентности
+            request_id = cursor.lastrowid
+            conn.executemany(
+                'INSERT INTO request_cards (request_id, position, card_id, role) VALUES (?, ?, ?, ?)',
+                [(request_id, position, card_id, role) for position, (card_id, role) in enumerate(cards)]
+            )
+        conn.executemany(
+            'INSERT OR REPLACE INTO draw_state (user_id, card_type, drawn, updated_at) VALUES (?, ?, ?, ?)',
+            [(user_id, card_type, drawn, updated_at)
+             for (user_id, card_type), (drawn, updated_at) in draw_states.items()]
+        )
+
+def failed_writes_path() -> str:
+    return f"{DB_PATH}.failed.jsonl"
+
+def _write_failed(operation, error) -> None:
+    # Отложенная операция — строка JSON: её можно разобрать и дописать в базу вручную
+    current_requests, requests, sessions, draw_states = operation
+    record = {
+        'at': time.time(),
+        'error': str(error),
+        'current_requests': list(current_requests.items()),
+        'requests': requests,
+        'sessions': list(sessions.items()),
+        'draw_states': [[list(key), row] for key, row in draw_states.items()],
+    }
+    with open(failed_writes_path(), 'a', encoding='utf-8') as f:
+        f.write(json.dumps(record, ensure_ascii=False, default=lambda value: value.hex()
+                           if isinstance(value, (bytes, bytearray)) else repr(value)) + '\n')
+
+class WriteBehindQueue:
+    """
+    Буфер мутаций users.current_request, requests, sessions и draw_state.
+
+    Повторные изменения current_request, сессии и мешка карт одного пользователя схлопываются
+    (в базу попадает только последнее значение), а всё накопленное
+    записывается одной транзакцией — один fsync на пачку вместо одного на запись.
+
+    Упавшая пачка повторяется до max_retries раз; дальше операции пишутся по
+    одной, а те, что не записываются и поодиночке, откладываются в
+    <база>.failed.jsonl — одна битая строка не блокирует остальные записи.
+    """
+
+    NOT_PENDING = object()
+
+    def __init__(self, max_ops: int = FLUSH_MAX_OPS, interval: float = FLUSH_INTERVAL,
+                 max_retries: int = FLUSH_MAX_RETRIES):
+        self.max_ops = max_ops
+        self.interval = interval
+        self.max_retries = max_retries
+        self._retries = 0
+        self._current_requests = {}  # user_id -> request_text | None
+        self._requests = []
+        self._sessions = {}  # user_id -> строка sessions | None (удаление)
+        self._flushing_sessions = {}  # пачка, которая пишется прямо сейчас
+        self._draw_states = {}  # (user_id, card_type) -> (drawn, updated_at)
+        self._flushing_draw_states = {}
+        self._pending = None
+        self._full = None
+        self._lock = None
+        self._task = None
+        # Счётчики
+        self.collapsed = 0
+        self.flushes = 0
+        self.flushed_ops = 0
+        self.failed_flushes = 0
+        self.set_aside = 0
+        self.last_flush_seconds = 0.0
+        self.max_flush_seconds = 0.0
+        self.total_flush_seconds = 0.0
+
+    @property
+    def depth(self) -> int:
+        return len(self._current_requests) + len(self._requests) + len(self._sessions) + len(self._draw_states)
+
+    def _ensure_started(self) -> None:
+        if self._task is None or self._task.done():
+            self._pending = asyncio.Event()
+            self._full = asyncio.Event()
+            self._lock = asyncio.Lock()
+            self._task = asyncio.create_task(self._flush_loop())
+
+    def _notify(self) -> None:
+        self._ensure_started()
+        self._pending.set()
+        if self.depth >= self.max_ops:
+            self._full.set()
+
+    def set_current_request(self, user_id, request_text) -> None:
+        if user_id in self._current_requests:
+            self.collapsed += 1
+        self._current_requests[user_id] = request_text
+        self._notify()
+
+    def add_request(self, row) -> None:
+        self._requests.append(row)
+        self._notify()
+
+    def set_session(self, user_id, row) -> None:
+        if user_id in self._sessions:
+            self.collapsed += 1
+        self._sessions[user_id] = row
+        self._notify()
+
+    def set_draw_state(self, user_id, card_type, row) -> None:
+        key = (user_id, card_type)
+        if key in self._draw_states:
+            self.collapsed += 1
+        self._draw_states[key] = row
+        self._notify()
+
+    def pending_draw_state(self, user_id, card_type):
+        key = (user_id, card_type)
+        if key in self._draw_states:
+            return self._draw_states[key]
+        return self._flushing_draw_states.get(key, self.NOT_PENDING)
+
+    def pending_session(self, user_id):
+        """Ещё не записанная строка сессии (None — удаление) или NOT_PENDING."""
+        if user_id in self._sessions:
+            return self._sessions[user_id]
+        return self._flushing_sessions.get(user_id, self.NOT_PENDING)
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await self._pending.wait()
+            try:
+                await asyncio.wait_for(self._full.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+
+    async def flush(self, isolate: bool = False) -> None:
+        """Записывает накопленное. isolate=True — сразу поштучно, без повтора пачки (при остановке)."""
+        if self._lock is None:
+            return
+        async with self._lock:
+            self._pending.clear()
+            self._full.clear()
+            if not self.depth:
+                return
+            current_requests, self._current_requests = self._current_requests, {}
+            requests, self._requests = self._requests, []
+            sessions, self._sessions = self._sessions, {}
+            draw_states, self._draw_states = self._draw_states, {}
+            self._flushing_sessions = sessions
+            self._flushing_draw_states = draw_states
+
+            started = time.monotonic()
+            try:
+                try:
+                    await _run(_apply_batch, current_requests, requests, sessions, draw_states)
+                    self._retries = 0
+                except sqlite3.Error as e:
+                    self.failed_flushes += 1
+                    self._retries += 1
+                    if not isolate and self._retries <= self.max_retries:
+                        # Возвращаем в очередь, не затирая более свежие значения
+                        logging.error(f"💥 Ошибка записи пачки в базу (попытка {self._retries}/{self.max_retries}): {e}")
+                        self._requeue(current_requests, requests, sessions, draw_states)
+                        return
+                    logging.error(f"💥 Пачка не записалась ({e}) — пишем операции по одной")
+                    self._retries = 0
+                    await self._apply_one_by_one(current_requests, requests, sessions, draw_states)
+            finally:
+                self._flushing_sessions = {}
+                self._flushing_draw_states = {}
+
+            elapsed = time.monotonic() - started
+            self.flushes += 1
+            self.flushed_ops += len(current_requests) + len(requests) + len(sessions) + len(draw_states)
+            self.last_flush_seconds = elapsed
+            self.max_flush_seconds = max(self.max_flush_seconds, elapsed)
+            self.total_flush_seconds += elapsed
+
+    def _requeue(self, current_requests, requests, sessions, draw_states) -> None:
+        for user_id, request_text in current_requests.items():
+            self._current_requests.setdefault(user_id, request_text)
+        self._requests[:0] = requests
+        for user_id, row in sessions.items():
+            self._sessions.setdefault(user_id, row)
+        for key, row in draw_states.items():
+            self._draw_states.setdefault(key, row)
+        self._pending.set()
+
+    async def _apply_one_by_one(self, current_requests, requests, sessions, draw_states) -> None:
+        operations = (
+            [({user_id: text}, [], {}, {}) for user_id, text in current_requests.items()]
+            + [({}, [row], {}, {}) for row in requests]
+            + [({}, [], {user_id: row}, {}) for user_id, row in sessions.items()]
+            + [({}, [], {}, {key: row}) for key, row in draw_states.items()]
+        )
+        for operation in operations:
+            try:
+                await _run(_apply_batch, *operation)
+            except sqlite3.Error as e:
+                self.set_aside += 1
+                logging.error(f"💥 Операция не записывается в базу и отложена в {failed_writes_path()}: {e}")
+                await asyncio.to_thread(_write_failed, operation, e)
+
+    async def stop(self) -> int:
+        """
+        Останавливает фоновый сброс и записывает всё, что осталось в очереди.
+        Возвращает число операций, которые не удалось записать (они в failed.jsonl).
+        """
+        if self._task is None:
+            return 0
+        # Под замком: не прерываем пачку, которая уже пишется
+        async with self._lock:
+            self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        set_aside = self.set_aside
+        await self.flush()
+        if self.depth:
+            # Повторять некогда: пишем остаток поштучно
+            await self.flush(isolate=True)
+        return self.set_aside - set_aside
+
+    def stats(self) -> dict:
+        return {
+            'depth': self.depth,
+            'collapsed': self.collapsed,
+            'flushes': self.flushes,
+            'flushed_ops': self.flushed_ops,
+            'failed_flushes': self.failed_flushes,
+            'set_aside': self.set_aside,
+            'last_flush_ms': round(self.last_flush_seconds * 1000, 2),
+            'max_flush_ms': round(self.max_flush_seconds * 1000, 2),
+            'avg_flush_ms': round(self.total_flush_seconds / self.flushes * 1000, 2) if self.flushes else 0.0,
+        }
+
+write_queue = WriteBehindQueue()
@@ -0,0 +1,207 @@
+"""
+Упакованная колода: метаданные, описания и картинки карт в одном файле.
+
+    python deck_bundle.py                    # собрать deck.bundle из cards.json
+    python deck_bundle.py --out other.bundle
+
+Формат: MAGIC | версия формата (u32) | длина индекса (u32) | индекс (JSON) | данные.
+В индексе у каждой карты — смещения и длины описания и картинки в файле.
+Бот открывает файл через mmap: картинки отдаются memoryview без копирования,
+описания декодируются только при обращении.
+"""
+import argparse
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+import time
+
+from catalog import Card, CardCatalog
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+BUNDLE_PATH = os.getenv("DECK_BUNDLE", os.path.join(BASE_DIR, "deck.bundle"))
+
+MAGIC = b"EMDECK\x00\x00"
+FORMAT_VERSION = 1
+HEADER = struct.Struct("<8sII")
+# Сигнатуры форматов картинок — для бандлов, собранных до появления image_ext в индексе
+IMAGE_SIGNATURES = ((b"\xff\xd8\xff", ".jpg"), (b"\x89PNG", ".png"), (b"RIFF", ".webp"))
+
+
+class BundleCard(Card):
+    """Карта из бандла: описание читается из mmap только при обращении."""
+
+    __slots__ = ('_bundle', '_description_span')
+
+    def __init__(self, bundle: 'DeckBundle', id: int, name: str, type: str, image_url: str, description_span):
+        self.id = id
+        self.name = name
+        self.type = type
+        self.image_url = image_url
+        self._bundle = bundle
+        self._description_span = description_span
+
+    @property
+    def description(self) -> str:
+        offset, length = self._description_span
+        return str(self._bundle.view(offset, length), 'utf-8')
+
+
+class DeckBundle:
+    def __init__(self, path: str = BUNDLE_PATH):
+        self.path = path
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.mtime = stat.st_mtime
+        self.size = stat.st_size
+        self._view = memoryview(self._mmap)
+
+        magic, version, index_length = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError(f"Неподдерживаемый формат колоды: {path}")
+        index = json.loads(str(self._view[HEADER.size:HEADER.size + index_length], 'utf-8'))
+
+        self.deck_version = index['deck_version']
+        self._images = {}  # card_id -> (offset, length)
+        self._image_hashes = {}  # card_id -> sha256 картинки
+        self._image_exts = {}  # card_id -> расширение формата картинки ('.jpg', '.png')
+        self.cards = []
+        for entry in index['cards']:
+            self.cards.append(BundleCard(
+                self, entry['id'], entry['name'], entry['type'], entry['image_url'], tuple(entry['description'])
+            ))
+            if entry.get('image'):
+                self._images[entry['id']] = tuple(entry['image'])
+                if entry.get('image_sha256'):
+                    self._image_hashes[entry['id']] = entry['image_sha256']
+                if entry.get('image_ext'):
+                    self._image_exts[entry['id']] = entry['image_ext']
+
+    def view(self, offset: int, length: int) -> memoryview:
+        return self._view[offset:offset + length]
+
+    def image(self, card_id: int) -> memoryview | None:
+        span = self._images.get(card_id)
+        return self.view(*span) if span else None
+
+    def image_sha256(self, card_id: int) -> str | None:
+        """Хэш картинки карты (в старых бандлах его нет в индексе — считаем один раз)."""
+        digest = self._image_hashes.get(card_id)
+        if digest is None and card_id in self._images:
+            digest = self._image_hashes[card_id] = hashlib.sha256(self.image(card_id)).hexdigest()
+        return digest
+
+    def image_ext(self, card_id: int) -> str | None:
+        """Расширение формата картинки карты (в старых бандлах его нет в индексе — смотрим сигнатуру)."""
+        ext = self._image_exts.get(card_id)
+        if ext is None and card_id in self._images:
+            head = bytes(self.image(card_id)[:4])
+            ext = self._image_exts[card_id] = next(
+                (ext for signature, ext in IMAGE_SIGNATURES if head.startswith(signature)), ".jpg"
+            )
+        return ext
+
+    def catalog(self) -> CardCatalog:
+        return CardCatalog(self.cards)
+
+    def changed_on_disk(self) -> bool:
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return False
+        return (stat.st_mtime, stat.st_size) != (self.mtime, self.size)
+
+
+def _read_image(image_url: str, card_id: int) -> tuple[bytes, str] | None:
+    # Предпочитаем сжатый вариант из assets/ (card_assets.py), иначе исходник из cards/;
+    # вместе с байтами — расширение их формата
+    from card_assets import CardAssets
+    assets = CardAssets()
+    data = assets.read(card_id)
+    if data:
+        return data, os.path.splitext(assets.variant(card_id)['path'])[1]
+    path = os.path.join(BASE_DIR, "cards", os.path.basename(image_url))
+    try:
+        with open(path, 'rb') as f:
+            return f.read(), os.path.splitext(path)[1].lower() or ".png"
+    except OSError:
+        return None
+
+
+def build(cards_json: str = os.path.join(BASE_DIR, "cards.json"), out: str = BUNDLE_PATH) -> str:
+    with open(cards_json, 'r', encoding='utf-8') as f:
+        cards = json.load(f)
+
+    blobs = []
+    entries = []
+    position = 0
+    digest = hashlib.sha256()
+
+    def _add(data: bytes) -> list:
+        nonlocal position
+        span = [position, len(data)]
+        blobs.append(data)
+        digest.update(data)
+        position += len(data)
+        return span
+
+    for card in cards:
+        entry = {
+            'id': card['id'],
+            'name': card['name'],
+            'type': card['type'],
+            'image_url': card['image_url'],
+            'description': _add(card['description'].encode('utf-8')),
+        }
+        image = _read_image(card['image_url'], card['id'])
+        if image:
+            data, ext = image
+            entry['image'] = _add(data)
+            entry['image_sha256'] = hashlib.sha256(data).hexdigest()
+            entry['image_ext'] = ext
+        else:
+            logging.warning(f"⚠️ Нет картинки для карты {card['id']}, в бандле будет только текст")
+        entries.append(entry)
+
+    deck_version = digest.hexdigest()[:16]
+
+    # Смещения в индексе — абсолютные, поэтому сначала считаем его длину
+    def _index(data_start: int) -> bytes:
+        shifted = [
+            dict(entry, **{key: [entry[key][0] + data_start, entry[key][1]]
+                           for key in ('description', 'image') if key in entry})
+            for entry in entries
+        ]
+        return json.dumps({'deck_version': deck_version, 'built_at': int(time.time()), 'cards': shifted},
+                          ensure_ascii=False).encode('utf-8')
+
+    index = _index(0)
+    while True:
+        data_start = HEADER.size + len(index)
+        shifted_index = _index(data_start)
+        if len(shifted_index) == len(index):
+            break
+        index = shifted_index
+    index = shifted_index
+
+    tmp_path = out + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(index)))
+        f.write(index)
+        for blob in blobs:
+            f.write(blob)
+    # Атомарная замена: уже открытые mmap продолжают видеть старую версию
+    os.replace(tmp_path, out)
+    logging.info(f"✅ Колода {deck_version}: {len(entries)} карт, {os.path.getsize(out) / 1024 / 1024:.1f} МБ → {out}")
+    return out
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Сборка упакованной колоды")
+    parser.add_argument("--out", default=BUNDLE_PATH, help="куда записать бандл")
+    args = parser.parse_args()
+    build(out=args.out)
@@ -0,0 +1,59 @@
+import os
+import time
+from collections import OrderedDict
+
+from aiogram import BaseMiddleware
+from aiogram.types import Update
+
+from metrics import registry
+
+# Окно, в котором повторная доставка апдейта считается дублем, и размер кэша
+DEDUP_TTL = int(os.getenv("DEDUP_TTL", 600))
+DEDUP_SIZE = int(os.getenv("DEDUP_SIZE", 10000))
+
+duplicate_updates = registry.counter('bot_duplicate_updates_total', 'Отброшенные повторные доставки апдейтов')
+
+
+class UpdateDeduplicator(BaseMiddleware):
+    """
+    Outer-middleware на update: повторно доставленный update_id отбрасывается
+    до фильтров, хендлеров и любого I/O.
+
+    Кэш — OrderedDict в порядке прихода, ограниченный по размеру и по времени:
+    старые записи вытесняются с головы, так что проверка стоит O(1).
+    Кэш у каждого процесса свой — записи в базу дополнительно защищены
+    ключами идемпотентности (см. save_request).
+    """
+
+    def __init__(self, ttl: float = DEDUP_TTL, max_size: int = DEDUP_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._seen = OrderedDict()  # update_id -> время прихода
+        self.suppressed = 0
+
+    def __len__(self):
+        return len(self._seen)
+
+    def seen(self, update_id: int, now: float | None = None) -> bool:
+        """Отмечает update_id; True, если он уже был в окне."""
+        now = time.monotonic() if now is None else now
+        while self._seen:
+            oldest_id, seen_at = next(iter(self._seen.items()))
+            if now - seen_at <= self.ttl and len(self._seen) < self.max_size:
+                break
+            del self._seen[oldest_id]
+
+        if update_id in self._seen:
+            return True
+        self._seen[update_id] = now
+        return False
+
+    async def __call__(self, handler, event: Update, data):
+        if self.seen(event.update_id):
+            self.suppressed += 1
+            duplicate_updates.inc()
+            return None
+        return await handler(event, data)
+
+    def stats(self) -> dict:
+        return {'tracked': len(self._seen), 'suppressed': self.suppressed}
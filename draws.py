@@ -0,0 +1,92 @@
+import asyncio
+import os
+import random
+from contextlib import asynccontextmanager
+
+from database import get_draw_state, save_draw_state
+
+# Фиксированное зерно делает вытягивание воспроизводимым (бенчмарк, отладка)
+DRAW_SEED = os.getenv("DRAW_SEED") or None
+# Сколько случайных попыток до перебора оставшихся карт
+REJECTION_TRIES = 16
+
+
+def make_rng(seed=DRAW_SEED) -> random.Random:
+    return random.Random(int(seed) if seed is not None and str(seed).isdigit() else seed)
+
+
+def _to_bits(blob: bytes | None) -> int:
+    return int.from_bytes(blob, 'little') if blob else 0
+
+
+def _to_blob(bits: int) -> bytes:
+    return bits.to_bytes((bits.bit_length() + 7) // 8, 'little')
+
+
+class DrawEngine:
+    """
+    Вытягивание карт «мешком»: пока пользователь не увидел все карты типа,
+    карты не повторяются, затем начинается новый круг.
+
+    Состояние — битсет id уже вытянутых карт на пару (пользователь, тип),
+    ~10 байт на колоду из 78 карт; хранится в draw_state через write-behind
+    очередь. Выбор — случайная карта с отбраковкой уже вытянутых: O(1) в среднем,
+    а когда невытянутых остаётся мало — перебор оставшихся.
+
+    Чтение битсета, выбор и запись идут под замком пары (пользователь, тип):
+    два одновременных апдейта одного пользователя иначе прочли бы один и тот же
+    битсет и могли вытянуть одну карту.
+    """
+
+    def __init__(self, rng: random.Random | None = None):
+        self.rng = rng or make_rng()
+        self._locks = {}  # (user_id, card_type) -> [Lock, сколько задач его держат или ждут]
+
+    @asynccontextmanager
+    async def _locked(self, key):
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    def _pick(self, pool: tuple, bits: int):
+        for _ in range(REJECTION_TRIES):
+            card = self.rng.choice(pool)
+            if not bits >> card.id & 1:
+                return card
+        remaining = [card for card in pool if not bits >> card.id & 1]
+        return self.rng.choice(remaining) if remaining else None
+
+    async def draw(self, user_id: int, card_type: str, pool, count: int = 1) -> list | None:
+        """count разных карт из pool без повторов относительно прошлых вытягиваний пользователя."""
+        pool = tuple(pool)
+        if len(pool) < count:
+            return None
+
+        async with self._locked((user_id, card_type)):
+            bits = _to_bits(await get_draw_state(user_id, card_type))
+            cards = []
+            for _ in range(count):
+                card = self._pick(pool, bits)
+                if card is None:
+                    # Колода пройдена — новый круг, но без карт, уже вытянутых в этот раз
+                    bits = 0
+                    for drawn in cards:
+                        bits |= 1 << drawn.id
+                    card = self._pick(pool, bits)
+                bits |= 1 << card.id
+                cards.append(card)
+
+            await save_draw_state(user_id, card_type, _to_blob(bits))
+        return cards
+
+    async def draw_one(self, user_id: int, card_type: str, pool):
+        cards = await self.draw(user_id, card_type, pool)
+        return cards[0] if cards else None
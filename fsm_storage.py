@@ -0,0 +1,69 @@
+import json
+import logging
+import os
+import time
+from typing import Any, Mapping
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, KeyBuilder, StateType, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+from database import get_fsm_state, get_fsm_data, set_fsm_state, set_fsm_data, purge_fsm
+from sessions import SHARED_SESSIONS
+
+# Сколько хранится брошенное состояние FSM (например, недописанный /number)
+FSM_TTL = int(os.getenv("FSM_TTL", 24 * 3600))
+PURGE_INTERVAL = 3600
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    Хранилище aiogram FSM в той же SQLite-базе, что и database.py.
+
+    Запись — upsert одной строки, устаревшие состояния не читаются и
+    периодически удаляются. Все процессы бота на одном хосте видят
+    одно и то же состояние.
+    """
+
+    def __init__(self, ttl: int = FSM_TTL, key_builder: KeyBuilder | None = None):
+        self.ttl = ttl
+        self.key_builder = key_builder or DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self._last_purge = 0.0
+
+    async def _maybe_purge(self, now: float) -> None:
+        if now - self._last_purge < PURGE_INTERVAL:
+            return
+        self._last_purge = now
+        removed = await purge_fsm(now - self.ttl)
+        if removed:
+            logging.info(f"🗑 Удалено устаревших FSM-состояний: {removed}")
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        now = time.time()
+        value = state.state if isinstance(state, State) else state
+        await set_fsm_state(self.key_builder.build(key), value, now)
+        await self._maybe_purge(now)
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        return await get_fsm_state(self.key_builder.build(key), time.time() - self.ttl)
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        value = json.dumps(dict(data), ensure_ascii=False) if data else None
+        await set_fsm_data(self.key_builder.build(key), value, time.time())
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        value = await get_fsm_data(self.key_builder.build(key), time.time() - self.ttl)
+        return json.loads(value) if value else {}
+
+    async def close(self) -> None:
+        # Соединение общее и закрывается в close_db()
+        pass
+
+
+def create_storage(shared: bool = SHARED_SESSIONS) -> BaseStorage:
+    """
+    FSM-хранилище по тому же правилу, что и SessionStore: в одном процессе —
+    память (FSM-middleware читает состояние на каждом апдейте, база тут лишняя),
+    в общем режиме — SQLite.
+    """
+    return SQLiteStorage() if shared else MemoryStorage()
@@ -0,0 +1,92 @@
+import asyncio
+import logging
+import os
+import random
+
+from aiohttp import ClientError, ClientSession, ClientTimeout, TCPConnector
+
+# Размер пула соединений и таймауты исходящих HTTP-запросов
+POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", 20))
+REQUEST_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", 15))
+CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", 5))
+RETRIES = int(os.getenv("HTTP_RETRIES", 3))
+BACKOFF_BASE = 0.5
+
+# Статусы, при которых имеет смысл повторить запрос
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class HttpResponse:
+    __slots__ = ('status', 'headers', 'body')
+
+    def __init__(self, status: int, headers, body: bytes):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    def text(self) -> str:
+        return self.body.decode('utf-8', errors='replace')
+
+
+class HttpClient:
+    """
+    Общий на весь процесс HTTP-клиент.
+
+    Одна ClientSession с ограниченным пулом keep-alive соединений, таймауты,
+    повторы с джиттером и single-flight: параллельные запросы одного и того же
+    URL ждут одну общую загрузку вместо того, чтобы качать её N раз.
+    """
+
+    def __init__(self, pool_size: int = POOL_SIZE, retries: int = RETRIES):
+        self.pool_size = pool_size
+        self.retries = retries
+        self._session: ClientSession | None = None
+        self._inflight = {}
+
+    def _get_session(self) -> ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = ClientSession(
+                connector=TCPConnector(limit=self.pool_size, limit_per_host=self.pool_size, keepalive_timeout=60),
+                timeout=ClientTimeout(total=REQUEST_TIMEOUT, sock_connect=CONNECT_TIMEOUT),
+            )
+        return self._session
+
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def _get_with_retries(self, url: str, headers: dict | None) -> HttpResponse:
+        session = self._get_session()
+        for attempt in range(self.retries + 1):
+            last_attempt = attempt == self.retries
+            try:
+                async with session.get(url, headers=headers) as resp:
+                    body = await resp.read()
+                    response = HttpResponse(resp.status, resp.headers, body)
+                if response.status not in RETRY_STATUSES or last_attempt:
+                    return response
+                logging.warning(f"⚠️ HTTP {response.status} для {url}, повтор {attempt + 1}/{self.retries}")
+            except (ClientError, asyncio.TimeoutError) as e:
+                if last_attempt:
+                    raise
+                logging.warning(f"⚠️ Сетевая ошибка для {url}: {e!r}, повтор {attempt + 1}/{self.retries}")
+            # Экспоненциальная задержка с полным джиттером
+            await asyncio.sleep(random.uniform(0, BACKOFF_BASE * 2 ** attempt))
+
+    async def get(self, url: str, headers: dict | None = None) -> HttpResponse:
+        """GET с повторами; одинаковые параллельные запросы сливаются в один."""
+        key = (url, tuple(sorted((headers or {}).items())))
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._get_with_retries(url, headers))
+            self._inflight[key] = task
+
+            def _done(t):
+                self._inflight.pop(key, None)
+                if not t.cancelled():
+                    t.exception()  # исключение заберут ожидающие; здесь — чтобы не было warning
+
+            task.add_done_callback(_done)
+        # shield: отмена одного ожидающего не отменяет общую загрузку для остальных
+        return await asyncio.shield(task)
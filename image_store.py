@@ -0,0 +1,223 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+
+from http_client import HttpClient
+from metrics import github_fetch_seconds
+
+BASE_DIR = os.path.dirname(__file__)
+
+# Локальное зеркало картинок карт (переживает перезапуск, если директория на диске)
+CACHE_DIR = os.getenv("IMAGE_CACHE_DIR", os.path.join(BASE_DIR, "image_cache"))
+# Картинки, лежащие в репозитории — запасной вариант, если GitHub недоступен
+BUNDLED_DIR = os.path.join(BASE_DIR, "cards")
+# Как часто (в секундах) перепроверять закэшированную картинку через ETag
+REVALIDATE_SECONDS = int(os.getenv("IMAGE_REVALIDATE_SECONDS", 3600))
+PREFETCH_CONCURRENCY = 8
+# Индекс пишется на диск не на каждый ответ GitHub, а пачкой — не чаще раза в столько секунд
+INDEX_SAVE_DELAY = float(os.getenv("IMAGE_INDEX_SAVE_DELAY", 5))
+
+INDEX_FILE = "index.json"
+
+
+class ImageStore:
+    """
+    Локальное хранилище картинок карт.
+
+    Отдаёт картинку с диска (зеркало в CACHE_DIR или файлы из cards/),
+    а свежесть проверяет в фоне условным запросом If-None-Match.
+    В сеть пользовательский запрос идёт, только если локальной копии нет совсем.
+    Чтение и запись файлов идут в потоке (asyncio.to_thread), а индекс
+    сохраняется пачкой через INDEX_SAVE_DELAY после первого изменения.
+    """
+
+    def __init__(self, http_client: HttpClient, cache_dir: str = CACHE_DIR, bundled_dir: str = BUNDLED_DIR,
+                 revalidate_seconds: int = REVALIDATE_SECONDS):
+        self.http_client = http_client
+        self.cache_dir = cache_dir
+        self.bundled_dir = bundled_dir
+        self.revalidate_seconds = revalidate_seconds
+        self._index = {}  # image_url -> {'file': ..., 'etag': ..., 'checked_at': ...}
+        self._background = set()
+        self._revalidating = set()
+        # image_url -> время последней фоновой проверки, в том числе неудачной и для картинок,
+        # которые отдаются только из cards/ и в индекс ещё не попали
+        self._checked_at = {}
+        self._index_save = None  # задача отложенного сохранения индекса
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._load_index()
+
+    # ========================
+    # 🔹 ЛОКАЛЬНЫЕ ФАЙЛЫ
+    # ========================
+
+    def _load_index(self) -> None:
+        path = os.path.join(self.cache_dir, INDEX_FILE)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                self._index = json.load(f)
+        except FileNotFoundError:
+            self._index = {}
+        except (OSError, ValueError) as e:
+            logging.warning(f"⚠️ Не удалось прочитать индекс кэша картинок: {e}")
+            self._index = {}
+
+    def _save_index(self, index: dict) -> None:
+        path = os.path.join(self.cache_dir, INDEX_FILE)
+        # Записи, которые тем временем сохранил другой процесс, не теряем: берём более свежую
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                on_disk = json.load(f)
+        except (OSError, ValueError):
+            on_disk = {}
+        for url, entry in index.items():
+            if entry.get('checked_at', 0) >= on_disk.get(url, {}).get('checked_at', 0):
+                on_disk[url] = entry
+        # Свой временный файл у каждого процесса: os.replace атомарен, чужую запись не испортим
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(on_disk, f)
+        os.replace(tmp_path, path)
+
+    def _index_changed(self) -> None:
+        if self._index_save is None:
+            self._index_save = asyncio.create_task(self._save_index_later())
+
+    async def _save_index_later(self) -> None:
+        try:
+            await asyncio.sleep(INDEX_SAVE_DELAY)
+        finally:
+            # Сохраняем и при отмене (close): копия снимается в loop, пишется в потоке
+            self._index_save = None
+            snapshot = {url: dict(entry) for url, entry in self._index.items()}
+            try:
+                await asyncio.to_thread(self._save_index, snapshot)
+            except OSError as e:
+                logging.warning(f"⚠️ Не удалось сохранить индекс кэша картинок: {e}")
+
+    async def close(self) -> None:
+        """Сохраняет индекс, если есть несохранённые изменения."""
+        task = self._index_save
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+    def _cache_path(self, image_url: str) -> str:
+        name = hashlib.sha1(image_url.encode('utf-8')).hexdigest()
+        ext = os.path.splitext(image_url)[1] or ".img"
+        return os.path.join(self.cache_dir, name + ext)
+
+    def _bundled_path(self, image_url: str) -> str:
+        return os.path.join(self.bundled_dir, os.path.basename(image_url))
+
+    @staticmethod
+    def _read_file(path: str) -> bytes | None:
+        try:
+            with open(path, 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    @staticmethod
+    def _write_file(path: str, data: bytes) -> None:
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    async def _store(self, image_url: str, data: bytes, etag: str | None) -> None:
+        path = self._cache_path(image_url)
+        await asyncio.to_thread(self._write_file, path, data)
+        self._index[image_url] = {'file': os.path.basename(path), 'etag': etag, 'checked_at': time.time()}
+        self._index_changed()
+
+    def _local(self, image_url: str) -> bytes | None:
+        if image_url in self._index:
+            data = self._read_file(self._cache_path(image_url))
+            if data:
+                return data
+        return self._read_file(self._bundled_path(image_url))
+
+    async def get_local(self, image_url: str) -> bytes | None:
+        """Картинка из зеркала, а если её там нет — из cards/ репозитория (чтение в потоке)."""
+        return await asyncio.to_thread(self._local, image_url)
+
+    # ========================
+    # 🔹 СЕТЬ
+    # ========================
+
+    async def fetch(self, image_url: str) -> bytes | None:
+        """
+        Условный запрос к GitHub. Возвращает актуальные байты картинки
+        (из сети или, при 304, из зеркала) или None, если сеть недоступна.
+        """
+        headers = {}
+        entry = self._index.get(image_url)
+        if entry and entry.get('etag') and os.path.exists(self._cache_path(image_url)):
+            headers['If-None-Match'] = entry['etag']
+
+        started = time.perf_counter()
+        try:
+            resp = await self.http_client.get(image_url, headers=headers)
+        except Exception as e:
+            github_fetch_seconds.observe(time.perf_counter() - started, status='error')
+            logging.error(f"💥 Ошибка загрузки изображения: {e!r}")
+            return None
+        github_fetch_seconds.observe(time.perf_counter() - started, status=str(resp.status))
+
+        if resp.status == 304 and 'If-None-Match' in headers:
+            entry['checked_at'] = time.time()
+            self._index_changed()
+            return await asyncio.to_thread(self._read_file, self._cache_path(image_url))
+        if resp.status == 200:
+            await self._store(image_url, resp.body, resp.headers.get('ETag'))
+            return resp.body
+        logging.error(f"❌ HTTP {resp.status} при загрузке изображения: {image_url} — {resp.text()}")
+        return None
+
+    def _revalidate_in_background(self, image_url: str) -> None:
+        if image_url in self._revalidating:
+            return
+        entry = self._index.get(image_url)
+        checked_at = max(entry.get('checked_at', 0) if entry else 0, self._checked_at.get(image_url, 0))
+        if time.time() - checked_at < self.revalidate_seconds:
+            return
+
+        self._checked_at[image_url] = time.time()
+        self._revalidating.add(image_url)
+        task = asyncio.create_task(self.fetch(image_url))
+        self._background.add(task)
+
+        def _done(t):
+            self._background.discard(t)
+            self._revalidating.discard(image_url)
+
+        task.add_done_callback(_done)
+
+    async def get(self, image_url: str) -> bytes | None:
+        """Отдаёт локальную копию сразу; сеть — только если копии нет вообще."""
+        data = await self.get_local(image_url)
+        if data:
+            self._revalidate_in_background(image_url)
+            return data
+        return await self.fetch(image_url)
+
+    async def prefetch(self, image_urls) -> None:
+        """Зеркалирует всю колоду (например, при старте бота)."""
+        semaphore = asyncio.Semaphore(PREFETCH_CONCURRENCY)
+
+        async def _one(url):
+            async with semaphore:
+                entry = self._index.get(url)
+                if entry and time.time() - entry.get('checked_at', 0) < self.revalidate_seconds:
+                    return True
+                return await self.fetch(url) is not None
+
+        started = time.monotonic()
+        results = await asyncio.gather(*(_one(url) for url in set(image_urls)))
+        logging.info(
+            f"✅ Предзагрузка картинок: {sum(results)}/{len(results)} за {time.monotonic() - started:.1f} с"
+        )
@@ -0,0 +1,126 @@
+import asyncio
+import logging
+import os
+import time
+
+from aiogram import BaseMiddleware
+
+from metrics import registry
+
+# Сколько ждать завершения начатой работы после SIGTERM (Render даёт ~30 с)
+DRAIN_TIMEOUT = float(os.getenv("DRAIN_TIMEOUT", 25))
+# Сколько при старте ждать прогрева картинок, прежде чем принимать апдейты
+PREWARM_TIMEOUT = float(os.getenv("PREWARM_TIMEOUT", 10))
+DRAIN_POLL_INTERVAL = 0.05
+
+# Момент импорта ≈ старт процесса: от него считаются времена готовности
+PROCESS_STARTED_AT = time.monotonic()
+
+STARTING = 'starting'
+READY = 'ready'
+DRAINING = 'draining'
+STOPPED = 'stopped'
+
+
+class Lifecycle(BaseMiddleware):
+    """
+    Жизненный цикл процесса бота: старт → готов → слив → остановлен.
+
+    Как outer-middleware на update считает апдейты, которые сейчас в обработке.
+    При остановке (drain) ждёт, пока закончится уже принятая работа — очередь
+    вебхука, хендлеры, сценарии с паузами, — но не дольше DRAIN_TIMEOUT.
+    Отложенные сообщения планировщика и сессии лежат в базе и переживают
+    перезапуск, поэтому их ждать не нужно — достаточно сбросить очередь записи.
+    Замеряет время до первого успешного /health и до первого вытянутого расклада.
+    """
+
+    def __init__(self, drain_timeout: float = DRAIN_TIMEOUT, started_at: float = PROCESS_STARTED_AT):
+        self.drain_timeout = drain_timeout
+        self.started_at = started_at
+        self.state = STARTING
+        self.in_flight = 0
+        self.ready_at = None
+        self.healthy_at = None
+        self.first_draw_at = None
+        self.abandoned = 0
+        self._drain_task = None
+
+    def _since_start(self, moment: float | None) -> float | None:
+        return round(moment - self.started_at, 3) if moment is not None else None
+
+    def mark_ready(self) -> None:
+        if self.state != STARTING:
+            return
+        self.state = READY
+        self.ready_at = time.monotonic()
+        logging.info(f"🚀 Бот готов через {self._since_start(self.ready_at)} с после старта")
+
+    def mark_healthy(self) -> None:
+        if self.healthy_at is None:
+            self.healthy_at = time.monotonic()
+            logging.info(f"💚 Первый успешный /health через {self._since_start(self.healthy_at)} с после старта")
+
+    def mark_draw(self) -> None:
+        if self.first_draw_at is None:
+            self.first_draw_at = time.monotonic()
+            logging.info(f"🃏 Первый расклад через {self._since_start(self.first_draw_at)} с после старта")
+
+    @property
+    def accepting(self) -> bool:
+        return self.state == READY
+
+    async def __call__(self, handler, event, data):
+        self.in_flight += 1
+        try:
+            return await handler(event, data)
+        finally:
+            self.in_flight -= 1
+
+    async def drain(self, *pending) -> None:
+        """
+        Останавливает приём и ждёт завершения работы. pending — функции,
+        возвращающие объём ещё не сделанной работы (глубина очереди, активные сценарии).
+        Повторный вызов ждёт уже идущий слив.
+        """
+        if self._drain_task is None:
+            self._drain_task = asyncio.create_task(self._drain(pending))
+        await asyncio.shield(self._drain_task)
+
+    async def _drain(self, pending) -> None:
+        self.state = DRAINING
+        started = time.monotonic()
+        deadline = started + self.drain_timeout
+        logging.info(f"🛑 Остановка: дожидаемся начатой работы (до {self.drain_timeout:g} с)")
+
+        def outstanding() -> int:
+            return self.in_flight + sum(fn() for fn in pending)
+
+        while outstanding() and time.monotonic() < deadline:
+            await asyncio.sleep(DRAIN_POLL_INTERVAL)
+
+        self.abandoned = outstanding()
+        if self.abandoned:
+            logging.warning(f"⚠️ Не дождались {self.abandoned} задач за {self.drain_timeout:g} с — прерываем")
+        else:
+            logging.info(f"✅ Вся работа завершена за {time.monotonic() - started:.1f} с")
+        self.state = STOPPED
+
+    def stats(self) -> dict:
+        return {
+            'state': self.state,
+            'uptime_s': round(time.monotonic() - self.started_at, 1),
+            'in_flight': self.in_flight,
+            'time_to_ready_s': self._since_start(self.ready_at),
+            'time_to_first_healthy_s': self._since_start(self.healthy_at),
+            'time_to_first_draw_s': self._since_start(self.first_draw_at),
+            'abandoned_on_drain': self.abandoned,
+        }
+
+    def register_gauges(self) -> None:
+        registry.gauge('bot_time_to_ready_seconds', 'От старта процесса до готовности',
+                       lambda: self._since_start(self.ready_at))
+        registry.gauge('bot_time_to_first_healthy_seconds', 'От старта процесса до первого успешного /health',
+                       lambda: self._since_start(self.healthy_at))
+        registry.gauge('bot_time_to_first_draw_seconds', 'От старта процесса до первого расклада',
+                       lambda: self._since_start(self.first_draw_at))
+        registry.gauge('bot_updates_in_flight', 'Апдейты в обработке', lambda: self.in_flight)
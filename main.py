@@ -1,27 +1,51 @@
 import asyncio
 import json
 import logging
+import multiprocessing
 import os
-import random
 import sys
-from datetime import datetime
+import time
 
 from aiogram import Bot, Dispatcher, Router
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
-from aiogram.filters import CommandStart, Command
+from aiogram.filters import CommandStart, Command, CommandObject
 from aiogram.types import (
-    Message, CallbackQuery, BufferedInputFile,
-    InlineKeyboardMarkup, InlineKeyboardButton, WebAppInfo
+    Message, CallbackQuery, InlineQuery,
+    InlineKeyboardMarkup, InlineKeyboardButton, WebAppInfo,
+    InlineQueryResultArticle, InlineQueryResultCachedPhoto, InputTextMessageContent
 )
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
-from aiohttp import web, ClientSession
+from aiohttp import web
 from dotenv import load_dotenv
-from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiogram.webhook.aiohttp_server import setup_application
 
-from database import init_db, add_or_update_user, get_user, save_request, update_current_request, clear_current_request
+from database import (
+    init_db, close_db, prewarm_db, add_or_update_user, get_user, save_request, update_current_request,
+    clear_current_request, write_queue
+)
+from card_media import CardMediaCache
+from catalog import CardCatalog
+from card_search import CardSearch, MAX_RESULTS
+from spreads import SpreadEngine, SPREADS
+from draws import DrawEngine
+from sessions import Session, SessionStore
+from scheduler import JobScheduler
+from scripts import ScriptEngine, Step
+from webhook import QueuedRequestHandler, owner_of
+from outbound import OutboundScheduler, GLOBAL_RATE
+from dedup import UpdateDeduplicator
+from lifecycle import Lifecycle, PREWARM_TIMEOUT
+from fsm_storage import create_storage
+from http_client import HttpClient
+from image_store import ImageStore
+from card_assets import CardAssets
+from deck_bundle import DeckBundle, BUNDLE_PATH
+import metrics
+import profiling
+from reporting import create_admin_router
 
 # Загрузка переменных окружения
 load_dotenv()
@@ -34,30 +58,145 @@ if not BOT_TOKEN:
 MINI_APP_URL = "https://jxmm.github.io/elina-miniapp/"
 
 # Глобальное состояние
-user_states = {}
+sessions = SessionStore()
+draws = DrawEngine()
+scheduler = JobScheduler()
+scripts = ScriptEngine()
+outbound = OutboundScheduler()
+deduplicator = UpdateDeduplicator()
+lifecycle = Lifecycle()
+
+# Задержки отложенных сообщений (секунды)
+FOLLOWUP_DELAY = 300
+FINAL_MESSAGE_DELAY = 180
+background_tasks = set()
+http_client = HttpClient()
+image_store = ImageStore(http_client)
+card_assets = CardAssets()
+deck_bundle: DeckBundle | None = None
+
+# Как часто проверять, не собрали ли новую версию deck.bundle (секунды)
+DECK_RELOAD_INTERVAL = int(os.getenv("DECK_RELOAD_INTERVAL", 30))
 
 class CardNumber(StatesGroup):
     waiting_for_number = State()
 
+# ========================
+# 🔹 СЦЕНАРИИ С ПАУЗАМИ
+# ========================
+
+GREETING_SCRIPT = (
+    Step(2, "Перед началом работы c картами сделай, пожалуйста, несколько глубоких вдохов и успокой свои мысли. 😌 \n\n "),
+    Step(5, "Готова? ✨", keyboard=InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="Да ❤️", callback_data="ready_yes")]
+    ])),
+)
+
+BLOCK_SCRIPT = (
+    Step(2, "Что ты тут видишь?"),
+    Step(10, "О чем карта говорит, что напоминает?"),
+    Step(10, "Какое чувство она вызывает? Какими событиями вызвано это чувство?"),
+    Step(15, "Все ли тебе понятно или нужны подсказки? ❤️", keyboard=lambda ctx: InlineKeyboardMarkup(inline_keyboard=[
+        [
+            InlineKeyboardButton(text="Подсказки ✨", callback_data=f"desc_block:{ctx['block_card_id']}"),
+            InlineKeyboardButton(text="Хочу ресурс 💫", callback_data="show_resource")
+        ]
+    ])),
+)
+
+RESOURCE_QUESTIONS = (
+    Step(2, "А что ты видишь тут?"),
+    Step(10, "Понимаешь ли ты, о чем говорит тебе эта карта?"),
+    Step(10, "Что тебе нужно сделать, чтобы это помогло с решением твоего запроса?"),
+    Step(10, "Если нужны подсказки, они тут ❤️", keyboard=lambda ctx: InlineKeyboardMarkup(inline_keyboard=[
+        [
+            InlineKeyboardButton(text="Подсказки ✨", callback_data=f"desc_resource:{ctx['resource_card_id']}"),
+            InlineKeyboardButton(text="Все понятно ☺️", callback_data="resource_understood")
+        ]
+    ])),
+)
+
 async def download_github_image(image_url: str) -> bytes | None:
     if "raw.githubusercontent.com" not in image_url:
         logging.error(f"❌ Неподдерживаемый URL: {image_url}")
         return None
 
-    try:
-        async with ClientSession() as session:
-            async with session.get(image_url) as resp:
-                if resp.status == 200:
-                    return await resp.read()
-                else:
-                    error_text = await resp.text()
-                    logging.error(f"❌ HTTP {resp.status} при загрузке изображения: {image_url} — {error_text}")
-                    return None
-    except Exception as e:
-        logging.error(f"💥 Ошибка загрузки изображения: {e}")
+    # Локальное зеркало отвечает сразу, GitHub перепроверяется в фоне
+    started = time.perf_counter()
+    data = await image_store.get(image_url)
+    metrics.image_download_seconds.observe(time.perf_counter() - started, source='store' if data else 'missing')
+    if data:
+        metrics.image_download_bytes.observe(len(data))
+    return data
+
+async def load_card_image(card) -> bytes | memoryview | None:
+    # Картинка из mmap колоды, затем сжатый вариант из assets/, иначе — оригинал
+    if deck_bundle is not None:
+        image = deck_bundle.image(card.id)
+        if image is not None:
+            return image
+    return card_assets.read(card.id) or await download_github_image(card.image_url)
+
+def card_image_hash(card) -> str | None:
+    # Хэш той же картинки, что отдаст load_card_image; у оригинала с GitHub его нет
+    if deck_bundle is not None:
+        digest = deck_bundle.image_sha256(card.id)
+        if digest is not None:
+            return digest
+    variant = card_assets.variant(card.id)
+    return variant['sha256'] if variant else None
+
+def card_image_filename(card) -> str:
+    # Расширение того формата, который отдаст load_card_image: в колоде бывает и исходный PNG
+    if deck_bundle is not None and deck_bundle.image(card.id) is not None:
+        return f"{card.id}{deck_bundle.image_ext(card.id)}"
+    variant = card_assets.variant(card.id)
+    if variant is not None:
+        return f"{card.id}{os.path.splitext(variant['path'])[1]}"
+    return f"{card.id}{os.path.splitext(card.image_url)[1] or '.png'}"
+
+def thumbnail_url(card) -> str | None:
+    # Превью для инлайн-результатов отдаёт сам бот (/thumbs/<id>.jpg) — только в режиме вебхука
+    external_url = os.getenv("RENDER_EXTERNAL_URL")
+    if not external_url or card_assets.variant(card.id, 'thumb') is None:
         return None
-
-def create_router(cards):
+    return f"{external_url}/thumbs/{card.id}.jpg"
+
+async def thumb_handler(request: web.Request) -> web.Response:
+    data = await asyncio.to_thread(card_assets.read, int(request.match_info['card_id']), 'thumb')
+    if data is None:
+        raise web.HTTPNotFound()
+    return web.Response(body=data, content_type='image/jpeg', headers={'Cache-Control': 'public, max-age=86400'})
+
+def load_catalog() -> CardCatalog:
+    global deck_bundle
+    if os.path.exists(BUNDLE_PATH):
+        deck_bundle = DeckBundle(BUNDLE_PATH)
+        logging.info(f"📦 Колода из {BUNDLE_PATH}, версия {deck_bundle.deck_version}")
+        return deck_bundle.catalog()
+    return CardCatalog.from_json('cards.json')
+
+async def watch_deck_bundle(catalog: CardCatalog, media: CardMediaCache) -> None:
+    """Горячая замена колоды: подхватывает пересобранный deck.bundle без перезапуска."""
+    global deck_bundle
+    while True:
+        await asyncio.sleep(DECK_RELOAD_INTERVAL)
+        if deck_bundle is not None and not deck_bundle.changed_on_disk():
+            continue
+        if deck_bundle is None and not os.path.exists(BUNDLE_PATH):
+            continue
+        try:
+            new_bundle = DeckBundle(BUNDLE_PATH)
+        except (OSError, ValueError) as e:
+            logging.error(f"💥 Не удалось открыть новую колоду: {e}")
+            continue
+        # Старый mmap закроется сам, когда на него не останется ссылок
+        catalog.swap(new_bundle.catalog())
+        deck_bundle = new_bundle
+        await media.load(catalog)
+        logging.info(f"🔄 Колода обновлена до версии {new_bundle.deck_version}")
+
+def create_router(catalog: CardCatalog, media: CardMediaCache):
     router = Router()
 
     # ========================
@@ -69,34 +208,29 @@ def create_router(cards):
         user_id = message.from_user.id
         first_name = message.from_user.first_name
 
-        existing_user = get_user(user_id)
+        existing_user = await get_user(user_id)
         if existing_user:
             greeting = "Дорогая...\n\nРада видеть тебя снова! 🌿"
         else:
-            add_or_update_user(user_id, first_name)
+            await add_or_update_user(user_id, first_name)
             greeting = f"Дорогая, {first_name}...\n\nПривет! 🌿"
 
         await message.answer(greeting)
-        await asyncio.sleep(2)
-
-        await message.answer("Перед началом работы c картами сделай, пожалуйста, несколько глубоких вдохов и успокой свои мысли. 😌 \n\n ")
-        await asyncio.sleep(5)
-
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="Да ❤️", callback_data="ready_yes")]
-        ])
-        await message.answer("Готова? ✨", reply_markup=keyboard)
+        scripts.start(message.bot, message.chat.id, GREETING_SCRIPT)
 
     @router.callback_query(lambda c: c.data == "ready_yes")
     async def ready_yes_handler(callback: CallbackQuery) -> None:
         await callback.answer()
         user_id = callback.from_user.id
 
+        scripts.cancel(user_id)
         text = "Cейчас подумай... и напиши мне свой запрос, над которым хочешь поработать сегодня...✨"
         await callback.message.answer(text, parse_mode=ParseMode.HTML)
 
-        user_states[user_id] = {'step': 'waiting_for_request'}
-        clear_current_request(user_id)
+        await sessions.save(Session(user_id, step='waiting_for_request'))
+        await clear_current_request(user_id)
+        # Новый расклад — старые отложенные сообщения больше не нужны
+        await scheduler.cancel(user_id, 'followup', 'final_message')
 
     @router.message(Command("aboutme"))
     async def cards_miniapp_handler(message: Message) -> None:
@@ -111,80 +245,168 @@ def create_router(cards):
     @router.message(Command("block"))
     async def block_command(message: Message) -> None:
         logging.info("🔍 /block: запущена")
-        cards_block = [c for c in cards if c['type'] == 'block']
-        logging.info(f"Найдено блок-карт: {len(cards_block)}")
-        if not cards_block:
+        card = await draws.draw_one(message.from_user.id, 'block', catalog.of_type('block'))
+        if not card:
             await message.answer("❌ Карты типа 'block' не найдены в базе.")
             return
-        card = random.choice(cards_block)
-        logging.info(f"Выбрана карта: ID={card['id']}, URL={card['image_url']}")
-        img = await download_github_image(card['image_url'])
-        if not img:
-            await message.answer(f"💥 Не удалось загрузить изображение для карты '{card['name']}'.")
-            logging.error(f"Ошибка загрузки: {card['image_url']}")
-            return
+        logging.info(f"Выбрана карта: ID={card.id}, URL={card.image_url}")
         kb = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="Описание", callback_data=f"desc_block:{card['id']}")]
+            [InlineKeyboardButton(text="Описание", callback_data=f"desc_block:{card.id}")]
         ])
-        await message.answer_photo(photo=BufferedInputFile(img, filename=f"{card['id']}.png"), reply_markup=kb)
+        sent = await media.send_photo(message.bot, message.chat.id, card, reply_markup=kb)
+        if not sent:
+            await message.answer(f"💥 Не удалось загрузить изображение для карты '{card.name}'.")
+            logging.error(f"Ошибка загрузки: {card.image_url}")
 
     @router.message(Command("resource"))
     async def resource_command(message: Message) -> None:
         logging.info("🔍 /resource: запущена")
-        cards_res = [c for c in cards if c['type'] == 'resource']
-        logging.info(f"Найдено ресурс-карт: {len(cards_res)}")
-        if not cards_res:
+        card = await draws.draw_one(message.from_user.id, 'resource', catalog.of_type('resource'))
+        if not card:
             await message.answer("❌ Карты типа 'resource' не найдены в базе.")
             return
-        card = random.choice(cards_res)
-        logging.info(f"Выбрана карта: ID={card['id']}, URL={card['image_url']}")
-        img = await download_github_image(card['image_url'])
-        if not img:
-            await message.answer(f"💥 Не удалось загрузить изображение для карты '{card['name']}'.")
-            logging.error(f"Ошибка загрузки: {card['image_url']}")
-            return
+        logging.info(f"Выбрана карта: ID={card.id}, URL={card.image_url}")
         kb = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="Описание", callback_data=f"desc_resource:{card['id']}")]
+            [InlineKeyboardButton(text="Описание", callback_data=f"desc_resource:{card.id}")]
         ])
-        await message.answer_photo(photo=BufferedInputFile(img, filename=f"{card['id']}.png"), reply_markup=kb)
+        sent = await media.send_photo(message.bot, message.chat.id, card, reply_markup=kb)
+        if not sent:
+            await message.answer(f"💥 Не удалось загрузить изображение для карты '{card.name}'.")
+            logging.error(f"Ошибка загрузки: {card.image_url}")
 
     @router.message(Command("number"))
     async def number_command(message: Message, state: FSMContext) -> None:
-        await message.answer("Введите номер карты (от 1 до 76):")
+        await message.answer(f"Введите номер карты (от {catalog.min_id} до {catalog.max_id}):")
         await state.set_state(CardNumber.waiting_for_number)
 
     @router.message(CardNumber.waiting_for_number)
     async def number_input_handler(message: Message, state: FSMContext) -> None:
         try:
             card_id = int(message.text.strip())
-            if not (1 <= card_id <= 76):
-                await message.answer("Введите число от 1 до 76.")
+            if not (catalog.min_id <= card_id <= catalog.max_id):
+                await message.answer(f"Введите число от {catalog.min_id} до {catalog.max_id}.")
                 return
         except ValueError:
             await message.answer("Пожалуйста, введите число!")
             return
 
-        card = next((c for c in cards if c['id'] == card_id), None)
+        card = catalog.get(card_id)
         if not card:
             await message.answer("Карта с таким номером не найдена.")
             await state.clear()
             return
 
-        img = await download_github_image(card['image_url'])
-        if not img:
+        card_type = card.type if card.type in ('block', 'resource') else 'block'
+        kb = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="Описание", callback_data=f"desc_{card_type}:{card.id}")]
+        ])
+        sent = await media.send_photo(message.bot, message.chat.id, card, reply_markup=kb)
+        if not sent:
             await message.answer(f"Не удалось загрузить изображение для карты ID {card_id}.")
-            await state.clear()
-            return
+        await state.clear()
 
-        card_type = card['type'] if card['type'] in ('block', 'resource') else 'block'
+    # ========================
+    # 🔹 РАСКЛАДЫ
+    # ========================
+
+    spread_engine = SpreadEngine(catalog, media, draws)
+
+    @router.message(Command("spread"))
+    async def spread_command(message: Message) -> None:
         kb = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="Описание", callback_data=f"desc_{card_type}:{card['id']}")]
+            [InlineKeyboardButton(text=f"{spread.title} ({len(spread.positions)})", callback_data=f"spread:{key}")]
+            for key, spread in SPREADS.items()
         ])
-        await message.answer_photo(
-            photo=BufferedInputFile(img, filename=f"{card['id']}.png"),
-            reply_markup=kb
+        await message.answer("Выбери расклад ✨", reply_markup=kb)
+
+    @router.callback_query(lambda c: c.data.startswith("spread:"))
+    async def spread_callback(callback: CallbackQuery) -> None:
+        await callback.answer()
+        spread = SPREADS.get(callback.data.split(":", 1)[1])
+        if not spread:
+            await callback.message.answer("Такого расклада нет.")
+            return
+
+        user_id = callback.from_user.id
+        session = await sessions.get(user_id)
+        cards = await spread_engine.deal(
+            callback.bot, callback.message.chat.id, user_id, spread,
+            request_text=session.request_text if session else None,
+            idempotency_key=f"cb:{callback.id}"
         )
-        await state.clear()
+        if not cards:
+            await callback.message.answer("Не удалось разложить карты, попробуй ещё раз.")
+            return
+        lifecycle.mark_draw()
+        kb = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text=f"Описание: {card.name}", callback_data=f"desc_{card.type}:{card.id}")]
+            for card in cards
+        ])
+        await callback.message.answer("Посмотри на карты внимательно. Что они говорят тебе? ❤️", reply_markup=kb)
+
+    # ========================
+    # 🔹 ПОИСК КАРТ
+    # ========================
+
+    search = CardSearch(catalog)
+
+    async def show_card(bot: Bot, chat_id: int, card) -> None:
+        card_type = card.type if card.type in ('block', 'resource') else 'block'
+        kb = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="Описание", callback_data=f"desc_{card_type}:{card.id}")]
+        ])
+        sent = await media.send_photo(bot, chat_id, card, reply_markup=kb)
+        if not sent:
+            await bot.send_message(chat_id, f"💥 Не удалось загрузить изображение для карты '{card.name}'.")
+
+    @router.message(Command("find"))
+    async def find_command(message: Message, command: CommandObject) -> None:
+        if not command.args:
+            await message.answer("Напиши после /find слова из названия или описания карты, например: /find благодарность")
+            return
+        cards = search.search(command.args, limit=10)
+        if not cards:
+            await message.answer("Ничего не нашлось 🤔 Попробуй другие слова.")
+        elif len(cards) == 1:
+            await show_card(message.bot, message.chat.id, cards[0])
+        else:
+            kb = InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text=f"{card.id}. {card.name}", callback_data=f"card:{card.id}")]
+                for card in cards
+            ])
+            await message.answer(f"Нашлось карт: {len(cards)}", reply_markup=kb)
+
+    @router.callback_query(lambda c: c.data.startswith("card:"))
+    async def card_callback(callback: CallbackQuery) -> None:
+        await callback.answer()
+        try:
+            card = catalog.get(int(callback.data.split(":", 1)[1]))
+        except ValueError:
+            card = None
+        if not card:
+            await callback.message.answer("Карта не найдена.")
+            return
+        await show_card(callback.bot, callback.message.chat.id, card)
+
+    @router.inline_query()
+    async def inline_search(query: InlineQuery) -> None:
+        # Пустой запрос — первые карты колоды, иначе поиск; фото — только из кэша file_id
+        cards = search.search(query.query, limit=MAX_RESULTS) if query.query.strip() else list(catalog)[:20]
+        results = []
+        for card in cards:
+            file_id = media.get(card)
+            if file_id:
+                results.append(InlineQueryResultCachedPhoto(
+                    id=str(card.id), photo_file_id=file_id, title=card.name,
+                    description=card.description[:100], caption=f"<b>{card.name}</b>"
+                ))
+            else:
+                results.append(InlineQueryResultArticle(
+                    id=str(card.id), title=card.name, description=card.description[:100],
+                    thumbnail_url=thumbnail_url(card),
+                    input_message_content=InputTextMessageContent(message_text=f"<b>{card.name}</b>\n\n{card.description}")
+                ))
+        await query.answer(results, cache_time=300)
 
     @router.message(lambda message: message.web_app_data)
     async def handle_web_app_data(message: Message) -> None:
@@ -234,11 +456,13 @@ def create_router(cards):
         if message.text and message.text.startswith('/'):
             return
         user_id = message.from_user.id
-        if user_id not in user_states or user_states[user_id].get('step') != 'waiting_for_request':
+        session = await sessions.get(user_id)
+        if not session or session.step != 'waiting_for_request':
             return
-        user_states[user_id]['request'] = message.text
-        user_states[user_id]['step'] = 'request_received'
-        update_current_request(user_id, message.text)
+        session.request_text = message.text
+        session.step = 'request_received'
+        await sessions.save(session)
+        await update_current_request(user_id, message.text)
         keyboard = InlineKeyboardBuilder()
         keyboard.button(text="Отправить запрос💫", callback_data="draw_cards")
         await message.answer("Отлично!✨ \n\nПервая карта - это блок. То, что мешает тебе в реализации твоего запроса.", reply_markup=keyboard.as_markup())
@@ -248,103 +472,63 @@ def create_router(cards):
         await callback.answer()
         user_id = callback.from_user.id
 
-        request_text = user_states.get(user_id, {}).get('request', "No specific request")
-
-        block_cards = [c for c in cards if c['type'] == 'block']
-        resource_cards = [c for c in cards if c['type'] == 'resource']
+        block_card = await draws.draw_one(user_id, 'block', catalog.of_type('block'))
+        resource_card = await draws.draw_one(user_id, 'resource', catalog.of_type('resource'))
 
-        if not block_cards or not resource_cards:
+        if not block_card or not resource_card:
             await callback.message.answer("Ошибка: карты не найдены!")
             return
+        lifecycle.mark_draw()
 
-        block_card = random.choice(block_cards)
-        resource_card = random.choice(resource_cards)
-
-        block_image_bytes = await download_github_image(block_card['image_url'])
-        if not block_image_bytes:
+        block_temp = await callback.bot.send_message(chat_id=user_id, text="Вытягиваем карту блока...")
+        try:
+            sent = await media.send_photo(callback.bot, user_id, block_card)
+        finally:
+            # Заглушка не должна остаться в чате, даже если отправка карты упала
+            await callback.bot.delete_message(chat_id=user_id, message_id=block_temp.message_id)
+        if not sent:
             await callback.message.answer("Не удалось загрузить блок-карту.")
             return
 
-        user_states[user_id]['block_card'] = block_card
-        user_states[user_id]['resource_card'] = resource_card
-        user_states[user_id]['request_text'] = request_text
+        session = await sessions.get_or_create(user_id)
+        session.block_card_id = block_card.id
+        session.resource_card_id = resource_card.id
+        await sessions.save(session)
 
-        block_temp = await callback.bot.send_message(chat_id=user_id, text="Вытягиваем карту блока...")
-        await callback.bot.send_photo(
-            chat_id=user_id,
-            photo=BufferedInputFile(block_image_bytes, filename=f"{block_card['id']}.png")
-        )
-        await callback.bot.delete_message(chat_id=user_id, message_id=block_temp.message_id)
-
-        await asyncio.sleep(2)
-        await callback.bot.send_message(user_id, "Что ты тут видишь?")
-        await asyncio.sleep(10)
-        await callback.bot.send_message(user_id, "О чем карта говорит, что напоминает?")
-        await asyncio.sleep(10)
-        await callback.bot.send_message(user_id, "Какое чувство она вызывает? Какими событиями вызвано это чувство?")
-        await asyncio.sleep(15)
-
-        final_kb = InlineKeyboardMarkup(inline_keyboard=[
-            [
-                InlineKeyboardButton(text="Подсказки ✨", callback_data=f"desc_block:{block_card['id']}"),
-                InlineKeyboardButton(text="Хочу ресурс 💫", callback_data="show_resource")
-            ]
-        ])
-        await callback.bot.send_message(
-            user_id,
-            "Все ли тебе понятно или нужны подсказки? ❤️",
-            reply_markup=final_kb
-        )
+        scripts.start(callback.bot, user_id, BLOCK_SCRIPT, {'block_card_id': block_card.id})
 
     @router.callback_query(lambda c: c.data == "show_resource")
     async def show_resource_handler(callback: CallbackQuery) -> None:
         await callback.answer()
         user_id = callback.from_user.id
 
-        if user_id not in user_states:
+        session = await sessions.get(user_id)
+        if not session:
             await callback.message.answer("Сессия устарела. Начни с /start.")
             return
 
-        resource_card = user_states[user_id].get('resource_card')
-        block_card = user_states[user_id].get('block_card')
+        resource_card = catalog.get(session.resource_card_id)
+        block_card = catalog.get(session.block_card_id)
 
         if not resource_card or not block_card:
             await callback.message.answer("Ошибка: данные карт утеряны.")
             return
 
-        resource_image_bytes = await download_github_image(resource_card['image_url'])
-        if not resource_image_bytes:
-            await callback.message.answer("Не удалось загрузить ресурс-карту.")
-            return
-
         resource_temp = await callback.bot.send_message(chat_id=user_id, text="Вытягиваем карту ресурс...")
-        await asyncio.sleep(3)
-        await callback.bot.delete_message(chat_id=user_id, message_id=resource_temp.message_id)
+        context = {'resource_card_id': resource_card.id, 'temp_message_id': resource_temp.message_id}
+        scripts.start(callback.bot, user_id, RESOURCE_SCRIPT, context)
 
-        await callback.bot.send_photo(
-            chat_id=user_id,
-            photo=BufferedInputFile(resource_image_bytes, filename=f"{resource_card['id']}.png")
-        )
+    async def reveal_resource_card(bot: Bot, chat_id: int, context: dict) -> bool:
+        try:
+            sent = await media.send_photo(bot, chat_id, catalog.get(context['resource_card_id']))
+        finally:
+            await bot.delete_message(chat_id=chat_id, message_id=context['temp_message_id'])
+        if not sent:
+            await bot.send_message(chat_id, "Не удалось загрузить ресурс-карту.")
+            return False
+        return True
 
-        await asyncio.sleep(2)
-        await callback.bot.send_message(user_id, "А что ты видишь тут?")
-        await asyncio.sleep(10)
-        await callback.bot.send_message(user_id, "Понимаешь ли ты, о чем говорит тебе эта карта?")
-        await asyncio.sleep(10)
-        await callback.bot.send_message(user_id, "Что тебе нужно сделать, чтобы это помогло с решением твоего запроса?")
-        await asyncio.sleep(10)
-
-        final_kb = InlineKeyboardMarkup(inline_keyboard=[
-            [
-                InlineKeyboardButton(text="Подсказки ✨", callback_data=f"desc_resource:{resource_card['id']}"),
-                InlineKeyboardButton(text="Все понятно ☺️", callback_data="resource_understood")
-            ]
-        ])
-        await callback.bot.send_message(
-            user_id,
-            "Если нужны подсказки, они тут ❤️",
-            reply_markup=final_kb
-        )
+    RESOURCE_SCRIPT = (Step(3, action=reveal_resource_card),) + RESOURCE_QUESTIONS
 
     @router.callback_query(lambda c: c.data == "block_understood")
     async def block_understood_handler(callback: CallbackQuery) -> None:
@@ -356,34 +540,33 @@ def create_router(cards):
         await callback.answer()
         user_id = callback.from_user.id
 
-        if user_id not in user_states:
+        session = await sessions.get(user_id)
+        if not session:
             await callback.message.answer("Сессия устарела.")
             return
 
-        request_text = user_states[user_id].get('request_text', "No specific request")
-        block_card = user_states[user_id].get('block_card')
-        resource_card = user_states[user_id].get('resource_card')
+        request_text = session.request_text or "No specific request"
+        block_card = catalog.get(session.block_card_id)
+        resource_card = catalog.get(session.resource_card_id)
 
         if block_card and resource_card:
-            save_request(
+            await save_request(
                 user_id,
                 request_text,
-                block_card['id'],
-                resource_card['id'],
-                block_card['description'],
-                resource_card['description']
+                [(block_card.id, 'block'), (resource_card.id, 'resource')],
+                idempotency_key=f"cb:{callback.id}"
             )
-            clear_current_request(user_id)
-            user_states[user_id]['step'] = 'waiting_for_feedback'
-            user_states[user_id]['last_interaction'] = datetime.utcnow()
-            asyncio.create_task(send_followup_questions(user_id, callback.bot))
+            await clear_current_request(user_id)
+            session.step = 'waiting_for_feedback'
+            session.touch()
+            await sessions.save(session)
+            await scheduler.enqueue(user_id, 'followup', FOLLOWUP_DELAY)
 
         await callback.message.answer("Отлично! 🌿 Ты молодец!")
 
-    async def send_followup_questions(user_id: int, bot: Bot):
-        await asyncio.sleep(300)
-        state = user_states.get(user_id)
-        if not state or state.get('step') != 'waiting_for_feedback':
+    async def send_followup_questions(bot: Bot, user_id: int, payload) -> None:
+        session = await sessions.get(user_id)
+        if not session or session.step != 'waiting_for_feedback':
             return
 
         text = "Получила ли ты ответ на свой запрос, или тебе нужно больше понимания?"
@@ -393,8 +576,9 @@ def create_router(cards):
 
         try:
             await bot.send_message(chat_id=user_id, text=text, reply_markup=keyboard.as_markup())
-            user_states[user_id]['step'] = 'waiting_for_hints_or_done'
-            user_states[user_id]['last_interaction'] = datetime.utcnow()
+            session.step = 'waiting_for_hints_or_done'
+            session.touch()
+            await sessions.save(session)
         except Exception as e:
             logging.warning(f"Не удалось отправить follow-up: {e}")
 
@@ -402,8 +586,10 @@ def create_router(cards):
     async def hints_handler(callback: CallbackQuery) -> None:
         await callback.answer()
         user_id = callback.from_user.id
-        if user_id in user_states:
-            user_states[user_id]['last_interaction'] = datetime.utcnow()
+        session = await sessions.get(user_id)
+        if session:
+            session.touch()
+            await sessions.save(session)
 
         text = (
             "Зайди в пункт меню слева, и выбери себе еще карты \"Блока\" или \"Ресурса\" как дополнение к своему запросу. 🌟\n\n"
@@ -416,25 +602,22 @@ def create_router(cards):
     async def insights_handler(callback: CallbackQuery) -> None:
         await callback.answer()
         user_id = callback.from_user.id
-        if user_id in user_states:
-            user_states[user_id]['last_interaction'] = datetime.utcnow()
-        else:
-            user_states[user_id] = {'last_interaction': datetime.utcnow()}
+        session = await sessions.get_or_create(user_id)
+        session.touch()
+        await sessions.save(session)
 
-        asyncio.create_task(schedule_final_message(user_id, callback.bot, delay=180))
+        await scheduler.enqueue(user_id, 'final_message', FINAL_MESSAGE_DELAY)
         await callback.message.answer("Пусть будет прекрасным твой день! 🌸\n\n")
 
-    async def schedule_final_message(user_id: int, bot: Bot, delay: int = 180):
-        await asyncio.sleep(delay)
-        current_state = user_states.get(user_id, {})
-        last_interaction = current_state.get('last_interaction')
-        if last_interaction:
-            if (datetime.utcnow() - last_interaction).total_seconds() >= delay:
+    async def send_final_message(bot: Bot, user_id: int, payload) -> None:
+        session = await sessions.get(user_id)
+        if session and session.last_interaction:
+            if time.time() - session.last_interaction >= FINAL_MESSAGE_DELAY:
                 try:
                     await bot.send_message(user_id, "Пусть будет прекрасным твой день! 🌸\n\n")
                 except Exception as e:
                     logging.warning(f"Не удалось отправить финальное сообщение: {e}")
-        user_states.pop(user_id, None)
+        await sessions.delete(user_id)
 
     @router.callback_query(lambda c: c.data.startswith("desc_"))
     async def desc_callback(callback: CallbackQuery) -> None:
@@ -447,15 +630,102 @@ def create_router(cards):
             await callback.message.answer("Ошибка в данных карты.")
             return
 
-        card = next((c for c in cards if c['id'] == card_id), None)
+        card = catalog.get(card_id)
         if not card:
             await callback.message.answer("Карта не найдена.")
             return
 
-        await callback.message.answer(card['description'])
+        await callback.message.answer(card.description)
+
+    scheduler.register('followup', send_followup_questions)
+    scheduler.register('final_message', send_final_message)
 
     return router
 
+def create_dispatcher(catalog: CardCatalog, media: CardMediaCache, process_index: int = 0, processes: int = 1) -> Dispatcher:
+    # FSM в SQLite только в общем режиме (SHARED_STATE=1 или несколько процессов), иначе в памяти
+    dp = Dispatcher(storage=create_storage())
+    # Повторные доставки апдейтов отбрасываются до любых фильтров и I/O
+    dp.update.outer_middleware(deduplicator)
+    # Внутри дедупликации: считаем апдейты в обработке, чтобы дождаться их при остановке
+    dp.update.outer_middleware(lifecycle)
+    # Команды администратора — раньше основного роутера, чтобы /stats не принялся за текст запроса
+    dp.include_router(create_admin_router(catalog))
+    dp.include_router(create_router(catalog, media))
+
+    async def prewarm():
+        # До приёма апдейтов: соединение с базой и картинки, которых нет ни в колоде, ни в assets/.
+        # GitHub ждём не дольше PREWARM_TIMEOUT — дальше предзагрузка продолжается в фоне
+        await prewarm_db()
+        # Зеркало картинок заполняет только первый процесс: остальные не пишут в тот же индекс наперегонки
+        if process_index != 0:
+            return
+        remote = [
+            card.image_url for card in catalog
+            if (deck_bundle is None or deck_bundle.image(card.id) is None) and card_assets.variant(card.id) is None
+        ]
+        if not remote:
+            return
+        task = asyncio.create_task(image_store.prefetch(remote))
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+        done, _ = await asyncio.wait({task}, timeout=PREWARM_TIMEOUT)
+        if not done:
+            logging.warning(f"⚠️ Картинки не прогрелись за {PREWARM_TIMEOUT:g} с — догружаем в фоне")
+
+    async def load_media_cache():
+        await media.load(catalog)
+
+    async def start_scheduler(bot: Bot):
+        # Отложенные сообщения чата шлёт процесс-владелец чата — там же его апдейты и лимит отправки
+        await scheduler.start(bot, owns=lambda user_id: owner_of(user_id, processes) == process_index)
+
+    async def start_deck_watcher():
+        task = asyncio.create_task(watch_deck_bundle(catalog, media))
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+
+    async def drain():
+        # Первым делом при остановке: дать закончиться начатым хендлерам и сценариям
+        await lifecycle.drain(lambda: scripts.active)
+
+    async def close_resources():
+        for task in list(background_tasks):
+            task.cancel()
+        await scripts.stop()
+        await scheduler.stop()
+        await http_client.close()
+        await image_store.close()
+        await close_db()
+
+    dp.startup.register(load_media_cache)
+    dp.startup.register(start_scheduler)
+    dp.startup.register(prewarm)
+    dp.startup.register(start_deck_watcher)
+    dp.shutdown.register(drain)
+    dp.shutdown.register(close_resources)
+    metrics.setup_dispatcher(dp)
+    # Профилировщик медленных апдейтов и сторож event loop — только если включены в окружении
+    profiling.setup(dp)
+    return dp
+
+def register_gauges() -> None:
+    metrics.registry.gauge('bot_sessions_in_memory', 'Сессии в LRU-кэше', lambda: len(sessions))
+    metrics.registry.gauge('bot_scheduled_jobs_pending', 'Отложенные сообщения в планировщике', lambda: scheduler.pending)
+    metrics.registry.gauge('bot_scripts_active', 'Активные сценарии с паузами', lambda: scripts.active)
+    metrics.registry.gauge('bot_background_tasks', 'Фоновые задачи бота', lambda: len(background_tasks))
+    metrics.registry.gauge('bot_outbound_queue_depth', 'Исходящие запросы в очереди лимитов', lambda: outbound.depth)
+    metrics.registry.gauge('bot_db_write_queue_depth', 'Отложенные записи в базу', lambda: write_queue.depth)
+    lifecycle.register_gauges()
+
+def create_bot() -> Bot:
+    bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+    # Все исходящие запросы проходят через лимиты Telegram
+    bot.session.middleware(outbound)
+    # Внутри лимитов: меряем сам запрос к Telegram, каждую попытку отдельно
+    bot.session.middleware(metrics.ApiMetricsMiddleware())
+    return bot
+
 # --- MAIN ---
 def main():
     # Уровень логирования: INFO для разработки, ERROR для продакшена
@@ -463,43 +733,92 @@ def main():
     logging.basicConfig(level=log_level)
     init_db()
 
-    with open('cards.json', 'r', encoding='utf-8') as f:
-        cards = json.load(f)
-    logging.info(f"✅ Загружено {len(cards)} карт")
+    catalog = load_catalog()
+    logging.info(f"✅ Загружено {len(catalog)} карт, типы: {', '.join(catalog.types)}")
+
+    media = CardMediaCache(load_card_image, card_image_hash, card_image_filename)
+    register_gauges()
 
     if os.getenv("RENDER_EXTERNAL_URL"):
-        external_url = os.getenv("RENDER_EXTERNAL_URL")
-        WEBHOOK_PATH = f"/webhook/{BOT_TOKEN}"
-        webhook_url = f"{external_url}{WEBHOOK_PATH}"
-        WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "elina_webhook_2025")
-
-        bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-        dp = Dispatcher()
-        router = create_router(cards)
-        dp.include_router(router)
-
-        async def on_startup(app):
-            await bot.set_webhook(url=webhook_url, secret_token=WEBHOOK_SECRET, drop_pending_updates=True)
-
-        app = web.Application()
-        app.on_startup.append(on_startup)
-        async def health_check(request):
-            return web.json_response({"status": "ok"})
-        app.router.add_get("/health", health_check)
-
-        SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
-        setup_application(app, dp, bot=bot)
-        web.run_app(app, host="0.0.0.0", port=int(os.getenv("PORT", 10000)))
+        # Несколько процессов слушают один порт (SO_REUSEPORT), состояние — в общей SQLite.
+        # Каждый чат закреплён за одним процессом (см. QueuedRequestHandler), так что порядок
+        # апдейтов, сценарии, лимиты и мешок карт пользователя живут в одном процессе
+        processes = int(os.getenv("WEB_CONCURRENCY", 1))
+        for process_index in range(1, processes):
+            multiprocessing.Process(
+                target=run_webhook, args=(catalog, media, process_index, processes), daemon=True
+            ).start()
+        run_webhook(catalog, media, 0, processes)
     else:
         async def run_polling():
-            bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-            await bot.delete_webhook(drop_pending_updates=True)
-            dp = Dispatcher()
-            router = create_router(cards)
-            dp.include_router(router)
-            await dp.start_polling(bot, skip_updates=True)
+            bot = create_bot()
+            # Накопившиеся за время перезапуска апдейты не выбрасываем — их обработает новый процесс
+            await bot.delete_webhook(drop_pending_updates=False)
+            dp = create_dispatcher(catalog, media)
+
+            async def mark_ready():
+                lifecycle.mark_ready()
+
+            dp.startup.register(mark_ready)
+            metrics_runner = await metrics.start_server()
+            try:
+                await dp.start_polling(bot)
+            finally:
+                if metrics_runner is not None:
+                    await metrics_runner.cleanup()
 
         asyncio.run(run_polling())
 
+def run_webhook(catalog: CardCatalog, media: CardMediaCache, process_index: int, processes: int = 1):
+    external_url = os.getenv("RENDER_EXTERNAL_URL")
+    WEBHOOK_PATH = f"/webhook/{BOT_TOKEN}"
+    webhook_url = f"{external_url}{WEBHOOK_PATH}"
+    WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "elina_webhook_2025")
+
+    # Лимит Telegram общий на бота: каждый процесс получает свою долю, в сумме не больше GLOBAL_RATE.
+    # Лимит чата делить не нужно — чат живёт в одном процессе
+    outbound.set_global_rate(GLOBAL_RATE / processes)
+    bot = create_bot()
+    dp = create_dispatcher(catalog, media, process_index, processes)
+
+    async def on_startup(app):
+        # После прогрева (startup диспетчера выше): Telegram начинает слать апдейты уже готовому процессу.
+        # Вебхук регистрирует только первый процесс; апдейты, пришедшие за время перезапуска, не выбрасываем
+        if process_index == 0:
+            await bot.set_webhook(url=webhook_url, secret_token=WEBHOOK_SECRET, drop_pending_updates=False)
+        lifecycle.mark_ready()
+
+    async def on_shutdown(app):
+        # До закрытия обработчика вебхука: сервер уже не принимает соединения, дорабатываем очередь
+        await lifecycle.drain(lambda: webhook_handler.depth, lambda: scripts.active)
+
+    app = web.Application()
+    app.on_shutdown.append(on_shutdown)
+    webhook_handler = QueuedRequestHandler(
+        dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET, process_index=process_index, processes=processes
+    )
+
+    async def health_check(request):
+        if not lifecycle.accepting:
+            return web.json_response({"status": lifecycle.state, "lifecycle": lifecycle.stats()}, status=503)
+        lifecycle.mark_healthy()
+        return web.json_response({
+            "status": "ok",
+            "process": process_index,
+            "lifecycle": lifecycle.stats(),
+            "webhook": webhook_handler.stats(),
+            "outbound": outbound.stats(),
+            "db_write_queue": write_queue.stats(),
+            "dedup": deduplicator.stats(),
+        })
+    app.router.add_get("/health", health_check)
+    app.router.add_get("/metrics", metrics.metrics_handler)
+    app.router.add_get(r"/thumbs/{card_id:\d+}.jpg", thumb_handler)
+
+    webhook_handler.register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    app.on_startup.append(on_startup)
+    web.run_app(app, host="0.0.0.0", port=int(os.getenv("PORT", 10000)), reuse_port=processes > 1)
+
 if __name__ == "__main__":
     main()
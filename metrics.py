@@ -0,0 +1,229 @@
+"""
+Метрики бота в текстовом формате Prometheus (без зависимости от prometheus_client).
+
+Гистограммы задержек по хендлерам, базе, Bot API и загрузке картинок,
+счётчики ошибок и gauge-значения, которые считаются в момент запроса /metrics.
+"""
+import logging
+import os
+import time
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import (
+    TelegramAPIError, TelegramBadRequest, TelegramConflictError, TelegramEntityTooLarge, TelegramForbiddenError,
+    TelegramNetworkError, TelegramNotFound, TelegramRetryAfter, TelegramServerError, TelegramUnauthorizedError
+)
+from aiohttp import web
+
+# Порт отдельного сервера метрик в режиме polling (0 — не запускать)
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9100))
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (10_000, 50_000, 100_000, 250_000, 500_000, 1_000_000, 2_000_000, 5_000_000)
+
+# Коды ошибок Bot API по классам исключений aiogram
+ERROR_CODES = (
+    (TelegramRetryAfter, '429'),
+    (TelegramEntityTooLarge, '413'),
+    (TelegramBadRequest, '400'),
+    (TelegramUnauthorizedError, '401'),
+    (TelegramForbiddenError, '403'),
+    (TelegramNotFound, '404'),
+    (TelegramConflictError, '409'),
+    (TelegramServerError, '5xx'),
+    (TelegramNetworkError, 'network'),
+)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labelnames: tuple, values: tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}  # значения меток -> число
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = tuple(labels[name] for name in self.labelnames)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        for key, value in self._values.items():
+            yield self.name, _format_labels(self.labelnames, key), value
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets) + (float('inf'),)
+        self._series = {}  # значения меток -> [счётчики корзин..., сумма, количество]
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(labels[name] for name in self.labelnames)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = [0] * len(self.buckets) + [0.0, 0]
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[index] += 1
+                break
+        series[-2] += value
+        series[-1] += 1
+
+    def samples(self):
+        for key, series in self._series.items():
+            cumulative = 0
+            for index, bound in enumerate(self.buckets):
+                cumulative += series[index]
+                le = 'le="+Inf"' if bound == float('inf') else f'le="{bound}"'
+                yield f"{self.name}_bucket", _format_labels(self.labelnames, key, le), cumulative
+            yield f"{self.name}_sum", _format_labels(self.labelnames, key), series[-2]
+            yield f"{self.name}_count", _format_labels(self.labelnames, key), series[-1]
+
+
+class Gauge:
+    """Значение считается функцией в момент отдачи метрик."""
+
+    kind = 'gauge'
+
+    def __init__(self, name: str, documentation: str, function):
+        self.name = name
+        self.documentation = documentation
+        self.function = function
+
+    def samples(self):
+        try:
+            value = self.function()
+        except Exception as e:
+            logging.error(f"💥 Ошибка вычисления метрики {self.name}: {e}")
+            return
+        if value is not None:  # None — значения пока нет
+            yield self.name, '', value
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: tuple = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: tuple = (),
+                  buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def gauge(self, name: str, documentation: str, function) -> Gauge:
+        return self.register(Gauge(name, documentation, function))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{labels} {_format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+handler_seconds = registry.histogram(
+    'bot_handler_seconds', 'Время обработки апдейта хендлером', ('handler',))
+handler_errors = registry.counter(
+    'bot_handler_errors_total', 'Исключения в хендлерах', ('handler',))
+telegram_api_seconds = registry.histogram(
+    'bot_telegram_api_seconds', 'Время запроса к Bot API', ('method',))
+telegram_api_errors = registry.counter(
+    'bot_telegram_api_errors_total', 'Ошибки Bot API по кодам', ('method', 'code'))
+db_call_seconds = registry.histogram(
+    'bot_db_call_seconds', 'Время вызова базы данных (с ожиданием потока базы)', ('call',))
+image_download_seconds = registry.histogram(
+    'bot_image_download_seconds', 'Время download_github_image', ('source',))
+image_download_bytes = registry.histogram(
+    'bot_image_download_bytes', 'Размер картинки из download_github_image', buckets=SIZE_BUCKETS)
+github_fetch_seconds = registry.histogram(
+    'bot_github_fetch_seconds', 'Время запроса картинки к GitHub', ('status',))
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Inner-middleware: задержка и ошибки по имени функции хендлера."""
+
+    async def __call__(self, handler, event, data):
+        handler_object = data.get('handler')
+        name = getattr(getattr(handler_object, 'callback', None), '__name__', 'unknown')
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            handler_errors.inc(handler=name)
+            raise
+        finally:
+            handler_seconds.observe(time.perf_counter() - started, handler=name)
+
+
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    """Request-middleware сессии бота: задержка и коды ошибок вызовов Bot API."""
+
+    async def __call__(self, make_request, bot, method):
+        name = type(method).__name__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except TelegramAPIError as e:
+            code = next((code for cls, code in ERROR_CODES if isinstance(e, cls)), 'other')
+            telegram_api_errors.inc(method=name, code=code)
+            raise
+        finally:
+            telegram_api_seconds.observe(time.perf_counter() - started, method=name)
+
+
+def setup_dispatcher(dp) -> None:
+    """Вешает HandlerMetricsMiddleware на все типы апдейтов диспетчера."""
+    middleware = HandlerMetricsMiddleware()
+    for name, observer in dp.observers.items():
+        if name not in ('update', 'error'):
+            observer.middleware(middleware)
+
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(text=registry.render(), content_type='text/plain', charset='utf-8')
+
+
+async def start_server(port: int = METRICS_PORT) -> web.AppRunner | None:
+    """Отдельный сервер /metrics для режима polling."""
+    if not port:
+        return None
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "0.0.0.0", port).start()
+    logging.info(f"📈 Метрики: http://0.0.0.0:{port}/metrics")
+    return runner
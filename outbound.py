@@ -0,0 +1,198 @@
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from contextvars import ContextVar
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+
+# Лимиты Telegram: ~30 сообщений в секунду на бота и ~1 в секунду на чат
+GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", 30))
+CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", 1))
+CHAT_BURST = float(os.getenv("SEND_CHAT_BURST", 3))
+MAX_RETRIES = 3
+SCAN_LIMIT = 100  # сколько ожидающих просматривать в поисках свободного чата
+
+# Полосы приоритета: ответы пользователю идут раньше отложенных сообщений
+INTERACTIVE = 0
+SCHEDULED = 1
+LANES = (INTERACTIVE, SCHEDULED)
+
+# Приоритет отправок текущей задачи (сценарии и планировщик ставят SCHEDULED)
+send_priority = ContextVar('send_priority', default=INTERACTIVE)
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated', 'blocked_until')
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """Через сколько секунд будет доступен токен (0 — уже есть)."""
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+    def idle(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity and now >= self.blocked_until
+
+
+class OutboundScheduler(BaseRequestMiddleware):
+    """
+    Планировщик исходящих запросов к Bot API (request middleware сессии бота).
+
+    Каждый метод с chat_id ждёт токен в общем бакете и в бакете своего чата;
+    ожидающие обслуживаются по полосам приоритета, при 429 запрос
+    повторяется после retry_after, а чат на это время ставится на паузу.
+    Методы без chat_id (getUpdates, answerCallbackQuery, ...) идут напрямую.
+    """
+
+    def __init__(self, global_rate: float = GLOBAL_RATE, chat_rate: float = CHAT_RATE,
+                 chat_burst: float = CHAT_BURST, max_retries: int = MAX_RETRIES):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats = {}  # chat_id -> TokenBucket
+        self._lanes = {lane: deque() for lane in LANES}  # (chat_id, future, enqueued_at)
+        self._wakeup = asyncio.Event()
+        self._pump_task = None
+        self._last_cleanup = time.monotonic()
+        # Метрики
+        self.sent = 0
+        self.retried = 0
+        self.wait_count = {lane: 0 for lane in LANES}
+        self.wait_total = {lane: 0.0 for lane in LANES}
+        self.wait_max = {lane: 0.0 for lane in LANES}
+
+    def set_global_rate(self, rate: float) -> None:
+        """Меняет общий лимит бота (несколько процессов делят GLOBAL_RATE между собой)."""
+        # Ёмкость не меньше одного токена, иначе при малой доле бакет никогда не наполнится
+        self._global = TokenBucket(rate, max(rate, 1.0))
+
+    @property
+    def depth(self) -> int:
+        return sum(len(lane) for lane in self._lanes.values())
+
+    def stats(self) -> dict:
+        return {
+            'queue_depth': self.depth,
+            'sent': self.sent,
+            'retried_after_429': self.retried,
+            'chat_buckets': len(self._chats),
+            'wait_ms': {
+                lane: {
+                    'count': self.wait_count[lane],
+                    'avg': round(self.wait_total[lane] / self.wait_count[lane] * 1000, 2) if self.wait_count[lane] else 0.0,
+                    'max': round(self.wait_max[lane] * 1000, 2),
+                }
+                for lane in LANES
+            },
+        }
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    async def _acquire(self, chat_id, priority: int) -> None:
+        enqueued_at = time.monotonic()
+        future = asyncio.get_running_loop().create_future()
+        self._lanes[priority].append((chat_id, future, enqueued_at))
+        if self._pump_task is None or self._pump_task.done():
+            self._pump_task = asyncio.create_task(self._pump())
+        self._wakeup.set()
+        await future
+
+        waited = time.monotonic() - enqueued_at
+        self.wait_count[priority] += 1
+        self.wait_total[priority] += waited
+        self.wait_max[priority] = max(self.wait_max[priority], waited)
+
+    def _grant_next(self, now: float) -> float:
+        """Выдаёт токен первому подходящему ожидающему; возвращает, сколько ждать до следующей попытки."""
+        global_wait = self._global.wait_time(now)
+        if global_wait:
+            return global_wait
+
+        next_wait = None
+        for lane in LANES:
+            queue = self._lanes[lane]
+            for index, (chat_id, future, _) in enumerate(queue):
+                if index >= SCAN_LIMIT:
+                    break
+                if future.done():  # ожидающего отменили
+                    del queue[index]
+                    return 0.0
+                bucket = self._chat_bucket(chat_id)
+                chat_wait = bucket.wait_time(now)
+                if not chat_wait:
+                    del queue[index]
+                    bucket.take()
+                    self._global.take()
+                    future.set_result(None)
+                    return 0.0
+                next_wait = chat_wait if next_wait is None else min(next_wait, chat_wait)
+        return next_wait
+
+    async def _pump(self) -> None:
+        while True:
+            self._wakeup.clear()
+            now = time.monotonic()
+            wait = self._grant_next(now)
+            if wait is None:
+                self._cleanup(now)
+                await self._wakeup.wait()
+            elif wait > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+            else:
+                await asyncio.sleep(0)
+
+    def _cleanup(self, now: float) -> None:
+        # Бакеты простаивающих чатов не нужны — память не растёт с числом чатов
+        if now - self._last_cleanup < 60:
+            return
+        self._last_cleanup = now
+        for chat_id in [c for c, bucket in self._chats.items() if bucket.idle(now)]:
+            del self._chats[chat_id]
+
+    async def __call__(self, make_request, bot: Bot, method):
+        chat_id = getattr(method, 'chat_id', None)
+        if chat_id is None:
+            return await make_request(bot, method)
+
+        priority = send_priority.get()
+        for attempt in range(self.max_retries + 1):
+            await self._acquire(chat_id, priority)
+            try:
+                result = await make_request(bot, method)
+                self.sent += 1
+                return result
+            except TelegramRetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                self.retried += 1
+                logging.warning(f"⚠️ 429 для чата {chat_id}, повтор через {e.retry_after} с")
+                bucket = self._chat_bucket(chat_id)
+                bucket.blocked_until = time.monotonic() + e.retry_after
@@ -0,0 +1,220 @@
+"""
+Профилирование медленных апдейтов (включается переменными окружения).
+
+PROFILE_SAMPLE_RATE > 0 — доля апдейтов, которые идут под cProfile (и tracemalloc,
+если PROFILE_TRACEMALLOC=1); дамп пишется, только если апдейт обрабатывался дольше
+PROFILE_THRESHOLD_MS. LOOP_STALL_MS > 0 — сторожевой поток, который замечает
+зависание event loop (синхронный вызов базы, тяжёлый PIL) и сохраняет стек,
+на котором loop стоит. Дампы — текстовые файлы в PROFILE_DIR, хранятся последние
+PROFILE_KEEP. Если всё выключено, в диспетчер ничего не добавляется.
+"""
+import asyncio
+import cProfile
+import io
+import logging
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+import traceback
+import tracemalloc
+
+from aiogram import BaseMiddleware, Dispatcher
+from aiogram.types import Update
+
+from metrics import registry
+
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", 0))
+PROFILE_THRESHOLD_MS = float(os.getenv("PROFILE_THRESHOLD_MS", 500))
+PROFILE_TRACEMALLOC = os.getenv("PROFILE_TRACEMALLOC", "0") == "1"
+LOOP_STALL_MS = float(os.getenv("LOOP_STALL_MS", 0))
+PROFILE_DIR = os.getenv("PROFILE_DIR") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "profiles")
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", 50))
+
+PSTATS_LINES = 30      # строк в выжимке cProfile
+TRACEMALLOC_LINES = 10  # строк в разнице снимков памяти
+TRACEMALLOC_FRAMES = 5
+# Собственные выделения профилировщиков в разницу снимков не попадают
+TRACEMALLOC_FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, cProfile.__file__),
+    tracemalloc.Filter(False, pstats.__file__),
+)
+
+profiles_written = registry.counter('bot_profiles_written_total', 'Записанные дампы профилировщика', ('kind',))
+loop_stall_seconds = registry.histogram(
+    'bot_loop_stall_seconds', 'Зависания event loop дольше LOOP_STALL_MS',
+    buckets=(0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0))
+
+
+class DumpDirectory:
+    """Каталог дампов с ротацией: после записи удаляются все файлы, кроме последних keep."""
+
+    def __init__(self, path: str = PROFILE_DIR, keep: int = PROFILE_KEEP):
+        self.path = path
+        self.keep = keep
+        self._lock = threading.Lock()  # пишут и loop (через поток), и сторожевой поток
+
+    def write(self, kind: str, name: str, text: str) -> str:
+        with self._lock:
+            os.makedirs(self.path, exist_ok=True)
+            now = time.time()
+            # Имя начинается со времени с микросекундами: сортировка по имени — по возрасту
+            stamp = f"{time.strftime('%Y%m%d-%H%M%S', time.localtime(now))}-{int(now % 1 * 1_000_000):06d}"
+            path = os.path.join(self.path, f"{stamp}-{kind}-{name}.txt")
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(text)
+            self._rotate()
+        profiles_written.inc(kind=kind)
+        return path
+
+    def _rotate(self) -> None:
+        files = sorted(name for name in os.listdir(self.path) if name.endswith('.txt'))
+        for name in files[:-self.keep] if self.keep > 0 else ():
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
+
+
+class ProfilingMiddleware(BaseMiddleware):
+    """
+    Outer-middleware на update: случайная доля апдейтов идёт под cProfile.
+
+    cProfile работает на весь поток, поэтому одновременно профилируется только
+    один апдейт, а в профиль попадает и всё, что loop делал параллельно —
+    для поиска «кто занял loop» это как раз то, что нужно.
+    """
+
+    def __init__(self, dumps: DumpDirectory, sample_rate: float = PROFILE_SAMPLE_RATE,
+                 threshold_ms: float = PROFILE_THRESHOLD_MS, trace_memory: bool = PROFILE_TRACEMALLOC):
+        self.dumps = dumps
+        self.sample_rate = sample_rate
+        self.threshold = threshold_ms / 1000
+        self.trace_memory = trace_memory
+        self._active = False
+        self.sampled = 0
+        self.slow = 0
+
+    async def __call__(self, handler, event: Update, data):
+        if self._active or random.random() >= self.sample_rate:
+            return await handler(event, data)
+
+        self._active = True
+        self.sampled += 1
+        profiler = cProfile.Profile()
+        before = tracemalloc.take_snapshot() if self.trace_memory and tracemalloc.is_tracing() else None
+        started = time.perf_counter()
+        profiler.enable()
+        try:
+            return await handler(event, data)
+        finally:
+            profiler.disable()
+            elapsed = time.perf_counter() - started
+            after = tracemalloc.take_snapshot() if before is not None else None
+            self._active = False
+            if elapsed >= self.threshold:
+                self.slow += 1
+                text = self._report(event, elapsed, profiler, before, after)
+                name = f"{event.event_type}-{event.update_id}-{elapsed * 1000:.0f}ms"
+                try:
+                    path = await asyncio.to_thread(self.dumps.write, 'update', name, text)
+                    logging.warning(f"🐢 Медленный апдейт {event.update_id}: {elapsed * 1000:.0f} мс, профиль: {path}")
+                except OSError as e:
+                    logging.error(f"💥 Не удалось записать профиль: {e}")
+
+    @staticmethod
+    def _report(event: Update, elapsed: float, profiler: cProfile.Profile, before, after) -> str:
+        out = io.StringIO()
+        out.write(f"update_id: {event.update_id}\ntype: {event.event_type}\nelapsed_ms: {elapsed * 1000:.1f}\n\n")
+        stats = pstats.Stats(profiler, stream=out)
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(PSTATS_LINES)
+        if after is not None:
+            out.write("\n=== tracemalloc: прирост памяти за апдейт ===\n")
+            after = after.filter_traces(TRACEMALLOC_FILTERS)
+            before = before.filter_traces(TRACEMALLOC_FILTERS)
+            for stat in after.compare_to(before, 'lineno')[:TRACEMALLOC_LINES]:
+                out.write(f"{stat}\n")
+        return out.getvalue()
+
+
+class LoopWatchdog:
+    """
+    Сторожевой поток: loop раз в interval отмечает «пульс»; если пульса нет
+    дольше stall_ms, поток снимает стек потока loop через sys._current_frames() —
+    это ровно тот код, который держит loop. Одно зависание — один дамп.
+    """
+
+    def __init__(self, dumps: DumpDirectory, stall_ms: float = LOOP_STALL_MS):
+        self.dumps = dumps
+        self.stall = stall_ms / 1000
+        self.interval = self.stall / 4
+        self.stalls = 0
+        self._beat = time.monotonic()
+        self._loop = None
+        self._loop_thread_id = None
+        self._handle = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _heartbeat(self) -> None:
+        self._beat = time.monotonic()
+        self._handle = self._loop.call_later(self.interval, self._heartbeat)
+
+    async def start(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._stop.clear()
+        self._heartbeat()
+        self._thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._thread.start()
+        logging.info(f"🐕 Сторож event loop: зависания дольше {self.stall * 1000:g} мс пишутся в {self.dumps.path}")
+
+    async def stop(self) -> None:
+        self._stop.set()
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        if self._thread is not None:
+            self._thread.join(timeout=1)
+            self._thread = None
+
+    def _watch(self) -> None:
+        reported = None  # пульс, на котором уже записали зависание
+        while not self._stop.wait(self.interval):
+            beat = self._beat
+            lag = time.monotonic() - beat
+            if lag < self.stall or reported == beat:
+                continue
+            reported = beat
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            self.stalls += 1
+            loop_stall_seconds.observe(lag)
+            stack = ''.join(traceback.format_stack(frame))
+            try:
+                path = self.dumps.write('stall', f"{lag * 1000:.0f}ms", f"loop_lag_ms: {lag * 1000:.1f}\n\n{stack}")
+                logging.warning(f"🧊 Event loop стоит уже {lag * 1000:.0f} мс, стек: {path}")
+            except OSError as e:
+                logging.error(f"💥 Не удалось записать стек зависания: {e}")
+
+
+def setup(dp: Dispatcher) -> None:
+    """Подключает профилировщик и сторожа к диспетчеру, если они включены в окружении."""
+    if PROFILE_SAMPLE_RATE <= 0 and LOOP_STALL_MS <= 0:
+        return
+    dumps = DumpDirectory()
+
+    if PROFILE_SAMPLE_RATE > 0:
+        if PROFILE_TRACEMALLOC and not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+        dp.update.outer_middleware(ProfilingMiddleware(dumps))
+        logging.info(f"🔬 Профилирование {PROFILE_SAMPLE_RATE:.0%} апдейтов дольше {PROFILE_THRESHOLD_MS:g} мс")
+
+    if LOOP_STALL_MS > 0:
+        watchdog = LoopWatchdog(dumps)
+        dp.startup.register(watchdog.start)
+        dp.shutdown.register(watchdog.stop)
@@ -0,0 +1,256 @@
+"""
+Отчёты по раскладам: частота карт, активность по дням, история пользователя.
+
+    python reporting.py stats [--days 14]        # расклады и активные пользователи по дням
+    python reporting.py cards [--days 30]        # самые частые карты
+    python reporting.py user 123456789           # история пользователя
+    python reporting.py export history.csv [--since 2025-01-01]
+
+Сводки читаются из агрегатных таблиц (их ведут триггеры, см. миграцию 3
+в database.py), а не считаются GROUP BY по всей истории. Все запросы идут
+через отдельное read-only соединение: в WAL-режиме оно не мешает записи бота.
+В боте — команды /stats и /export для пользователей из ADMIN_IDS.
+"""
+import argparse
+import asyncio
+import csv
+import datetime
+import itertools
+import logging
+import os
+import sqlite3
+import sys
+import tempfile
+
+from aiogram import F, Router
+from aiogram.filters import Command, CommandObject
+from aiogram.types import FSInputFile, Message
+
+import database
+from catalog import CardCatalog
+
+# Telegram ID администраторов через запятую
+ADMIN_IDS = frozenset(int(x) for x in os.getenv("ADMIN_IDS", "").replace(" ", "").split(",") if x)
+EXPORT_FETCH_SIZE = 500
+CSV_COLUMNS = ('id', 'user_id', 'requested_at', 'request_text', 'spread',
+               'card_ids', 'card_names', 'card_roles')
+CSV_LIST_SEPARATOR = ';'  # карты расклада — в порядке позиций, через разделитель
+
+
+def connect_readonly(path: str | None = None) -> sqlite3.Connection:
+    conn = sqlite3.connect(f"file:{path or database.DB_PATH}?mode=ro", uri=True, check_same_thread=False)
+    conn.execute("PRAGMA busy_timeout=5000")
+    return conn
+
+
+def _since(days: int) -> str:
+    return (datetime.date.today() - datetime.timedelta(days=days - 1)).isoformat()
+
+
+def daily_stats(conn, days: int = 14) -> list:
+    """[(день, расклады, активные пользователи)] за последние days дней."""
+    return conn.execute(
+        'SELECT day, readings, active_users FROM daily_stats WHERE day >= ? ORDER BY day DESC',
+        (_since(days),)
+    ).fetchall()
+
+
+def top_cards(conn, days: int = 30, limit: int = 10) -> list:
+    """[(card_id, роль, выпадения)] за последние days дней — из суточных агрегатов."""
+    return conn.execute('''
+        SELECT card_id, role, SUM(draws) AS total FROM card_draws_daily
+        WHERE day >= ? GROUP BY card_id, role ORDER BY total DESC LIMIT ?
+    ''', (_since(days), limit)).fetchall()
+
+
+def top_users(conn, limit: int = 10) -> list:
+    return conn.execute(
+        'SELECT user_id, readings, last_at FROM user_readings ORDER BY readings DESC LIMIT ?', (limit,)
+    ).fetchall()
+
+
+def user_summary(conn, user_id: int) -> tuple | None:
+    """(расклады, первый, последний) для пользователя или None."""
+    return conn.execute(
+        'SELECT readings, first_at, last_at FROM user_readings WHERE user_id = ?', (user_id,)
+    ).fetchone()
+
+
+def user_history(conn, user_id: int, limit: int = 20) -> list:
+    """
+    Последние расклады пользователя: [(время, расклад, [(card_id, роль), ...])].
+    Расклады — по индексу idx_requests_user_time, карты — по первичному ключу
+    request_cards в порядке позиций.
+    """
+    readings = conn.execute('''
+        SELECT id, requested_at, spread FROM requests
+        WHERE user_id = ? ORDER BY requested_at DESC LIMIT ?
+    ''', (user_id, limit)).fetchall()
+    if not readings:
+        return []
+    placeholders = ','.join('?' * len(readings))
+    cards = {}
+    for request_id, card_id, role in conn.execute(f'''
+        SELECT request_id, card_id, role FROM request_cards
+        WHERE request_id IN ({placeholders}) ORDER BY request_id, position
+    ''', [request_id for request_id, _, _ in readings]):
+        cards.setdefault(request_id, []).append((card_id, role))
+    return [(requested_at, spread, cards.get(request_id, [])) for request_id, requested_at, spread in readings]
+
+
+def _card_name(catalog: CardCatalog | None, card_id, default: str | None = None) -> str:
+    card = catalog.get(card_id) if catalog is not None and card_id is not None else None
+    if card:
+        return card.name
+    return f"#{card_id}" if default is None else default
+
+
+def export_csv(conn, out, catalog: CardCatalog | None = None, since: str | None = None) -> int:
+    """
+    Пишет историю раскладов в CSV построчно: курсор читается пачками,
+    вся история в память не загружается. Возвращает число строк.
+    """
+    writer = csv.writer(out)
+    writer.writerow(CSV_COLUMNS)
+    # Строка на карту, по порядку расклада; строки одного расклада идут подряд
+    cursor = conn.execute('''
+        SELECT r.id, r.user_id, r.requested_at, r.request_text, r.spread, c.card_id, c.role
+        FROM requests r LEFT JOIN request_cards c ON c.request_id = r.id
+        WHERE r.requested_at >= ? ORDER BY r.id, c.position
+    ''', (since or '',))
+
+    def _rows():
+        while True:
+            rows = cursor.fetchmany(EXPORT_FETCH_SIZE)
+            if not rows:
+                return
+            yield from rows
+
+    count = 0
+    for _, group in itertools.groupby(_rows(), key=lambda row: row[0]):
+        group = list(group)
+        request_id, user_id, requested_at, request_text, spread = group[0][:5]
+        cards = [(card_id, role) for *_, card_id, role in group if card_id is not None]
+        writer.writerow((
+            request_id, user_id, requested_at, request_text, spread,
+            CSV_LIST_SEPARATOR.join(str(card_id) for card_id, _ in cards),
+            CSV_LIST_SEPARATOR.join(_card_name(catalog, card_id, '') for card_id, _ in cards),
+            CSV_LIST_SEPARATOR.join(role for _, role in cards),
+        ))
+        count += 1
+    return count
+
+
+def format_report(conn, catalog: CardCatalog | None = None, days: int = 14) -> str:
+    lines = [f"📊 Расклады за {days} дн.:"]
+    stats = daily_stats(conn, days)
+    if not stats:
+        lines.append("нет данных")
+    for day, readings, active_users in stats:
+        lines.append(f"{day}: {readings} раскл., {active_users} польз.")
+
+    lines.append("\n🃏 Частые карты:")
+    for card_id, role, total in top_cards(conn, days):
+        lines.append(f"{_card_name(catalog, card_id)} ({'блок' if role == 'block' else 'ресурс'}): {total}")
+
+    lines.append("\n👤 Активные пользователи:")
+    for user_id, readings, last_at in top_users(conn):
+        lines.append(f"{user_id}: {readings} раскл., последний {last_at}")
+    return '\n'.join(lines)
+
+
+def format_user(conn, user_id: int, catalog: CardCatalog | None = None) -> str:
+    summary = user_summary(conn, user_id)
+    if summary is None:
+        return f"У пользователя {user_id} нет раскладов."
+    readings, first_at, last_at = summary
+
+    lines = [f"👤 {user_id}: {readings} раскл. ({first_at} — {last_at})"]
+    for requested_at, spread, cards in user_history(conn, user_id):
+        names = ' → '.join(_card_name(catalog, card_id) for card_id, _ in cards)
+        lines.append(f"{requested_at} [{spread}]: {names}")
+    return '\n'.join(lines)
+
+
+def _query(fn, *args):
+    """Синхронный отчёт в отдельном потоке и на своём соединении — поток базы бота не занят."""
+    def _call():
+        conn = connect_readonly()
+        try:
+            return fn(conn, *args)
+        finally:
+            conn.close()
+    return asyncio.to_thread(_call)
+
+
+def create_admin_router(catalog: CardCatalog) -> Router:
+    router = Router()
+    router.message.filter(F.from_user.id.in_(ADMIN_IDS))
+
+    @router.message(Command("stats"))
+    async def stats_command(message: Message, command: CommandObject) -> None:
+        # /stats — сводка, /stats <user_id> — история пользователя
+        if command.args and command.args.strip().isdigit():
+            text = await _query(format_user, int(command.args.strip()), catalog)
+        else:
+            text = await _query(format_report, catalog)
+        await message.answer(text, parse_mode=None)
+
+    @router.message(Command("export"))
+    async def export_command(message: Message, command: CommandObject) -> None:
+        # /export [YYYY-MM-DD] — CSV истории раскладов (с даты, если указана)
+        since = command.args.strip() if command.args else None
+        fd, path = tempfile.mkstemp(prefix="requests-", suffix=".csv")
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8', newline='') as f:
+                count = await _query(export_csv, f, catalog, since)
+            await message.answer_document(FSInputFile(path, filename="requests.csv"),
+                                          caption=f"📄 Раскладов: {count}")
+        finally:
+            os.remove(path)
+
+    return router
+
+
+def _load_catalog() -> CardCatalog | None:
+    try:
+        return CardCatalog.from_json(os.path.join(os.path.dirname(os.path.abspath(__file__)), "cards.json"))
+    except (OSError, ValueError) as e:
+        logging.warning(f"⚠️ Колода не загружена, вместо названий карт будут id: {e}")
+        return None
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Отчёты по раскладам")
+    parser.add_argument("--db", default=database.DB_PATH, help="путь к базе")
+    commands = parser.add_subparsers(dest="command", required=True)
+    stats_parser = commands.add_parser("stats", help="сводка по дням, картам и пользователям")
+    stats_parser.add_argument("--days", type=int, default=14)
+    cards_parser = commands.add_parser("cards", help="самые частые карты")
+    cards_parser.add_argument("--days", type=int, default=30)
+    cards_parser.add_argument("--limit", type=int, default=20)
+    user_parser = commands.add_parser("user", help="история пользователя")
+    user_parser.add_argument("user_id", type=int)
+    export_parser = commands.add_parser("export", help="история раскладов в CSV ('-' — stdout)")
+    export_parser.add_argument("out")
+    export_parser.add_argument("--since", help="с даты YYYY-MM-DD")
+    args = parser.parse_args()
+
+    catalog = _load_catalog()
+    conn = connect_readonly(args.db)
+    if args.command == "stats":
+        print(format_report(conn, catalog, args.days))
+    elif args.command == "cards":
+        for card_id, role, total in top_cards(conn, args.days, args.limit):
+            print(f"{total:6d}  {role:8s}  {card_id:4d}  {_card_name(catalog, card_id, '')}")
+    elif args.command == "user":
+        print(format_user(conn, args.user_id, catalog))
+    elif args.command == "export":
+        if args.out == '-':
+            count = export_csv(conn, sys.stdout, catalog, args.since)
+        else:
+            with open(args.out, 'w', encoding='utf-8', newline='') as f:
+                count = export_csv(conn, f, catalog, args.since)
+        logging.info(f"✅ Выгружено раскладов: {count}")
+    conn.close()
@@ -0,0 +1,134 @@
+import asyncio
+import heapq
+import json
+import logging
+import time
+
+from aiogram import Bot
+
+from database import add_job, delete_jobs, claim_job, get_jobs
+from outbound import SCHEDULED, send_priority
+
+
+class JobScheduler:
+    """
+    Планировщик отложенных сообщений: одна задача asyncio и куча по времени
+    запуска поверх таблицы scheduled_jobs.
+
+    Тысячи ожидающих follow-up'ов стоят одну корутину и строки на диске,
+    а после перезапуска задачи поднимаются из базы (просроченные — сразу).
+    На пользователя держится не больше одной задачи каждого вида.
+    """
+
+    def __init__(self):
+        self._handlers = {}  # kind -> async (bot, user_id, payload)
+        self._heap = []  # (run_at, job_id, user_id, kind, payload)
+        self._current = {}  # (user_id, kind) -> job_id; всё прочее в куче — отменённые задачи
+        self._claiming = {}  # (user_id, kind) -> job_id задач, чью строку сейчас забирает claim_job
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._running = set()
+        self.bot: Bot | None = None
+
+    def register(self, kind: str, handler) -> None:
+        self._handlers[kind] = handler
+
+    @property
+    def pending(self) -> int:
+        return len(self._current)
+
+    def _push(self, job_id, user_id, kind, run_at, payload) -> None:
+        self._current[(user_id, kind)] = job_id
+        heapq.heappush(self._heap, (run_at, job_id, user_id, kind, payload))
+        self._wakeup.set()
+
+    async def enqueue(self, user_id: int, kind: str, delay: float, payload: dict | None = None) -> None:
+        run_at = time.time() + delay
+        raw_payload = json.dumps(payload) if payload is not None else None
+        job_id = await add_job(user_id, kind, run_at, raw_payload)
+        self._push(job_id, user_id, kind, run_at, payload)
+
+    async def cancel(self, user_id: int, *kinds: str) -> None:
+        # Чат закреплён за процессом, а start() поднимает все задачи своих чатов, так что
+        # неизвестной здесь задачи нет и в базе — тогда обходимся без записи.
+        # Задача, которую уже забирают (claim_job), тоже отменяется: _run_job её не выполнит
+        known = []
+        for kind in kinds:
+            queued = self._current.pop((user_id, kind), None)
+            claiming = self._claiming.pop((user_id, kind), None)
+            if queued is not None or claiming is not None:
+                known.append(kind)
+        if known:
+            await delete_jobs(user_id, known)
+
+    async def start(self, bot: Bot, owns=None) -> None:
+        """
+        Поднимает задачи из базы и запускает цикл.
+        owns(user_id) — принадлежит ли чат этому процессу: при нескольких процессах
+        каждый поднимает только задачи своих чатов.
+        """
+        self.bot = bot
+        for job_id, user_id, kind, run_at, raw_payload in await get_jobs():
+            if owns is not None and not owns(user_id):
+                continue
+            payload = json.loads(raw_payload) if raw_payload else None
+            self._push(job_id, user_id, kind, run_at, payload)
+        if self._heap:
+            logging.info(f"⏰ Восстановлено отложенных задач: {len(self._heap)}")
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self) -> None:
+        # Невыполненные задачи остаются в базе и выполнятся после перезапуска
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _loop(self) -> None:
+        while True:
+            self._wakeup.clear()
+            if not self._heap:
+                await self._wakeup.wait()
+                continue
+
+            run_at, job_id, user_id, kind, payload = self._heap[0]
+            delay = run_at - time.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            heapq.heappop(self._heap)
+            if self._current.get((user_id, kind)) != job_id:
+                continue  # отменена или заменена более новой
+            self._claiming[(user_id, kind)] = self._current.pop((user_id, kind))
+
+            task = asyncio.create_task(self._run_job(job_id, user_id, kind, payload))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _run_job(self, job_id, user_id, kind, payload) -> None:
+        send_priority.set(SCHEDULED)
+        key = (user_id, kind)
+        try:
+            try:
+                claimed = await claim_job(job_id)
+            finally:
+                # cancel(), пришедший во время claim_job, уже убрал задачу из _claiming
+                cancelled = self._claiming.get(key) != job_id
+                if not cancelled:
+                    del self._claiming[key]
+            if not claimed or cancelled:
+                return
+            handler = self._handlers.get(kind)
+            if handler is None:
+                logging.error(f"❌ Нет обработчика для задачи '{kind}'")
+                return
+            await handler(self.bot, user_id, payload)
+        except Exception as e:
+            logging.error(f"💥 Ошибка выполнения задачи '{kind}' для {user_id}: {e}")
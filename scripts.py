@@ -0,0 +1,124 @@
+import asyncio
+import heapq
+import logging
+
+from aiogram import Bot
+
+from outbound import SCHEDULED, send_priority
+
+
+class Step:
+    """
+    Шаг сценария: пауза `delay` секунд, затем сообщение `text`
+    (с клавиатурой `keyboard`) или произвольное действие `action`.
+
+    keyboard — разметка или функция context -> разметка.
+    action — async (bot, chat_id, context) -> bool | None; False прерывает сценарий.
+    """
+
+    __slots__ = ('delay', 'text', 'keyboard', 'action')
+
+    def __init__(self, delay: float = 0, text: str | None = None, keyboard=None, action=None):
+        self.delay = delay
+        self.text = text
+        self.keyboard = keyboard
+        self.action = action
+
+
+class ScriptEngine:
+    """
+    Проигрывает сценарии (кортежи Step) в фоне, по одному на чат.
+
+    Хендлер только запускает сценарий и сразу возвращается; новый сценарий
+    в том же чате отменяет предыдущий. Часы подменяемые (`sleep`), поэтому
+    движок можно гонять на VirtualClock без реального ожидания.
+    """
+
+    def __init__(self, sleep=asyncio.sleep):
+        self._sleep = sleep
+        self._running = {}  # chat_id -> Task
+
+    @property
+    def active(self) -> int:
+        return len(self._running)
+
+    def start(self, bot: Bot, chat_id: int, script, context: dict | None = None) -> asyncio.Task:
+        self.cancel(chat_id)
+        task = asyncio.create_task(self._play(bot, chat_id, script, context or {}))
+        self._running[chat_id] = task
+
+        def _done(t):
+            if self._running.get(chat_id) is t:
+                del self._running[chat_id]
+
+        task.add_done_callback(_done)
+        return task
+
+    def cancel(self, chat_id: int) -> bool:
+        task = self._running.pop(chat_id, None)
+        if task is None:
+            return False
+        task.cancel()
+        return True
+
+    async def wait(self, chat_id: int) -> None:
+        """Ждёт, пока доиграет текущий сценарий чата (бенчмарк, тесты)."""
+        task = self._running.get(chat_id)
+        if task is not None:
+            await asyncio.gather(task, return_exceptions=True)
+
+    async def stop(self) -> None:
+        tasks = list(self._running.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _play(self, bot: Bot, chat_id: int, script, context: dict) -> None:
+        # Паузные сообщения уступают очередь прямым ответам пользователям
+        send_priority.set(SCHEDULED)
+        try:
+            for step in script:
+                if step.delay:
+                    await self._sleep(step.delay)
+                if step.action is not None:
+                    if await step.action(bot, chat_id, context) is False:
+                        return
+                if step.text is not None:
+                    markup = step.keyboard(context) if callable(step.keyboard) else step.keyboard
+                    await bot.send_message(chat_id, step.text, reply_markup=markup)
+        except Exception as e:
+            logging.error(f"💥 Ошибка сценария в чате {chat_id}: {e}")
+
+
+class VirtualClock:
+    """Виртуальные часы для тестов и бенчмарков: sleep() ждёт advance(), а не реального времени."""
+
+    def __init__(self):
+        self.now = 0.0
+        self._sleepers = []  # (wake_at, seq, future)
+        self._seq = 0
+
+    async def sleep(self, delay: float) -> None:
+        future = asyncio.get_running_loop().create_future()
+        self._seq += 1
+        heapq.heappush(self._sleepers, (self.now + delay, self._seq, future))
+        await future
+
+    @staticmethod
+    async def _settle() -> None:
+        # Даём запущенным и проснувшимся корутинам дойти до следующего sleep()
+        for _ in range(10):
+            await asyncio.sleep(0)
+
+    async def advance(self, seconds: float) -> None:
+        """Продвигает время, по очереди будя всех, чей срок наступил."""
+        target = self.now + seconds
+        # Только что запущенные задачи ещё не уснули: их сроки отсчитываются от текущего now
+        await self._settle()
+        while self._sleepers and self._sleepers[0][0] <= target:
+            wake_at, _, future = heapq.heappop(self._sleepers)
+            self.now = wake_at
+            if not future.done():
+                future.set_result(None)
+            await self._settle()
+        self.now = target
@@ -0,0 +1,136 @@
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+
+from database import (
+    get_session, save_session, delete_session, save_session_now, delete_session_now, purge_sessions
+)
+
+# Сколько живёт брошенная сессия и сколько сессий держим в памяти
+SESSION_TTL = int(os.getenv("SESSION_TTL", 24 * 3600))
+SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", 10000))
+# Общий режим для нескольких процессов: без кэша в памяти, запись сразу в базу
+SHARED_SESSIONS = os.getenv("SHARED_STATE", "0") == "1" or int(os.getenv("WEB_CONCURRENCY", 1)) > 1
+PURGE_INTERVAL = 3600
+
+
+class Session:
+    """Состояние диалога пользователя. Карты хранятся по id, а не целыми записями."""
+
+    __slots__ = ('user_id', 'step', 'request_text', 'block_card_id', 'resource_card_id',
+                 'last_interaction', 'updated_at')
+
+    def __init__(self, user_id: int, step: str | None = None, request_text: str | None = None,
+                 block_card_id: int | None = None, resource_card_id: int | None = None,
+                 last_interaction: float | None = None, updated_at: float | None = None):
+        self.user_id = user_id
+        self.step = step
+        self.request_text = request_text
+        self.block_card_id = block_card_id
+        self.resource_card_id = resource_card_id
+        self.last_interaction = last_interaction
+        self.updated_at = updated_at or time.time()
+
+    def touch(self) -> None:
+        self.last_interaction = time.time()
+
+    def to_row(self) -> tuple:
+        return (self.user_id, self.step, self.request_text, self.block_card_id,
+                self.resource_card_id, self.last_interaction, self.updated_at)
+
+
+class SessionStore:
+    """
+    Хранилище сессий: ограниченный LRU-кэш в памяти с TTL поверх таблицы sessions.
+
+    Из памяти сессия может быть вытеснена в любой момент — она дочитается
+    из базы при следующем обращении, поэтому память не растёт с числом
+    пользователей, а сессии переживают перезапуск.
+
+    В общем режиме (shared=True) кэша нет: каждое чтение и запись идут
+    в SQLite, и несколько процессов бота видят одни и те же сессии.
+    """
+
+    def __init__(self, ttl: int = SESSION_TTL, max_size: int = SESSION_CACHE_SIZE,
+                 shared: bool = SHARED_SESSIONS):
+        self.ttl = ttl
+        self.max_size = 0 if shared else max_size
+        self.shared = shared
+        self._cache = OrderedDict()  # user_id -> Session
+        self._last_purge = 0.0
+        self._purge_task = None
+
+    def __len__(self):
+        return len(self._cache)
+
+    def _expired(self, session: Session, now: float) -> bool:
+        return now - session.updated_at > self.ttl
+
+    def _put(self, session: Session) -> None:
+        self._cache[session.user_id] = session
+        self._cache.move_to_end(session.user_id)
+        while len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+
+    async def get(self, user_id: int) -> Session | None:
+        now = time.time()
+        session = self._cache.get(user_id)
+        if session is not None:
+            if not self._expired(session, now):
+                self._cache.move_to_end(user_id)
+                return session
+            del self._cache[user_id]
+            return None
+
+        row = await get_session(user_id, now - self.ttl)
+        if row is None:
+            return None
+        session = Session(*row)
+        if self._expired(session, now):
+            return None
+        self._put(session)
+        return session
+
+    async def get_or_create(self, user_id: int) -> Session:
+        session = await self.get(user_id)
+        if session is None:
+            session = Session(user_id)
+            self._put(session)
+        return session
+
+    async def save(self, session: Session) -> None:
+        session.updated_at = time.time()
+        self._put(session)
+        if self.shared:
+            await save_session_now(session.to_row())
+        else:
+            await save_session(session.to_row())
+        self._maybe_purge(session.updated_at)
+
+    async def delete(self, user_id: int) -> None:
+        self._cache.pop(user_id, None)
+        if self.shared:
+            await delete_session_now(user_id)
+        else:
+            await delete_session(user_id)
+
+    def _maybe_purge(self, now: float) -> None:
+        if now - self._last_purge < PURGE_INTERVAL:
+            return
+        if self._purge_task is not None and not self._purge_task.done():
+            return
+        self._last_purge = now
+        self._purge_task = asyncio.create_task(self.purge(now))
+
+    async def purge(self, now: float | None = None) -> None:
+        """Удаляет из базы сессии старше TTL."""
+        now = now or time.time()
+        try:
+            removed = await purge_sessions(now - self.ttl)
+        except Exception as e:
+            logging.error(f"💥 Ошибка очистки устаревших сессий: {e}")
+            return
+        if removed:
+            logging.info(f"🗑 Удалено устаревших сессий: {removed}")
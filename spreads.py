@@ -0,0 +1,99 @@
+import logging
+
+from aiogram import Bot
+
+from card_media import CardMediaCache
+from catalog import CardCatalog
+from database import save_request
+from draws import DrawEngine
+
+
+class Position:
+    __slots__ = ('title', 'card_type')
+
+    def __init__(self, title: str, card_type: str):
+        self.title = title
+        self.card_type = card_type
+
+
+class Spread:
+    """Расклад: упорядоченные позиции, каждая тянет карту своего типа."""
+
+    __slots__ = ('key', 'title', 'positions')
+
+    def __init__(self, key: str, title: str, positions):
+        self.key = key
+        self.title = title
+        self.positions = tuple(positions)
+
+
+SPREADS = {spread.key: spread for spread in (
+    Spread('pair', "Блок и ресурс", (
+        Position("Блок", 'block'),
+        Position("Ресурс", 'resource'),
+    )),
+    Spread('three', "Прошлое, настоящее, будущее", (
+        Position("Прошлое", 'block'),
+        Position("Настоящее", 'block'),
+        Position("Будущее", 'resource'),
+    )),
+    Spread('cross', "Крест", (
+        Position("Ситуация", 'block'),
+        Position("Препятствие", 'block'),
+        Position("Ресурс", 'resource'),
+        Position("Совет", 'resource'),
+    )),
+)}
+
+MAX_MEDIA_GROUP = 10  # лимит Telegram на альбом
+
+
+class SpreadEngine:
+    """
+    Раскладывает карты: все карты тянутся сразу через DrawEngine (без повторов
+    внутри расклада и относительно прошлых вытягиваний пользователя),
+    недостающие картинки грузятся параллельно, а весь расклад уходит
+    одним sendMediaGroup — один запрос к API вместо отдельного фото на карту.
+    """
+
+    def __init__(self, catalog: CardCatalog, media: CardMediaCache, draws: DrawEngine):
+        self.catalog = catalog
+        self.media = media
+        self.draws = draws
+
+    async def draw(self, user_id: int, spread: Spread) -> list | None:
+        """Карты для позиций расклада или None, если в колоде не хватает карт нужного типа."""
+        needed = {}
+        for position in spread.positions:
+            needed[position.card_type] = needed.get(position.card_type, 0) + 1
+
+        drawn = {}
+        for card_type, count in needed.items():
+            cards = await self.draws.draw(user_id, card_type, self.catalog.of_type(card_type), count)
+            if cards is None:
+                return None
+            drawn[card_type] = cards
+        return [drawn[position.card_type].pop() for position in spread.positions]
+
+    async def deal(self, bot: Bot, chat_id: int, user_id: int, spread: Spread,
+                   request_text: str | None = None, idempotency_key: str | None = None) -> list | None:
+        """Тянет, отправляет альбомом и сохраняет расклад. Возвращает карты или None при ошибке."""
+        if not 2 <= len(spread.positions) <= MAX_MEDIA_GROUP:
+            raise ValueError(f"В альбоме может быть от 2 до {MAX_MEDIA_GROUP} карт: {spread.key}")
+
+        cards = await self.draw(user_id, spread)
+        if cards is None:
+            logging.error(f"❌ Не хватает карт для расклада {spread.key}")
+            return None
+
+        captions = [f"{position.title}: {card.name}" for position, card in zip(spread.positions, cards)]
+        messages = await self.media.send_media_group(bot, chat_id, cards, captions)
+        if not messages:
+            return None
+
+        await save_request(
+            user_id, request_text,
+            [(card.id, position.card_type) for position, card in zip(spread.positions, cards)],
+            spread=spread.key, idempotency_key=idempotency_key
+        )
+        return cards
@@ -0,0 +1,26 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database  # noqa: E402
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """Чистая база во временном каталоге и своя write-behind очередь на тест."""
+    monkeypatch.setattr(database, 'DB_PATH', str(tmp_path / 'test.db'))
+    monkeypatch.setattr(database, '_conn', None)
+    monkeypatch.setattr(database, 'write_queue', database.WriteBehindQueue(interval=0.01))
+    database.init_db()
+    yield database
+    database._close()
+
+
+@pytest.fixture
+def run():
+    """Прогоняет корутину сценария в свежем event loop и возвращает её результат."""
+    return asyncio.run
@@ -0,0 +1,169 @@
+import json
+import sqlite3
+import threading
+import time
+
+import pytest
+
+import database
+
+
+def make_legacy_db(path, rows=5):
+    """База до версионирования: исходная схема, user_version = 0, описания карт в requests."""
+    conn = sqlite3.connect(path)
+    database._migrate_1_base(conn)
+    conn.execute("INSERT INTO users (user_id, first_name) VALUES (1, 'Анна')")
+    conn.executemany(
+        'INSERT INTO requests (user_id, request_text, block_card_id, resource_card_id, '
+        'block_card_description, resource_card_description) VALUES (?, ?, ?, ?, ?, ?)',
+        [(1, f'запрос {i}', i, i + 1, 'блок', 'ресурс') for i in range(rows)]
+    )
+    conn.commit()
+    conn.close()
+
+
+def test_migrations_bring_legacy_db_to_current_schema(tmp_path, monkeypatch):
+    path = str(tmp_path / 'legacy.db')
+    make_legacy_db(path)
+    monkeypatch.setattr(database, 'DB_PATH', path)
+    database.init_db()
+    database.init_db()  # повторный запуск ничего не меняет
+
+    conn = sqlite3.connect(path)
+    try:
+        assert database._user_version(conn) == database.SCHEMA_VERSION
+        assert 'block_card_description' not in database._columns(conn, 'requests')
+        assert conn.execute('SELECT COUNT(*) FROM requests').fetchone()[0] == 5
+        cards = conn.execute(
+            'SELECT position, card_id, role FROM request_cards WHERE request_id = 3 ORDER BY position'
+        ).fetchall()
+        assert cards == [(0, 2, 'block'), (1, 3, 'resource')]
+        assert conn.execute('SELECT readings FROM user_readings WHERE user_id = 1').fetchone() == (5,)
+    finally:
+        conn.close()
+
+
+def test_newer_schema_is_refused(tmp_path, monkeypatch):
+    path = str(tmp_path / 'future.db')
+    conn = sqlite3.connect(path)
+    conn.execute(f'PRAGMA user_version = {database.SCHEMA_VERSION + 1}')
+    conn.close()
+    monkeypatch.setattr(database, 'DB_PATH', path)
+    with pytest.raises(RuntimeError, match='новее'):
+        database.init_db()
+
+
+def test_concurrent_init_db_migrates_once(tmp_path, monkeypatch):
+    path = str(tmp_path / 'legacy.db')
+    # Маленькие пачки: миграция 2 идёт несколькими транзакциями, между которыми блокировку SQLite отпускает
+    monkeypatch.setattr(database, 'MIGRATION_BATCH_SIZE', 10)
+    rows = 37
+    make_legacy_db(path, rows)
+    monkeypatch.setattr(database, 'DB_PATH', path)
+
+    original = database._migrate_2_normalize_requests
+
+    def slow_migrate_2(conn):
+        time.sleep(0.1)  # окно, в которое без общей блокировки входит второй init_db()
+        original(conn)
+
+    slow_migrate_2.__doc__ = original.__doc__
+    monkeypatch.setattr(database, 'MIGRATIONS', tuple(
+        (version, slow_migrate_2 if migration is original else migration) for version, migration in database.MIGRATIONS
+    ))
+
+    errors = []
+
+    def start():
+        try:
+            database.init_db()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=start) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    conn = sqlite3.connect(path)
+    try:
+        assert database._user_version(conn) == database.SCHEMA_VERSION
+        assert conn.execute('SELECT COUNT(*) FROM requests').fetchone()[0] == rows
+        assert conn.execute('SELECT COUNT(*) FROM request_cards').fetchone()[0] == rows * 2
+        assert conn.execute('SELECT readings FROM user_readings WHERE user_id = 1').fetchone() == (rows,)
+    finally:
+        conn.close()
+
+
+def test_current_request_writes_collapse(db, run):
+    async def scenario():
+        await db.add_or_update_user(1, 'Анна')
+        for text in ('первый', 'второй', 'третий'):
+            await db.update_current_request(1, text)
+        assert db.write_queue.depth == 1
+        await db.write_queue.flush()
+        return await db._run(lambda conn: conn.execute(
+            'SELECT current_request FROM users WHERE user_id = 1').fetchone()[0])
+
+    assert run(scenario()) == 'третий'
+    assert db.write_queue.collapsed == 2
+    assert db.write_queue.flushes == 1
+
+
+def test_pending_session_is_read_before_flush(db, run):
+    async def scenario():
+        row = (1, 'waiting_request', 'текст', None, None, 1.0, 2.0)
+        await db.save_session(row)
+        before = await db.get_session(1, 0)
+        await db.write_queue.flush()
+        after = await db.get_session(1, 0)
+        await db.delete_session(1)
+        deleted = await db.get_session(1, 0)
+        return row, before, after, deleted
+
+    row, before, after, deleted = run(scenario())
+    assert before == row
+    assert after == row
+    assert deleted is None
+
+
+def test_spread_is_saved_with_cards_once_per_idempotency_key(db, run):
+    async def scenario():
+        cards = [(10, 'block'), (20, 'resource'), (30, 'resource')]
+        await db.save_request(1, 'вопрос', cards, spread='triple', idempotency_key='cb-1')
+        await db.save_request(1, 'вопрос', cards, spread='triple', idempotency_key='cb-1')
+        await db.write_queue.flush()
+        return await db._run(lambda conn: (
+            conn.execute('SELECT spread, block_card_id, resource_card_id FROM requests').fetchall(),
+            conn.execute('SELECT position, card_id, role FROM request_cards ORDER BY position').fetchall(),
+        ))
+
+    requests, cards = run(scenario())
+    assert requests == [('triple', 10, 20)]
+    assert cards == [(0, 10, 'block'), (1, 20, 'resource'), (2, 30, 'resource')]
+
+
+def test_failing_row_is_set_aside_and_the_rest_is_written(db, run):
+    async def scenario():
+        await db.save_request(1, 'хороший', [(1, 'block'), (2, 'resource')])
+        # Значение, которое sqlite3 не умеет записать: пачка падает на каждой попытке
+        await db.save_request(1, object(), [(3, 'block')])
+        await db.save_draw_state(1, 'block', b'\x01')
+        for _ in range(db.write_queue.max_retries + 1):
+            await db.write_queue.flush()
+        return await db._run(lambda conn: (
+            conn.execute('SELECT request_text FROM requests').fetchall(),
+            conn.execute('SELECT drawn FROM draw_state').fetchall(),
+        ))
+
+    requests, draw_states = run(scenario())
+    assert requests == [('хороший',)]
+    assert draw_states == [(b'\x01',)]
+    assert db.write_queue.depth == 0
+    assert db.write_queue.set_aside == 1
+    with open(db.failed_writes_path(), encoding='utf-8') as f:
+        records = [json.loads(line) for line in f]
+    assert len(records) == 1
+    assert records[0]['requests'][0][0] == 1
@@ -0,0 +1,50 @@
+import json
+
+import card_assets
+import deck_bundle
+from card_media import CardMediaCache
+from catalog import Card
+from deck_bundle import DeckBundle
+
+PNG = b"\x89PNG\r\n\x1a\n" + b"\x00" * 16
+JPEG = b"\xff\xd8\xff\xe0" + b"\x00" * 16
+
+
+def make_bundle(tmp_path, monkeypatch, images: dict) -> DeckBundle:
+    (tmp_path / 'cards').mkdir()
+    cards = []
+    for card_id, (name, data) in images.items():
+        (tmp_path / 'cards' / name).write_bytes(data)
+        cards.append({'id': card_id, 'name': f"Карта {card_id}", 'type': 'block',
+                      'image_url': f"https://example.com/cards/{name}", 'description': '...'})
+    cards_json = tmp_path / 'cards.json'
+    cards_json.write_text(json.dumps(cards), encoding='utf-8')
+
+    # Сжатых вариантов нет — в бандл идут исходники из cards/
+    monkeypatch.setattr(deck_bundle, 'BASE_DIR', str(tmp_path))
+    assets = card_assets.CardAssets(str(tmp_path / 'assets'))
+    monkeypatch.setattr(card_assets, 'CardAssets', lambda: assets)
+    return DeckBundle(deck_bundle.build(str(cards_json), str(tmp_path / 'deck.bundle')))
+
+
+def test_bundle_keeps_format_of_original_image(tmp_path, monkeypatch):
+    bundle = make_bundle(tmp_path, monkeypatch, {1: ('1.png', PNG), 2: ('2.jpg', JPEG)})
+    assert bundle.image_ext(1) == '.png'
+    assert bundle.image_ext(2) == '.jpg'
+    assert bundle.image_ext(3) is None
+
+    # В бандлах без image_ext в индексе формат определяется по сигнатуре
+    bundle._image_exts.clear()
+    assert bundle.image_ext(1) == '.png'
+    assert bundle.image_ext(2) == '.jpg'
+
+
+def test_upload_is_named_after_image_format(tmp_path, monkeypatch, run):
+    bundle = make_bundle(tmp_path, monkeypatch, {1: ('1.png', PNG)})
+    card = Card(1, "Карта 1", '...', 'block', "https://example.com/cards/1.png")
+
+    async def load(card):
+        return bundle.image(card.id)
+
+    media = CardMediaCache(load, image_filename=lambda card: f"{card.id}{bundle.image_ext(card.id)}")
+    assert run(media._upload(card)).filename == '1.png'
@@ -0,0 +1,76 @@
+import asyncio
+from collections import namedtuple
+
+from draws import DrawEngine, make_rng
+
+Card = namedtuple('Card', 'id name')
+
+DECK = tuple(Card(i, f'карта {i}') for i in range(78))
+
+
+def test_no_repeats_until_deck_is_exhausted(db, run):
+    async def scenario():
+        engine = DrawEngine(make_rng(1))
+        first_cycle = [(await engine.draw_one(1, 'block', DECK)).id for _ in DECK]
+        next_card = await engine.draw_one(1, 'block', DECK)
+        return first_cycle, next_card
+
+    first_cycle, next_card = run(scenario())
+    assert sorted(first_cycle) == list(range(len(DECK)))
+    assert next_card in DECK
+
+
+def test_spread_across_cycle_boundary_has_no_duplicates(db, run):
+    async def scenario():
+        engine = DrawEngine(make_rng(2))
+        await engine.draw(1, 'block', DECK, count=len(DECK) - 1)
+        return await engine.draw(1, 'block', DECK, count=3)
+
+    cards = run(scenario())
+    assert len({card.id for card in cards}) == 3
+
+
+def test_state_is_kept_per_user_and_type(db, run):
+    async def scenario():
+        engine = DrawEngine(make_rng(3))
+        small = DECK[:2]
+        await engine.draw(1, 'block', small, count=2)
+        # Пройденная колода блоков не влияет на ресурсы и на другого пользователя
+        return (await engine.draw(1, 'resource', small, count=2),
+                await engine.draw(2, 'block', small, count=2))
+
+    resources, other_user = run(scenario())
+    assert sorted(card.id for card in resources) == [0, 1]
+    assert sorted(card.id for card in other_user) == [0, 1]
+
+
+def test_same_seed_gives_same_draws(db, run):
+    async def scenario():
+        sequences = []
+        for user_id in (1, 2):
+            engine = DrawEngine(make_rng('42'))
+            sequences.append([card.id for card in await engine.draw(user_id, 'block', DECK, count=10)])
+        return sequences
+
+    first, second = run(scenario())
+    assert first == second
+
+
+def test_pool_smaller_than_spread(db, run):
+    assert run(DrawEngine(make_rng(4)).draw(1, 'block', DECK[:2], count=3)) is None
+
+
+def test_concurrent_draws_of_one_user_do_not_repeat(db, run):
+    async def scenario():
+        engine = DrawEngine(make_rng(5))
+        pool = DECK[:2]
+        # Два одновременных апдейта на пользователя: оба читают состояние до записи друг друга
+        pairs = await asyncio.gather(*(
+            asyncio.gather(engine.draw_one(user_id, 'block', pool), engine.draw_one(user_id, 'block', pool))
+            for user_id in range(20)
+        ))
+        return pairs, engine._locks
+
+    pairs, locks = run(scenario())
+    assert all(first.id != second.id for first, second in pairs)
+    assert locks == {}
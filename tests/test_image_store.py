@@ -0,0 +1,65 @@
+from http_client import HttpResponse
+from image_store import ImageStore
+
+URL = "https://raw.githubusercontent.com/example/deck/main/cards/1.png"
+
+
+class FakeHttpClient:
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.requests = []  # заголовки запросов
+
+    async def get(self, url, headers=None):
+        self.requests.append(headers or {})
+        return self.responses.pop(0) if len(self.responses) > 1 else self.responses[0]
+
+
+def make_store(tmp_path, http_client, bundled: bytes | None = None):
+    bundled_dir = tmp_path / 'cards'
+    bundled_dir.mkdir()
+    if bundled is not None:
+        (bundled_dir / '1.png').write_bytes(bundled)
+    return ImageStore(http_client, cache_dir=str(tmp_path / 'cache'), bundled_dir=str(bundled_dir))
+
+
+def test_bundled_card_is_revalidated_once_per_interval(tmp_path, run):
+    http_client = FakeHttpClient(HttpResponse(500, {}, b'error'))
+    store = make_store(tmp_path, http_client, bundled=b'bundled')
+
+    async def scenario():
+        results = []
+        for _ in range(5):
+            results.append(await store.get(URL))
+            for task in list(store._background):
+                await task
+        await store.close()
+        return results
+
+    # GitHub недоступен: картинка из cards/, а в сеть — один раз за интервал, а не на каждый get()
+    assert run(scenario()) == [b'bundled'] * 5
+    assert len(http_client.requests) == 1
+
+
+def test_mirror_is_revalidated_with_etag(tmp_path, run):
+    http_client = FakeHttpClient(HttpResponse(200, {'ETag': '"v1"'}, b'v1'), HttpResponse(304, {}, b''))
+    store = make_store(tmp_path, http_client)
+
+    async def scenario():
+        first = await store.fetch(URL)
+        second = await store.fetch(URL)
+        await store.close()
+        return first, second
+
+    assert run(scenario()) == (b'v1', b'v1')
+    assert http_client.requests[1] == {'If-None-Match': '"v1"'}
+
+
+def test_unexpected_304_without_cached_copy(tmp_path, run):
+    store = make_store(tmp_path, FakeHttpClient(HttpResponse(304, {}, b'')))
+
+    async def scenario():
+        data = await store.fetch(URL)
+        await store.close()
+        return data
+
+    assert run(scenario()) is None
@@ -0,0 +1,146 @@
+import asyncio
+
+import scheduler as scheduler_module
+from scheduler import JobScheduler
+
+# Ожидание реальное, но короткое: планировщик живёт на time.time()
+TICK = 0.05
+
+
+def make_scheduler(calls):
+    scheduler = JobScheduler()
+
+    async def handler(bot, user_id, payload):
+        calls.append((user_id, payload))
+
+    scheduler.register('follow_up', handler)
+    return scheduler
+
+
+def test_job_runs_after_delay_and_leaves_db(db, run):
+    calls = []
+
+    async def scenario():
+        scheduler = make_scheduler(calls)
+        await scheduler.start(bot=None)
+        await scheduler.enqueue(1, 'follow_up', TICK, {'card': 7})
+        assert calls == []
+        await asyncio.sleep(TICK * 4)
+        await scheduler.stop()
+        return scheduler.pending, await db.get_jobs()
+
+    pending, jobs = run(scenario())
+    assert calls == [(1, {'card': 7})]
+    assert pending == 0
+    assert jobs == []
+
+
+def test_cancelled_and_replaced_jobs_do_not_run(db, run):
+    calls = []
+
+    async def scenario():
+        scheduler = make_scheduler(calls)
+        await scheduler.start(bot=None)
+        await scheduler.enqueue(1, 'follow_up', TICK, {'n': 1})
+        await scheduler.cancel(1, 'follow_up')
+        await scheduler.enqueue(2, 'follow_up', TICK, {'n': 1})
+        await scheduler.enqueue(2, 'follow_up', TICK, {'n': 2})
+        await asyncio.sleep(TICK * 4)
+        await scheduler.stop()
+        return await db.get_jobs()
+
+    assert run(scenario()) == []
+    assert calls == [(2, {'n': 2})]
+
+
+def test_jobs_survive_restart(db, run):
+    calls = []
+
+    async def scenario():
+        first = make_scheduler(calls)
+        await first.start(bot=None)
+        await first.enqueue(1, 'follow_up', TICK * 2)
+        await first.stop()
+
+        second = make_scheduler(calls)
+        await second.start(bot=None)
+        assert second.pending == 1
+        await asyncio.sleep(TICK * 5)
+        await second.stop()
+
+    run(scenario())
+    assert calls == [(1, None)]
+
+
+def test_cancel_writes_only_for_known_jobs(db, monkeypatch, run):
+    deletes = []
+    delete_jobs = scheduler_module.delete_jobs
+
+    async def counting_delete_jobs(user_id, kinds):
+        deletes.append((user_id, tuple(kinds)))
+        await delete_jobs(user_id, kinds)
+
+    monkeypatch.setattr(scheduler_module, 'delete_jobs', counting_delete_jobs)
+
+    async def scenario():
+        scheduler = make_scheduler([])
+        scheduler.register('final', scheduler._handlers['follow_up'])
+        await scheduler.start(bot=None)
+        await scheduler.cancel(1, 'follow_up', 'final')  # задач нет — в базу не ходим
+        await scheduler.enqueue(2, 'follow_up', 60)
+        await scheduler.enqueue(2, 'final', 60)
+        await scheduler.cancel(2, 'follow_up', 'final')
+        await scheduler.stop()
+        return scheduler.pending, await db.get_jobs()
+
+    pending, jobs = run(scenario())
+    assert deletes == [(2, ('follow_up', 'final'))]
+    assert pending == 0
+    assert jobs == []
+
+
+def test_each_process_loads_only_jobs_of_its_chats(db, run):
+    async def scenario():
+        await db.add_job(1, 'follow_up', 0, None)
+        await db.add_job(2, 'follow_up', 0, None)
+        await db.add_job(3, 'follow_up', 0, None)
+        calls = [[], []]
+        for process_index in (0, 1):
+            scheduler = make_scheduler(calls[process_index])
+            await scheduler.start(bot=None, owns=lambda user_id: user_id % 2 == process_index)
+            await asyncio.sleep(TICK)
+            await scheduler.stop()
+        return calls
+
+    even, odd = run(scenario())
+    assert even == [(2, None)]
+    assert sorted(odd) == [(1, None), (3, None)]
+
+
+def test_cancel_while_job_is_being_claimed(db, monkeypatch, run):
+    calls = []
+    claim_job = scheduler_module.claim_job
+
+    async def scenario():
+        claiming = asyncio.Event()
+        release = asyncio.Event()
+
+        async def slow_claim_job(job_id):
+            claiming.set()
+            await release.wait()
+            return await claim_job(job_id)
+
+        monkeypatch.setattr(scheduler_module, 'claim_job', slow_claim_job)
+        scheduler = make_scheduler(calls)
+        await scheduler.start(bot=None)
+        await scheduler.enqueue(1, 'follow_up', 0)
+        await claiming.wait()
+        # Задача уже ушла из кучи, но строка ещё не забрана: отмена должна её остановить
+        await scheduler.cancel(1, 'follow_up')
+        release.set()
+        await asyncio.sleep(TICK)
+        await scheduler.stop()
+        return await db.get_jobs()
+
+    assert run(scenario()) == []
+    assert calls == []
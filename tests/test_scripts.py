@@ -0,0 +1,133 @@
+import asyncio
+
+from scripts import ScriptEngine, Step, VirtualClock
+
+
+class FakeBot:
+    def __init__(self, clock: VirtualClock):
+        self.clock = clock
+        self.sent = []  # (время, чат, текст, разметка)
+
+    async def send_message(self, chat_id, text, reply_markup=None):
+        self.sent.append((self.clock.now, chat_id, text, reply_markup))
+
+
+def test_steps_are_sent_after_their_delays(run):
+    async def scenario():
+        clock = VirtualClock()
+        bot = FakeBot(clock)
+        engine = ScriptEngine(sleep=clock.sleep)
+        task = engine.start(bot, 1, (Step(2, "a"), Step(5, "b"), Step(0, "c")))
+        await clock.advance(1)
+        assert bot.sent == []
+        await clock.advance(10)
+        await task
+        return bot.sent, engine.active
+
+    sent, active = run(scenario())
+    assert [(at, text) for at, _, text, _ in sent] == [(2, "a"), (7, "b"), (7, "c")]
+    assert active == 0
+
+
+def test_keyboard_is_built_from_context(run):
+    async def scenario():
+        clock = VirtualClock()
+        bot = FakeBot(clock)
+        engine = ScriptEngine(sleep=clock.sleep)
+        task = engine.start(bot, 1, (Step(1, "x", keyboard=lambda ctx: ctx['card']),), {'card': 42})
+        await clock.advance(1)
+        await task
+        return bot.sent
+
+    assert run(scenario())[0][3] == 42
+
+
+def test_new_script_cancels_previous_in_same_chat(run):
+    async def scenario():
+        clock = VirtualClock()
+        bot = FakeBot(clock)
+        engine = ScriptEngine(sleep=clock.sleep)
+        first = engine.start(bot, 1, (Step(1, "old-1"), Step(5, "old-2")))
+        other_chat = engine.start(bot, 2, (Step(3, "other"),))
+        await clock.advance(2)
+        second = engine.start(bot, 1, (Step(1, "new"),))
+        await clock.advance(10)
+        await asyncio.gather(first, second, other_chat, return_exceptions=True)
+        return bot.sent, first.cancelled()
+
+    sent, first_cancelled = run(scenario())
+    assert [(at, chat, text) for at, chat, text, _ in sent] == [(1, 1, "old-1"), (3, 2, "other"), (3, 1, "new")]
+    assert first_cancelled
+
+
+def test_cancel_stops_script(run):
+    async def scenario():
+        clock = VirtualClock()
+        bot = FakeBot(clock)
+        engine = ScriptEngine(sleep=clock.sleep)
+        task = engine.start(bot, 1, (Step(1, "a"), Step(1, "b")))
+        await clock.advance(1)
+        assert engine.cancel(1)
+        assert not engine.cancel(1)
+        await clock.advance(5)
+        await asyncio.gather(task, return_exceptions=True)
+        return bot.sent, engine.active
+
+    sent, active = run(scenario())
+    assert [text for _, _, text, _ in sent] == ["a"]
+    assert active == 0
+
+
+def test_action_returning_false_stops_script(run):
+    calls = []
+
+    async def action(bot, chat_id, context):
+        calls.append(chat_id)
+        return context['go_on']
+
+    async def scenario(go_on):
+        clock = VirtualClock()
+        bot = FakeBot(clock)
+        engine = ScriptEngine(sleep=clock.sleep)
+        task = engine.start(bot, 1, (Step(1, action=action), Step(1, "after")), {'go_on': go_on})
+        await clock.advance(5)
+        await task
+        return [text for _, _, text, _ in bot.sent]
+
+    assert run(scenario(False)) == []
+    assert run(scenario(None)) == ["after"]
+    assert calls == [1, 1]
+
+
+def test_stop_cancels_all_scripts(run):
+    async def scenario():
+        clock = VirtualClock()
+        bot = FakeBot(clock)
+        engine = ScriptEngine(sleep=clock.sleep)
+        for chat_id in range(3):
+            engine.start(bot, chat_id, (Step(10, "late"),))
+        await clock.advance(1)
+        await engine.stop()
+        await clock.advance(20)
+        return bot.sent, engine.active
+
+    sent, active = run(scenario())
+    assert sent == []
+    assert active == 0
+
+
+def test_wait_returns_when_script_finishes(run):
+    async def scenario():
+        clock = VirtualClock()
+        bot = FakeBot(clock)
+        engine = ScriptEngine(sleep=clock.sleep)
+        engine.start(bot, 1, (Step(5, "a"),))
+        waiter = asyncio.create_task(engine.wait(1))
+        await clock.advance(4)
+        assert not waiter.done()
+        await clock.advance(1)
+        await waiter
+        await engine.wait(2)  # сценария нет — не ждём
+        return [text for _, _, text, _ in bot.sent]
+
+    assert run(scenario()) == ["a"]
@@ -0,0 +1,191 @@
+import asyncio
+import logging
+import os
+from collections import deque
+
+from aiogram import Bot, Dispatcher
+from aiogram.methods import TelegramMethod
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+from aiohttp import ClientError, ClientSession, ClientTimeout, web
+
+# Число воркеров и предел очереди входящих апдейтов (выше — отказ с 503)
+WORKERS = int(os.getenv("WEBHOOK_WORKERS", 8))
+QUEUE_LIMIT = int(os.getenv("WEBHOOK_QUEUE_LIMIT", 1000))
+# При нескольких процессах процесс N принимает пересланные апдейты на 127.0.0.1:(база + N)
+INTERNAL_PORT_BASE = int(os.getenv("WEBHOOK_INTERNAL_PORT", 10100))
+INTERNAL_PATH = "/internal/update"
+FORWARD_TIMEOUT = 5
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+def chat_key(update: dict):
+    """Ключ упорядочивания: id чата (или пользователя) из сырого апдейта."""
+    for name, event in update.items():
+        if name == 'update_id' or not isinstance(event, dict):
+            continue
+        chat = event.get('chat') or (event.get('message') or {}).get('chat')
+        if chat:
+            return chat['id']
+        user = event.get('from') or event.get('user')
+        if user:
+            return user['id']
+    return update.get('update_id')
+
+
+def owner_of(key, processes: int) -> int:
+    """Процесс, которому принадлежит чат: все апдейты чата обрабатывает один процесс."""
+    return hash(key) % processes if processes > 1 else 0
+
+
+class QueuedRequestHandler(SimpleRequestHandler):
+    """
+    Вебхук, который сразу отвечает Telegram 200, а апдейт кладёт в очередь.
+
+    Апдейты одного чата обрабатываются строго по порядку (чат в каждый момент
+    у одного воркера), разные чаты — параллельно на WORKERS воркерах.
+    При переполнении очереди (QUEUE_LIMIT) отвечаем 503 — Telegram повторит позже.
+
+    Если процессов несколько (общий порт через SO_REUSEPORT), Telegram может
+    отдать апдейты одного чата разным процессам. Поэтому каждый чат закреплён
+    за одним процессом (owner_of), а чужие апдейты пересылаются владельцу на его
+    внутренний порт — порядок внутри чата сохраняется и между процессами.
+    """
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, workers: int = WORKERS,
+                 queue_limit: int = QUEUE_LIMIT, process_index: int = 0, processes: int = 1, **kwargs):
+        super().__init__(dispatcher=dispatcher, bot=bot, handle_in_background=True, **kwargs)
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self.process_index = process_index
+        self.processes = processes
+        self._internal_runner = None
+        self._forward_session = None
+        self.forwarded = 0
+        self._chats = {}  # chat_key -> deque апдейтов
+        self._ready = asyncio.Queue()  # чаты, у которых есть апдейты и нет воркера
+        self._depth = 0
+        self._busy = 0
+        self._worker_tasks = []
+        self.accepted = 0
+        self.processed = 0
+        self.shed = 0
+
+    def register(self, app: web.Application, /, path: str, **kwargs) -> None:
+        app.on_startup.append(self._start_workers)
+        if self.processes > 1:
+            app.on_startup.append(self._start_internal)
+        super().register(app, path=path, **kwargs)
+
+    async def _start_workers(self, app: web.Application) -> None:
+        self._worker_tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def _start_internal(self, app: web.Application) -> None:
+        internal = web.Application()
+        internal.router.add_post(INTERNAL_PATH, self._handle_forwarded)
+        self._internal_runner = web.AppRunner(internal)
+        await self._internal_runner.setup()
+        await web.TCPSite(self._internal_runner, "127.0.0.1", INTERNAL_PORT_BASE + self.process_index).start()
+        self._forward_session = ClientSession(timeout=ClientTimeout(total=FORWARD_TIMEOUT))
+
+    async def close(self) -> None:
+        for task in self._worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        self._worker_tasks = []
+        if self._forward_session is not None:
+            await self._forward_session.close()
+            self._forward_session = None
+        if self._internal_runner is not None:
+            await self._internal_runner.cleanup()
+            self._internal_runner = None
+        await super().close()
+
+    @property
+    def depth(self) -> int:
+        return self._depth
+
+    def stats(self) -> dict:
+        return {
+            'workers': self.workers,
+            'busy_workers': self._busy,
+            'queue_depth': self._depth,
+            'queue_limit': self.queue_limit,
+            'queued_chats': len(self._chats),
+            'accepted': self.accepted,
+            'processed': self.processed,
+            'shed': self.shed,
+            'forwarded': self.forwarded,
+        }
+
+    async def _handle_request_background(self, bot: Bot, request: web.Request) -> web.Response:
+        update = await request.json(loads=bot.session.json_loads)
+        key = chat_key(update)
+        owner = owner_of(key, self.processes)
+        if owner != self.process_index:
+            return await self._forward(owner, update)
+        return self._enqueue(bot, key, update)
+
+    async def _handle_forwarded(self, request: web.Request) -> web.Response:
+        if self.secret_token and request.headers.get(SECRET_HEADER) != self.secret_token:
+            return web.Response(status=401)
+        update = await request.json(loads=self.bot.session.json_loads)
+        return self._enqueue(self.bot, chat_key(update), update)
+
+    async def _forward(self, owner: int, update: dict) -> web.Response:
+        # Владелец только ставит апдейт в очередь, так что ответ приходит быстро.
+        # Не удалось — отвечаем Telegram 503, он доставит апдейт повторно
+        headers = {SECRET_HEADER: self.secret_token} if self.secret_token else None
+        url = f"http://127.0.0.1:{INTERNAL_PORT_BASE + owner}{INTERNAL_PATH}"
+        try:
+            async with self._forward_session.post(url, json=update, headers=headers) as resp:
+                status = resp.status
+        except (ClientError, asyncio.TimeoutError) as e:
+            logging.warning(f"⚠️ Не удалось переслать апдейт процессу {owner}: {e!r}")
+            return web.Response(status=503, text="Owner unavailable")
+        if status != 200:
+            return web.Response(status=503, text="Owner unavailable")
+        self.forwarded += 1
+        return web.json_response({})
+
+    def _enqueue(self, bot: Bot, key, update: dict) -> web.Response:
+        if self._depth >= self.queue_limit:
+            self.shed += 1
+            logging.warning(f"⚠️ Очередь апдейтов переполнена ({self._depth}), отвечаем 503")
+            return web.Response(status=503, text="Overloaded")
+
+        pending = self._chats.get(key)
+        if pending is None:
+            self._chats[key] = deque([(bot, update)])
+            self._ready.put_nowait(key)
+        else:
+            pending.append((bot, update))
+        self._depth += 1
+        self.accepted += 1
+        return web.json_response({}, dumps=bot.session.json_dumps)
+
+    async def _worker(self) -> None:
+        while True:
+            key = await self._ready.get()
+            pending = self._chats[key]
+            bot, update = pending[0]
+            self._busy += 1
+            try:
+                await self._process(bot, update)
+            finally:
+                self._busy -= 1
+                pending.popleft()
+                self._depth -= 1
+                self.processed += 1
+                # Остальные апдейты чата — в конец очереди, чтобы не занимать воркер надолго
+                if pending:
+                    self._ready.put_nowait(key)
+                else:
+                    del self._chats[key]
+
+    async def _process(self, bot: Bot, update: dict) -> None:
+        try:
+            result = await self.dispatcher.feed_raw_update(bot=bot, update=update, **self.data)
+            if isinstance(result, TelegramMethod):
+                await self.dispatcher.silent_call_request(bot=bot, result=result)
+        except Exception as e:
+            logging.error(f"💥 Ошибка обработки апдейта {update.get('update_id')}: {e}")